@@ -18,6 +18,8 @@ from keg_auth.model import (
     UserEmailMixin,
     UserTokenMixin,
     AttemptMixin,
+    RevokedTokenMixin,
+    RefreshTokenMixin,
     PermissionMixin,
     GroupMixin,
     BundleMixin,
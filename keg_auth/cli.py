@@ -1,9 +1,24 @@
+import arrow
 import click
 import keg
+import sqlalchemy as sa
 
 from keg_auth.model import get_username_key
 from keg_auth.extensions import gettext as _
 from keg_auth.libs.authenticators import PasswordPolicyError
+from keg_auth.libs.hashing import (
+    calibrate_schemes,
+    check_rounds,
+    recommend_cryptcontext_kwargs,
+    scheme_available,
+)
+from keg_auth.libs.invites import (
+    INVITE_URL_KINDS,
+    generate_invite_urls,
+    stream_users,
+    write_invite_urls,
+)
+from keg_auth.libs.lockout import LockoutPolicy, simulate_lockout
 from keg_auth.model.entity_registry import RegistryError
 
 
@@ -114,4 +129,248 @@ def add_cli_to_app(app, cli_group_name, user_args=('email',)):
 
     auth.command('purge-attempts')(purge_attempts)
 
+    @click.option('--attempt-type', '--type', default='login',
+                  type=click.Choice(['login', 'forgot', 'reset']))
+    @click.option('--policy', 'policies', multiple=True, metavar='LIMIT:TIMESPAN:LOCKOUT',
+                  help='candidate policy to replay (may be given more than once),'
+                       ' defaults to the configured policy')
+    @click.option('--ip-limit/--no-ip-limit', default=None,
+                  help='also count attempts from the same source IP toward an input,'
+                       ' defaults to KEGAUTH_ATTEMPT_IP_LIMIT')
+    @click.option('--since', type=int, help='only replay attempts from the last N days')
+    def simulate_lockout_cmd(attempt_type, policies, ip_limit, since):
+        """Replay stored attempts through candidate attempt limiting policies."""
+        auth_manager = keg.current_app.auth_manager
+        try:
+            attempt_ent = auth_manager.entity_registry.attempt_cls
+        except RegistryError:
+            click.echo('No attempt class has been registered.')
+            return
+
+        config = keg.current_app.config
+        if ip_limit is None:
+            ip_limit = config.get('KEGAUTH_ATTEMPT_IP_LIMIT', False)
+
+        if policies:
+            try:
+                policies = [
+                    LockoutPolicy(*(int(part) for part in policy.split(':')))
+                    for policy in policies
+                ]
+            except (TypeError, ValueError):
+                raise click.BadParameter('expected LIMIT:TIMESPAN:LOCKOUT', param_hint='--policy')
+        else:
+            policies = [LockoutPolicy(*(
+                config.get(
+                    f'KEGAUTH_{attempt_type.upper()}_ATTEMPT_{key}',
+                    config.get(f'KEGAUTH_ATTEMPT_{key}')
+                )
+                for key in ('LIMIT', 'TIMESPAN', 'LOCKOUT')
+            ))]
+
+        since_dt = arrow.utcnow().shift(days=-since) if since is not None else None
+        reports = simulate_lockout(attempt_ent, attempt_type, policies, ip_limit=ip_limit,
+                                   since=since_dt)
+        for report in reports:
+            click.echo(
+                'limit={0.limit} timespan={0.timespan} lockout={0.lockout}'.format(report.policy)
+            )
+            click.echo(f'  attempts: {report.attempts}, blocked: {report.blocked}')
+            click.echo(f'  users locked out: {report.users_locked_out} of {report.users}'
+                       f' ({report.successes_blocked} successful attempts blocked)')
+            click.echo(f'  attacker attempts blocked: {report.attacker_attempts_blocked}'
+                       f' of {report.attacker_attempts}')
+
+    auth.command('simulate-lockout')(simulate_lockout_cmd)
+
+    @click.argument('input_file', type=click.File('r', encoding='utf-8'))
+    @click.option('--format', 'input_format', type=click.Choice(['csv', 'jsonl']),
+                  help='input format, defaults to the file extension (or csv)')
+    @click.option('--batch-size', type=int, default=1000, show_default=True,
+                  help='users to insert per transaction')
+    @click.option('--workers', type=int, default=None,
+                  help='processes for password hashing, defaults to the CPU count (0 for none)')
+    @click.option('--send-mail', is_flag=True, help='send new users the verification mail')
+    def import_users(input_file, input_format, batch_size, workers, send_mail):
+        """Create users in bulk from a CSV or JSON lines file.
+
+        Records hold user fields, plus optional password, groups, and bundles (separate several
+        names with ";" in CSV). Users that already exist are skipped, so an interrupted import can
+        be resumed by running it again.
+        """
+        from keg_auth.libs.user_import import UserImportError, read_user_records
+
+        if input_format is None:
+            input_format = 'jsonl' if input_file.name.endswith(('.jsonl', '.json')) else 'csv'
+
+        def progress(report):
+            click.echo(f'Line {report.last_line}: {report.created} created,'
+                       f' {report.skipped} skipped, {len(report.errors)} errors')
+
+        auth_manager = keg.current_app.auth_manager
+        try:
+            report = auth_manager.import_users(
+                read_user_records(input_file, format=input_format),
+                batch_size=batch_size,
+                workers=workers,
+                mail_enabled=send_mail,
+                progress=progress,
+            )
+        except UserImportError as exc:
+            click.echo(f'Import stopped: {exc}', err=True)
+            return
+
+        for line, message in report.errors:
+            click.echo(f'Line {line}: {message}', err=True)
+        summary = f'Imported {report.created} users, skipped {report.skipped} existing'
+        if send_mail:
+            summary += f', sent {report.mailed} emails'
+        click.echo(summary + '.')
+
+    auth.command('import-users')(import_users)
+
+    @click.option('--page-size', type=int, default=None,
+                  help='entries per LDAP search page, defaults to KEGAUTH_LDAP_SYNC_PAGE_SIZE')
+    @click.option('--no-create-users', is_flag=True,
+                  help='only update membership of users that already exist')
+    @click.option('--dry-run', is_flag=True, help='report the changes without saving them')
+    def ldap_sync(page_size, no_create_users, dry_run):
+        """Synchronize users and group membership from the LDAP directory.
+
+        Groups found in the directory are created as needed, and their members set to match it.
+        Sessions of users whose groups changed are invalidated.
+        """
+        try:
+            import ldap
+        except ImportError:
+            click.echo('LDAP sync requires python-ldap.', err=True)
+            return
+        from keg_auth.libs.ldap_sync import LdapDirectory, LdapSync, connect_directory
+
+        app = keg.current_app
+        registry = app.auth_manager.entity_registry
+        required = ('KEGAUTH_LDAP_SERVER_URL', 'KEGAUTH_LDAP_SYNC_USER_BASE_DN',
+                    'KEGAUTH_LDAP_SYNC_GROUP_BASE_DN')
+        missing = [name for name in required if not app.config.get(name)]
+        if missing:
+            click.echo(f'LDAP sync needs {", ".join(missing)} configured.', err=True)
+            return
+
+        try:
+            conn = connect_directory(app.config)
+            try:
+                directory = LdapDirectory.read(conn, app.config, page_size=page_size)
+            finally:
+                conn.unbind_s()
+        except ldap.LDAPError as exc:
+            click.echo(f'LDAP sync stopped: {exc}', err=True)
+            return
+
+        report = LdapSync(
+            registry.user_cls, registry.group_cls, create_users=not no_create_users,
+        ).run(directory, dry_run=dry_run)
+        click.echo(f'Read {len(directory.users)} users and {len(directory.groups)} groups.')
+        click.echo(f'Created {report.users_created} users and {report.groups_created} groups,'
+                   f' added {report.memberships_added} and removed {report.memberships_removed}'
+                   f' memberships, invalidated {report.sessions_invalidated} sessions.')
+        if dry_run:
+            click.echo('Dry run, no changes saved.')
+
+    auth.command('ldap-sync')(ldap_sync)
+
+    @click.option('--kind', type=click.Choice(INVITE_URL_KINDS), default='verify-account',
+                  show_default=True)
+    @click.option('--user-id', 'user_ids', type=int, multiple=True,
+                  help='user to include (may be given more than once)')
+    @click.option('--username-like', help='SQL LIKE pattern for usernames to include')
+    @click.option('--unverified', is_flag=True, help='only include users not yet verified')
+    @click.option('--never-logged-in', is_flag=True, help='only include users who never logged in')
+    @click.option('--format', 'output_format', type=click.Choice(['csv', 'jsonl']), default='csv',
+                  show_default=True)
+    @click.option('--output', type=click.File('w', encoding='utf-8'), default='-',
+                  help='file to write, defaults to stdout')
+    @click.option('--batch-size', type=int, default=1000, show_default=True,
+                  help='users to fetch per round trip')
+    def invite_urls(kind, user_ids, username_like, unverified, never_logged_in, output_format,
+                    output, batch_size):
+        """Generate verification or reset URLs for a set of users."""
+        user_ent = keg.current_app.auth_manager.entity_registry.user_cls
+        query = user_ent.query.order_by(user_ent.id)
+        if user_ids:
+            query = query.filter(user_ent.id.in_(user_ids))
+        if username_like:
+            query = query.filter(user_ent.username.like(username_like))
+        if unverified:
+            if not hasattr(user_ent, 'is_verified'):
+                click.echo('Users have no verified status.', err=True)
+                return
+            query = query.filter(user_ent.is_verified == sa.false())
+        if never_logged_in:
+            query = query.filter(user_ent.last_login_utc.is_(None))
+
+        rows = generate_invite_urls(stream_users(query, batch_size=batch_size), kind=kind)
+        count = write_invite_urls(rows, output, format=output_format)
+        click.echo(f'Generated {count} URLs.', err=True)
+
+    auth.command('invite-urls')(invite_urls)
+
+    @click.option('--target-ms', type=float, default=250, show_default=True,
+                  help='p99 verify latency budget in milliseconds')
+    @click.option('--threads', type=int, default=1, show_default=True,
+                  help='number of concurrent verifications')
+    @click.option('--samples', type=int, default=20, show_default=True,
+                  help='verifications to time per cost value')
+    @click.option('--scheme', 'schemes', multiple=True,
+                  help='scheme to benchmark (may be given more than once), defaults to the'
+                       ' keg-auth default schemes, plus argon2 if installed')
+    @click.option('--rounds', 'rounds', multiple=True, metavar='SCHEME:ROUNDS',
+                  help='cost value to try for a scheme (may be given more than once), defaults'
+                       ' to a range suited to each scheme')
+    def calibrate_hash(target_ms, threads, samples, schemes, rounds):
+        """Benchmark password hash costs and recommend PASSLIB_CRYPTCONTEXT_KWARGS."""
+        from keg_auth.core import DEFAULT_CRYPTO_SCHEMES
+
+        if not schemes:
+            schemes = (('argon2',) if scheme_available('argon2') else ()) + DEFAULT_CRYPTO_SCHEMES
+        unavailable = [scheme for scheme in schemes if not scheme_available(scheme)]
+        if unavailable:
+            click.echo(f'Scheme not available: {", ".join(unavailable)}')
+            return
+
+        # each scheme measures cost in its own units (e.g. bcrypt's are log2 of the iterations,
+        # pbkdf2's are iterations), so cost values are given per scheme
+        scheme_rounds = {}
+        for value in rounds:
+            scheme, _sep, cost = value.rpartition(':')
+            try:
+                cost = int(cost)
+            except ValueError:
+                scheme = None
+            if not scheme:
+                raise click.BadParameter('expected SCHEME:ROUNDS', param_hint='--rounds')
+            if scheme not in schemes:
+                raise click.BadParameter(f'{scheme} is not being calibrated',
+                                         param_hint='--rounds')
+            try:
+                check_rounds(scheme, cost)
+            except ValueError as exc:
+                raise click.BadParameter(str(exc), param_hint='--rounds')
+            scheme_rounds.setdefault(scheme, []).append(cost)
+
+        results = []
+        for result in calibrate_schemes(schemes, rounds=scheme_rounds, samples=samples,
+                                        threads=threads):
+            marker = '' if result.p99_ms <= target_ms else ' (over budget)'
+            click.echo(f'{result.scheme} rounds={result.rounds}: p50 {result.p50_ms:.1f}ms,'
+                       f' p99 {result.p99_ms:.1f}ms{marker}')
+            results.append(result)
+
+        kwargs = recommend_cryptcontext_kwargs(results, target_ms, list(schemes))
+        if kwargs is None:
+            click.echo(f'No cost value verifies within {target_ms:g}ms at p99.')
+            return
+        click.echo(f'Recommended PASSLIB_CRYPTCONTEXT_KWARGS = {kwargs!r}')
+
+    auth.command('calibrate-hash')(calibrate_hash)
+
     app.auth_manager.cli_group = auth
@@ -1,4 +1,9 @@
-import arrow
+import collections
+import copy
+import inspect
+import threading
+import weakref
+
 import flask
 import flask_login
 import jinja2
@@ -6,15 +11,21 @@ import sqlalchemy as sa
 from blazeutils import tolist
 from keg.db import db
 from keg.signals import db_init_post, init_complete
+from passlib.context import CryptContext
 from webgrid.renderers import render_html_attributes
 
 import keg_auth.cli
 from keg_auth import model
+from keg_auth.libs import REQUEST_CREDENTIALS, get_request_kind
 from keg_auth.libs.authenticators import (
     DefaultPasswordPolicy,
     KegAuthenticator,
     OAuthAuthenticator,
+    RequestLoaderDispatch,
 )
+from keg_auth.libs.caching import TTLCache
+from keg_auth.libs.hashing import HashingService
+from keg_auth.libs.last_login import LastLoginRecorder
 
 DEFAULT_CRYPTO_SCHEMES = ('bcrypt', 'pbkdf2_sha256',)
 
@@ -55,6 +66,8 @@ class AuthManager(object):
         'after-verify-account': '{blueprint}.login',
         'oauth-login': '{blueprint}.oauth-login',
         'oauth-authorize': '{blueprint}.oauth-authorize',
+        'jwks': '{blueprint}.jwks',
+        'jwt-refresh': '{blueprint}.jwt-refresh',
     }
     cli_group_name = 'auth'
 
@@ -77,11 +90,24 @@ class AuthManager(object):
         self.oauth_authenticator_cls = oauth_authenticator
         self.request_loader_cls = tolist(request_loaders or [])
         self.request_loaders = dict()
+        self.request_loader_dispatch = None
+        # instances of loader classes given only to view decorators, by app, then by class.
+        # See resolve_request_loader
+        self._decorator_request_loaders = weakref.WeakKeyDictionary()
+        self._decorator_request_loaders_lock = threading.Lock()
         self.menus = dict()
         self.permissions = tolist(permissions or [])
         self._model_initialized = False
         self._loaders_initialized = False
         self._signal_handlers = []
+        self._hashing_service = None
+        self._credential_cache = None
+        self._last_login_recorder = None
+        # requests that skipped request loaders and cookie fixups, by kind
+        self.fast_path_counts = collections.Counter()
+        self._fast_path_lock = threading.Lock()
+        self._crypt_contexts = weakref.WeakKeyDictionary()
+        self._crypt_contexts_lock = threading.Lock()
 
     def init_app(self, app):
         """Inits KegAuth as a flask extension on the given app."""
@@ -112,10 +138,17 @@ class AuthManager(object):
         app.config.setdefault('KEGAUTH_CRUD_INCLUDE_TITLE', True)
         app.config.setdefault('KEGAUTH_TEMPLATE_TITLE_VAR', 'page_title')
         app.config.setdefault('KEGAUTH_TOKEN_EXPIRE_MINS', 60 * 4)
+        # Accept verification/reset tokens in the format generated by keg-auth versions using
+        # itsdangerous. Turn off once those tokens have expired.
+        app.config.setdefault('KEGAUTH_TOKEN_LEGACY_ENABLED', True)
         app.config.setdefault('KEGAUTH_LOGOUT_CLEAR_SESSION', True)
 
         app.config.setdefault('KEGAUTH_CLI_USER_ARGS', ['email'])
 
+        # On successful login, replace password hashes the crypt context marks as outdated
+        # (see `deprecated` and rounds settings in PASSLIB_CRYPTCONTEXT_KWARGS).
+        app.config.setdefault('KEGAUTH_PASSWORD_REHASH_ON_LOGIN', True)
+
         # HTTP methods to ignore during auth checks. This can be useful for excluding
         # methods like OPTIONS during front-end API requests, for CORS compatibility.
         app.config.setdefault('KEGAUTH_HTTP_METHODS_EXCLUDED', [])
@@ -126,6 +159,110 @@ class AuthManager(object):
         # OAuth profiles
         app.config.setdefault('KEGAUTH_OAUTH_PROFILES', [])
 
+        # OAuth provider discovery documents and JWKS are fetched again once older than
+        # METADATA_TTL seconds. With METADATA_CACHE_DIR, they are also kept on disk there, so new
+        # workers (and other processes on the host) skip the fetches.
+        app.config.setdefault('KEGAUTH_OAUTH_METADATA_TTL', 86400)
+        app.config.setdefault('KEGAUTH_OAUTH_METADATA_CACHE_DIR', None)
+
+        # LdapAuthenticator connections. Up to POOL_SIZE idle connections are kept per server (0
+        # disables pooling). Timeouts are in seconds, for connecting and for each operation. A
+        # server that fails is tried last for FAILURE_BACKOFF seconds, doubling while it keeps
+        # failing. With PARALLEL_BIND, all servers are tried at once, and the first success wins.
+        app.config.setdefault('KEGAUTH_LDAP_POOL_SIZE', 4)
+        app.config.setdefault('KEGAUTH_LDAP_NETWORK_TIMEOUT', 5)
+        app.config.setdefault('KEGAUTH_LDAP_TIMEOUT', 10)
+        app.config.setdefault('KEGAUTH_LDAP_FAILURE_BACKOFF', 30)
+        app.config.setdefault('KEGAUTH_LDAP_PARALLEL_BIND', False)
+
+        # LdapAuthenticator verification cache. A successful bind is remembered for TTL seconds
+        # as a salted PBKDF2 fingerprint of the password (with the given rounds), so repeat
+        # logins skip the directory. Up to SIZE users are kept. A TTL of 0 disables the cache.
+        app.config.setdefault('KEGAUTH_LDAP_CACHE_TTL', 0)
+        app.config.setdefault('KEGAUTH_LDAP_CACHE_SIZE', 1024)
+        app.config.setdefault('KEGAUTH_LDAP_CACHE_ROUNDS', 50000)
+
+        # `auth ldap-sync` reads users and groups from the LDAP directory, bound as BIND_DN (an
+        # anonymous bind if unset). Users match the filter under USER_BASE_DN, and are named by
+        # USERNAME_ATTR. Groups are named by GROUP_NAME_ATTR, and list members (DNs or usernames)
+        # in MEMBER_ATTR. Searches are paged, PAGE_SIZE entries at a time.
+        app.config.setdefault('KEGAUTH_LDAP_SYNC_BIND_DN', None)
+        app.config.setdefault('KEGAUTH_LDAP_SYNC_BIND_PASSWORD', None)
+        app.config.setdefault('KEGAUTH_LDAP_SYNC_USER_BASE_DN', None)
+        app.config.setdefault('KEGAUTH_LDAP_SYNC_USER_FILTER', '(objectClass=person)')
+        app.config.setdefault('KEGAUTH_LDAP_SYNC_USERNAME_ATTR', 'uid')
+        app.config.setdefault('KEGAUTH_LDAP_SYNC_GROUP_BASE_DN', None)
+        app.config.setdefault('KEGAUTH_LDAP_SYNC_GROUP_FILTER', '(objectClass=groupOfNames)')
+        app.config.setdefault('KEGAUTH_LDAP_SYNC_GROUP_NAME_ATTR', 'cn')
+        app.config.setdefault('KEGAUTH_LDAP_SYNC_MEMBER_ATTR', 'member')
+        app.config.setdefault('KEGAUTH_LDAP_SYNC_PAGE_SIZE', 500)
+
+        # API tokens. The pepper keys the digest of API key secrets, and defaults to SECRET_KEY.
+        # Changing it invalidates all issued API keys. Legacy (email/token) API tokens need a
+        # password hash verify per request, disable them once clients have moved to API keys.
+        app.config.setdefault('KEGAUTH_API_TOKEN_PEPPER', None)
+        app.config.setdefault('KEGAUTH_API_TOKEN_LEGACY_ENABLED', True)
+
+        # Password hashing pool. When enabled, password hashing and verification run in a
+        # bounded worker pool instead of on the request thread.
+        # - Size: number of workers.
+        # - Type: "thread" or "process".
+        # - Queue limit: number of hashing jobs that may wait for a worker. Once the pool and
+        #   queue are full, further requests are rejected with a 503.
+        # - Timeout: seconds to wait for a hashing job, None to wait indefinitely.
+        app.config.setdefault('KEGAUTH_HASHING_POOL_ENABLED', False)
+        app.config.setdefault('KEGAUTH_HASHING_POOL_SIZE', 4)
+        app.config.setdefault('KEGAUTH_HASHING_POOL_TYPE', 'thread')
+        app.config.setdefault('KEGAUTH_HASHING_QUEUE_LIMIT', 16)
+        app.config.setdefault('KEGAUTH_HASHING_TIMEOUT', 10)
+
+        # Verified-credential cache. Maps a keyed digest of an API token that verified to its
+        # user, so repeat requests skip the password hash. Entries are checked against the user's
+        # current token and session key on each hit. A TTL of 0 disables the cache.
+        app.config.setdefault('KEGAUTH_CREDENTIAL_CACHE_TTL', 60)
+        app.config.setdefault('KEGAUTH_CREDENTIAL_CACHE_SIZE', 1024)
+
+        # Last login times. Request loaders (JWT, API tokens) log the user in on every request,
+        # their logins are only written once the stored time is INTERVAL seconds old (0 writes
+        # every time). With DEFERRED, those writes are queued and written in batches every
+        # FLUSH_INTERVAL seconds by a background thread. Interactive logins are always written,
+        # as they invalidate outstanding password reset and verification tokens.
+        app.config.setdefault('KEGAUTH_LAST_LOGIN_INTERVAL', 60)
+        app.config.setdefault('KEGAUTH_LAST_LOGIN_DEFERRED', False)
+        app.config.setdefault('KEGAUTH_LAST_LOGIN_FLUSH_INTERVAL', 10)
+
+        # JwtRequestLoader user cache. Users loaded for a token identity are reused for up to TTL
+        # seconds without a database query. Session key rotation in this process takes effect
+        # immediately, other changes (e.g. disabling a user elsewhere) within TTL seconds. A TTL of
+        # 0 disables the cache.
+        app.config.setdefault('KEGAUTH_JWT_USER_CACHE_TTL', 0)
+        app.config.setdefault('KEGAUTH_JWT_USER_CACHE_SIZE', 1024)
+
+        # Permission snapshots in JWTs from JwtRequestLoader.create_access_token. None, "list" of
+        # tokens, or "bitmask" over the app's defined permissions. Tokens carrying a snapshot
+        # expire after the given seconds, limiting how long a snapshot may be relied on.
+        app.config.setdefault('KEGAUTH_JWT_PERMISSIONS_CLAIM', None)
+        app.config.setdefault('KEGAUTH_JWT_PERMISSIONS_EXPIRES', 300)
+
+        # JwtRequestLoader revocations. Revoked token IDs are held in memory until the token
+        # expires, behind a Bloom filter sized for CAPACITY revocations at the given false positive
+        # rate (false positives only cost a set lookup). With a revoked_token entity registered,
+        # revocations from other processes are loaded every SYNC_INTERVAL seconds.
+        app.config.setdefault('KEGAUTH_JWT_REVOCATION_CAPACITY', 100000)
+        app.config.setdefault('KEGAUTH_JWT_REVOCATION_ERROR_RATE', 0.001)
+        app.config.setdefault('KEGAUTH_JWT_REVOCATION_SYNC_INTERVAL', 30)
+
+        # Asymmetric JWT signing. PEM encoded RSA (RS256) or Ed25519 (EdDSA) keys, the current
+        # signing key first. Keys after the first are only used to verify tokens, and may be public
+        # keys, so tokens signed before a rotation stay valid. All are published as a JWKS
+        # document, which clients may cache for MAX_AGE seconds. None signs with the secret key.
+        app.config.setdefault('KEGAUTH_JWT_SIGNING_KEYS', None)
+        app.config.setdefault('KEGAUTH_JWT_JWKS_MAX_AGE', 300)
+
+        # JwtRequestLoader refresh tokens (requires a refresh_token entity). Seconds a refresh
+        # token stays valid, each exchange issuing a new one.
+        app.config.setdefault('KEGAUTH_JWT_REFRESH_EXPIRES', 30 * 24 * 60 * 60)
+
         # Attempt lockout parameters.
         # - Enabled: default True, turns on attempt limits and requires the attempt entity.
         # - Limit: maximum number of attempts within the timespan.
@@ -149,6 +286,18 @@ class AuthManager(object):
         # app.config.setdefault('KEGAUTH_RESET_ATTEMPT_TIMESPAN', 86400)  # 24 hours
         # app.config.setdefault('KEGAUTH_RESET_ATTEMPT_LOCKOUT', 86400)  # 24 hours
 
+        # Proof-of-work login challenge. Once failed login attempts reach the threshold, the
+        # login form must solve a signed challenge before the password is checked.
+        # - Threshold: number of failed attempts in the attempt timespan before challenging.
+        # - Base difficulty: leading zero bits required at the threshold, one more bit is
+        #   required for each further failure up to the max difficulty.
+        # - TTL: number of seconds a challenge is valid for.
+        app.config.setdefault('KEGAUTH_LOGIN_POW_ENABLED', False)
+        app.config.setdefault('KEGAUTH_LOGIN_POW_THRESHOLD', 3)
+        app.config.setdefault('KEGAUTH_LOGIN_POW_BASE_DIFFICULTY', 14)
+        app.config.setdefault('KEGAUTH_LOGIN_POW_MAX_DIFFICULTY', 22)
+        app.config.setdefault('KEGAUTH_LOGIN_POW_TTL', 300)  # 5 minutes
+
     def init_cli(self, app):
         """Add a CLI group for auth."""
         keg_auth.cli.add_cli_to_app(app, self.cli_group_name,
@@ -201,6 +350,8 @@ class AuthManager(object):
 
         for loader_cls in self.request_loader_cls:
             self.request_loaders[loader_cls.get_identifier()] = loader_cls(app)
+        self.request_loader_dispatch = RequestLoaderDispatch(
+            self.request_loaders.values(), app.config)
 
         self._loaders_initialized = True
 
@@ -292,6 +443,10 @@ class AuthManager(object):
             for endpoint_key in self.endpoints.keys():
                 endpoint = self.endpoint(endpoint_key)
                 view_obj = app.view_functions.get(endpoint)
+                if getattr(getattr(view_obj, 'view_class', None), '_csrf_custom_handling', False):
+                    # views that do not use the session, e.g. token APIs
+                    app.extensions['csrf'].exempt(f"{view_obj.__module__}.{view_obj.__name__}")
+                    continue
                 if (
                     not hasattr(view_obj, 'view_class')
                     or not hasattr(view_obj.view_class, 'auth_manager_key')
@@ -402,10 +557,154 @@ class AuthManager(object):
             db.session.commit()
         return user
 
+    def import_users(self, records, batch_size=1000, workers=None, mail_enabled=False,
+                     progress=None):
+        """Create users in bulk, see :class:`keg_auth.libs.user_import.UserImporter`.
+
+        :param records: ``(line number, record)`` pairs, e.g. from
+            :func:`keg_auth.libs.user_import.read_user_records`
+        :param workers: processes for password hashing, None for one per CPU, 0 for none
+        :param mail_enabled: send new users the account verification mail
+        :param progress: callable receiving the running report after each batch
+        :return: :class:`keg_auth.libs.user_import.UserImportReport`
+        """
+        from keg_auth.libs.user_import import UserImporter
+
+        registry = self.entity_registry
+        importer = UserImporter(
+            registry.user_cls,
+            group_cls=registry.group_cls if registry.is_registered('group') else None,
+            bundle_cls=registry.bundle_cls if registry.is_registered('bundle') else None,
+            batch_size=batch_size,
+            workers=workers,
+            mail_manager=self.mail_manager if mail_enabled else None,
+            is_domain_excluded=self.login_authenticator.is_domain_excluded,
+        )
+        return importer.run(records, progress=progress)
+
+    def get_crypt_context(self, **column_kwargs):
+        """Return the app's CryptContext for password and token columns.
+
+        One context is compiled per app (and per set of column-specific kwargs), and shared by
+        every ``KAPasswordType`` column. When ``PASSLIB_CRYPTCONTEXT_KWARGS`` changes, the
+        existing contexts are reloaded in place, so schemes can be swapped without a restart, and
+        password values already loaded (which hold a weak reference to them) follow the change.
+        """
+        app = flask.current_app._get_current_object()
+        config = app.config['PASSLIB_CRYPTCONTEXT_KWARGS']
+        key = tuple(sorted((name, repr(value)) for name, value in column_kwargs.items()))
+
+        cache = self._crypt_contexts.get(app)
+        if cache is not None and cache.config == config and key in cache.contexts:
+            return cache.contexts[key][0]
+
+        with self._crypt_contexts_lock:
+            cache = self._crypt_contexts.setdefault(app, _CryptContextCache())
+            if cache.config != config:
+                cache.config = copy.deepcopy(config)
+                for context, context_kwargs in cache.contexts.values():
+                    context.load(model._create_cryptcontext_kwargs(**context_kwargs))
+            if key not in cache.contexts:
+                context = CryptContext(**model._create_cryptcontext_kwargs(**column_kwargs))
+                cache.contexts[key] = (context, column_kwargs)
+            return cache.contexts[key][0]
+
+    @property
+    def hashing_service(self):
+        """Password hashing pool, or None if hashing should run inline."""
+        config = flask.current_app.config
+        if not config.get('KEGAUTH_HASHING_POOL_ENABLED'):
+            return None
+
+        if self._hashing_service is None:
+            self._hashing_service = HashingService(
+                max_workers=config.get('KEGAUTH_HASHING_POOL_SIZE'),
+                executor_type=config.get('KEGAUTH_HASHING_POOL_TYPE'),
+                queue_limit=config.get('KEGAUTH_HASHING_QUEUE_LIMIT'),
+                timeout=config.get('KEGAUTH_HASHING_TIMEOUT'),
+            )
+        return self._hashing_service
+
+    @property
+    def credential_cache(self):
+        """Cache of verified API credentials, or None if disabled."""
+        config = flask.current_app.config
+        if not config.get('KEGAUTH_CREDENTIAL_CACHE_TTL'):
+            return None
+
+        if self._credential_cache is None:
+            self._credential_cache = TTLCache(
+                maxsize=config.get('KEGAUTH_CREDENTIAL_CACHE_SIZE'),
+                ttl=config.get('KEGAUTH_CREDENTIAL_CACHE_TTL'),
+            )
+        return self._credential_cache
+
+    @property
+    def last_login_recorder(self):
+        """Writes users' last login times. Rebuilt if the configuration changes."""
+        config = flask.current_app.config
+        settings = (
+            config.get('KEGAUTH_LAST_LOGIN_INTERVAL'),
+            config.get('KEGAUTH_LAST_LOGIN_DEFERRED'),
+            config.get('KEGAUTH_LAST_LOGIN_FLUSH_INTERVAL'),
+        )
+        if self._last_login_recorder is None or self._last_login_recorder[0] != settings:
+            if self._last_login_recorder is not None:
+                self._last_login_recorder[1].stop()
+            interval, deferred, flush_interval = settings
+            self._last_login_recorder = (settings, LastLoginRecorder(
+                flask.current_app._get_current_object(),
+                self.entity_registry.user_cls,
+                interval=interval,
+                deferred=deferred,
+                flush_interval=flush_interval,
+            ))
+        return self._last_login_recorder[1]
+
+    def count_fast_path(self, kind):
+        with self._fast_path_lock:
+            self.fast_path_counts[kind] += 1
+
+    def invalidate_session_key(self, session_key):
+        """Drop anything request loaders have cached for a user's (outgoing) session key."""
+        loaders = list(self.request_loaders.values())
+        for app_loaders in list(self._decorator_request_loaders.values()):
+            loaders += app_loaders.values()
+        for loader in loaders:
+            invalidate = getattr(loader, 'invalidate_session_key', None)
+            if invalidate is not None:
+                invalidate(session_key)
+
     def get_request_loader(self, identifier):
         """Returns a registered request loader, keyed by its identifier."""
         return self.request_loaders.get(identifier)
 
+    def resolve_request_loader(self, loader):
+        """Returns the loader instance for a request loader class or instance, as given to
+        ``requires_user(request_loaders=...)``.
+
+        A registered loader class resolves to the registered instance. Other classes are
+        created for the app on first use and kept, since creating a loader may set up the app
+        (e.g. ``JwtRequestLoader`` registers flask-jwt-extended callbacks).
+        """
+        if not inspect.isclass(loader):
+            return loader
+
+        registered = self.request_loaders.get(loader.get_identifier())
+        if type(registered) is loader:
+            return registered
+
+        # the manager may be shared by several apps, and a loader is set up for one of them
+        app = flask.current_app._get_current_object()
+        instance = self._decorator_request_loaders.get(app, {}).get(loader)
+        if instance is None:
+            with self._decorator_request_loaders_lock:
+                app_loaders = self._decorator_request_loaders.setdefault(app, {})
+                instance = app_loaders.get(loader)
+                if instance is None:
+                    instance = app_loaders[loader] = loader(app)
+        return instance
+
     def resend_verification_email(self, user_id):
         """Generate a fresh token and send the account verification email."""
         user = self.user_by_id(user_id)
@@ -416,6 +715,13 @@ class AuthManager(object):
         self.mail_manager.send_new_user(user)
 
 
+class _CryptContextCache(object):
+    """An app's compiled crypt contexts, and the config they were compiled from."""
+    def __init__(self):
+        self.config = None
+        self.contexts = {}
+
+
 # ensure that any manager-attached menus are reset for auth requirements on login/logout
 def refresh_session_menus(app, user):
     for menu in app.auth_manager.menus.values():
@@ -423,8 +729,9 @@ def refresh_session_menus(app, user):
 
 
 def update_last_login(app, user):
-    user.last_login_utc = arrow.utcnow()
-    db.session.commit()
+    # request loaders log users in on each request, those writes are throttled
+    interactive = not flask.g.get('_kegauth_request_loader_login', False)
+    app.auth_manager.last_login_recorder.record(user, interactive=interactive)
 
 
 def on_login(app, user):
@@ -438,6 +745,10 @@ def clear_session(app, user):
 
 
 def fix_session_cookies(app, **extra):
+    if hasattr(app, 'auth_manager') and get_request_kind() != REQUEST_CREDENTIALS:
+        # static files, and requests without a session cookie
+        return
+
     cookie_values = flask.request.cookies.getlist(
         app.config.get('SESSION_COOKIE_NAME')
     )
@@ -40,6 +40,11 @@ def login_form():
             validators.DataRequired(),
         ])
 
+    if flask.current_app.config.get('KEGAUTH_LOGIN_POW_ENABLED'):
+        # proof-of-work challenge issued by the view, solved by script on the login page
+        Login.pow_challenge = HiddenField()
+        Login.pow_solution = HiddenField()
+
     return Login
 
 
@@ -2,6 +2,64 @@ import flask
 import flask_login
 
 
+# request kinds, see get_request_kind
+REQUEST_STATIC = 'static'
+REQUEST_ANONYMOUS = 'anonymous'
+REQUEST_CREDENTIALS = 'credentials'
+
+
+def is_static_endpoint(endpoint):
+    return bool(endpoint) and (endpoint == 'static' or endpoint.endswith('.static'))
+
+
+def get_request_loaders():
+    """The registered request loaders that may find a user in the current request, once per
+    request. See ``RequestLoaderDispatch``."""
+    environ = flask.request.environ
+    loaders = environ.get('keg_auth.request_loaders')
+    if loaders is None:
+        auth_manager = flask.current_app.auth_manager
+        if auth_manager.request_loader_dispatch is None:
+            loaders = list(auth_manager.request_loaders.values())
+        else:
+            loaders = auth_manager.request_loader_dispatch.get_loaders(flask.request)
+        environ['keg_auth.request_loaders'] = loaders
+    return loaders
+
+
+def get_request_kind():
+    """Classify the current request for auth, once per request.
+
+    - ``REQUEST_STATIC``: a static file, no auth processing is needed
+    - ``REQUEST_ANONYMOUS``: no session cookie, and nothing any registered request loader reads
+      (e.g. an auth header), so there is no user to load
+    - ``REQUEST_CREDENTIALS``: anything else
+
+    Requests taking the fast path (static or anonymous) are counted in
+    ``auth_manager.fast_path_counts``.
+    """
+    environ = flask.request.environ
+    kind = environ.get('keg_auth.request_kind')
+    if kind is not None:
+        return kind
+
+    app = flask.current_app
+    if is_static_endpoint(flask.request.endpoint):
+        kind = REQUEST_STATIC
+    elif (
+        app.config.get('SESSION_COOKIE_NAME') not in flask.request.cookies
+        and not get_request_loaders()
+    ):
+        kind = REQUEST_ANONYMOUS
+    else:
+        kind = REQUEST_CREDENTIALS
+
+    if kind != REQUEST_CREDENTIALS:
+        app.auth_manager.count_fast_path(kind)
+    environ['keg_auth.request_kind'] = kind
+    return kind
+
+
 def get_current_user():
     """Helper to grab the authenticated user from the session.
 
@@ -12,9 +70,13 @@ def get_current_user():
     if flask_login.current_user and flask_login.current_user.is_authenticated:
         return flask_login.current_user
 
+    if get_request_kind() != REQUEST_CREDENTIALS:
+        # nothing in the request for a loader to find
+        return None
+
     # no user in session right now, so we need to run request loaders to see if any match
     user = None
-    for loader in flask.current_app.auth_manager.request_loaders.values():
+    for loader in get_request_loaders():
         user = loader.get_authenticated_user()
         if user:
             break
@@ -1,3 +1,7 @@
+import collections
+import contextlib
+import hashlib
+import time
 from datetime import timedelta
 from urllib.parse import urljoin, urlparse
 
@@ -7,6 +11,7 @@ import flask_login
 import passlib
 import sqlalchemy as sa
 import string
+import threading
 import typing
 import wtforms
 from blazeutils import tolist
@@ -16,7 +21,16 @@ from sqlalchemy_utils import EmailType
 from keg_auth import forms
 from keg_auth.extensions import flash, lazy_gettext as _
 from keg_auth.libs import get_domain_from_email
-from keg_auth.model import get_username_key, get_username
+from keg_auth.libs.caching import JSONFileCache, TTLCache, restore_entity, snapshot_entity
+from keg_auth.libs.challenge import issue_pow_challenge, verify_pow_solution
+from keg_auth.libs.hashing import HashingServiceBusy
+from keg_auth.libs.ldap_utils import (
+    LdapServerPool,
+    check_credential_fingerprint,
+    credential_fingerprint,
+)
+from keg_auth.libs.revocation import RevocationStore
+from keg_auth.model import KAPassword, get_username_key, get_username
 from keg_auth.model.entity_registry import RegistryError
 
 try:
@@ -26,11 +40,7 @@ except ImportError:
 
 try:
     import flask_jwt_extended
-except ImportError:
-    pass  # pragma: no cover
-
-try:
-    import ldap
+    from keg_auth.libs.jwks import load_signing_keys
 except ImportError:
     pass  # pragma: no cover
 
@@ -53,6 +63,37 @@ class AttemptBlocked(Exception):
     pass
 
 
+class CredentialLocation(typing.NamedTuple):
+    """Where a request loader reads credentials from.
+
+    :param kind: "header", "cookie", "query_string", or "json" (a JSON body)
+    :param name: header, cookie, or argument name. Unused for "json".
+    :param scheme: for headers, the scheme the value starts with (e.g. "Bearer"), if any
+    """
+    kind: str
+    name: str = None
+    scheme: str = None
+
+    def matches(self, request):
+        if self.kind == 'header':
+            value = request.headers.get(self.name)
+            if value is None:
+                return False
+            return not self.scheme or header_scheme(value) == self.scheme.lower()
+        if self.kind == 'cookie':
+            return self.name in request.cookies
+        if self.kind == 'query_string':
+            return self.name in request.args
+        if self.kind == 'json':
+            return request.is_json
+        return True
+
+
+def header_scheme(value):
+    """The lowercased scheme of an auth header value, e.g. "bearer" for "Bearer abc"."""
+    return value.split(None, 1)[0].lower() if value.strip() else ''
+
+
 class RequestLoader(object):
     """ Generic loader interface for determining if a user should be logged in"""
 
@@ -63,6 +104,89 @@ class RequestLoader(object):
     def get_identifier(cls):
         return cls.__name__.lower().replace('requestloader', '')
 
+    @classmethod
+    def get_credential_locations(cls, config):
+        """Where this loader reads credentials, as a list of ``CredentialLocation``.
+
+        Requests are only given to loaders whose credentials they carry. Defaults to None, for
+        loaders that do not say, which run for every request."""
+        return None
+
+    @classmethod
+    def may_authenticate(cls, request):
+        """Whether the request carries anything this loader reads."""
+        locations = cls.get_credential_locations(flask.current_app.config)
+        return locations is None or any(location.matches(request) for location in locations)
+
+    @staticmethod
+    def login_user(user):
+        """Log the user in for this request. Unlike an interactive login, the last login time
+        is only written periodically (see ``KEGAUTH_LAST_LOGIN_INTERVAL``)."""
+        flask.g._kegauth_request_loader_login = True
+        try:
+            flask_login.login_user(user)
+        finally:
+            flask.g._kegauth_request_loader_login = False
+
+
+class RequestLoaderDispatch(object):
+    """Picks the request loaders to run for a request, by the credentials it carries.
+
+    Built once from the loaders' ``get_credential_locations``, so a request is only parsed by
+    loaders that read what it sent, e.g. an ``X-Auth-Token`` request skips the JWT loader.
+    Loaders that do not declare locations run for every request. Matching loaders keep their
+    registration order.
+    """
+    def __init__(self, loaders, config):
+        self.loaders = list(loaders)
+        self.always = set()
+        # header name -> [(lowercased scheme or None, loader index)]
+        self.headers = collections.defaultdict(list)
+        self.cookies = collections.defaultdict(list)
+        self.query_string = collections.defaultdict(list)
+        self.json = set()
+
+        for index, loader in enumerate(self.loaders):
+            locations = loader.get_credential_locations(config)
+            if locations is None:
+                self.always.add(index)
+                continue
+            for location in locations:
+                if location.kind == 'header':
+                    scheme = location.scheme.lower() if location.scheme else None
+                    self.headers[location.name].append((scheme, index))
+                elif location.kind == 'cookie':
+                    self.cookies[location.name].append(index)
+                elif location.kind == 'query_string':
+                    self.query_string[location.name].append(index)
+                elif location.kind == 'json':
+                    self.json.add(index)
+                else:
+                    self.always.add(index)
+
+    def matching_indexes(self, request):
+        matched = set(self.always)
+        for name, entries in self.headers.items():
+            value = request.headers.get(name)
+            if value is None:
+                continue
+            for scheme, index in entries:
+                if scheme is None or header_scheme(value) == scheme:
+                    matched.add(index)
+        for name in self.cookies.keys() & request.cookies.keys():
+            matched.update(self.cookies[name])
+        for name in self.query_string.keys() & request.args.keys():
+            matched.update(self.query_string[name])
+        if self.json and request.is_json:
+            matched.update(self.json)
+        return matched
+
+    def get_loaders(self, request):
+        """Loaders that may find a user in the request, in registration order."""
+        if len(self.always) == len(self.loaders):
+            return self.loaders
+        return [self.loaders[index] for index in sorted(self.matching_indexes(request))]
+
 
 class LoginAuthenticator(object):
     """ Manages verification of users as well as relevant view-layer logic
@@ -244,6 +368,9 @@ class LoginResponderMixin(UserResponderMixin):
 class FormResponderMixin(object):
     """ Wrap form usage for auth responders, contains GET and POST handlers"""
     flash_form_error = _('The form has errors, please see below.'), 'error'
+    flash_hashing_busy = _(
+        'The server is too busy to process this request. Please try again shortly.'
+    ), 'error'
     form_cls = None
     page_title = None
 
@@ -251,6 +378,10 @@ class FormResponderMixin(object):
         if self.flash_form_error:
             flash(*self.flash_form_error)
 
+    def on_hashing_busy(self):
+        if self.flash_hashing_busy:
+            flash(*self.flash_hashing_busy)
+
     def on_form_valid(self, form):
         raise NotImplementedError  # pragma: no cover
 
@@ -467,7 +598,11 @@ class PasswordSetterResponderBase(FormResponderMixin, ViewResponder):
 
     def on_form_valid(self, form):
         new_password = form.password.data
-        self.user.change_password(self.token, new_password)
+        try:
+            self.user.change_password(self.token, new_password)
+        except HashingServiceBusy:
+            self.on_hashing_busy()
+            return
         self.flash_and_redirect(self.flash_success, self.on_success_endpoint)
 
     def on_invalid_token(self):
@@ -488,14 +623,23 @@ class ResetPasswordViewResponder(AttemptLimitMixin, PasswordSetterResponderBase)
 
     def on_form_valid(self, form):
         try:
-            self.check_blocking(get_username(self.user), success=True)
+            attempt = self.check_blocking(get_username(self.user))
         except AttemptBlocked:
             # If we are rate-limiting this attempt, we don't want to proceed with validation.
             # Validating may still allow brute forcing by measuring response time.
             return
 
         new_password = form.password.data
-        self.user.change_password(self.token, new_password)
+        try:
+            self.user.change_password(self.token, new_password, _commit=False)
+        except HashingServiceBusy:
+            self.on_hashing_busy()
+            return
+
+        # the attempt only counts as a success once the new password is set
+        if attempt:
+            attempt.success = True
+        db.session.commit()
         self.flash_and_redirect(self.flash_success, self.on_success_endpoint)
 
     def get_flash_attempts_limit_reached(self):
@@ -541,12 +685,73 @@ class PasswordFormViewResponder(AttemptLimitMixin, LoginResponderMixin,
     template_name = 'keg-auth/login.html'
     page_title = _('Log In')
     flash_invalid_password = _('Invalid password.'), 'error'
+    flash_pow_failed = _('Login challenge not completed. Please try again.'), 'error'
+    flash_pow_required = _('Please log in again to complete the login challenge.'), 'error'
     _csrf_custom_handling = True
 
     @property
     def form_cls(self):
         return forms.login_form()
 
+    def get_pow_difficulty(self, username):
+        """Number of leading zero bits a proof-of-work solution needs for this login ID.
+
+        Zero when the challenge is disabled or failures have not reached the threshold. Past the
+        threshold, each further failure adds a bit, doubling the work for the client.
+        """
+        config = flask.current_app.config
+        if not config.get('KEGAUTH_LOGIN_POW_ENABLED') or not username:
+            return 0
+        if not self.should_limit_attempts():
+            return 0
+
+        failures = self.get_limiting_attempt_count(arrow.utcnow(), username)
+        threshold = config.get('KEGAUTH_LOGIN_POW_THRESHOLD')
+        if failures < threshold:
+            return 0
+        return min(
+            config.get('KEGAUTH_LOGIN_POW_BASE_DIFFICULTY') + failures - threshold,
+            config.get('KEGAUTH_LOGIN_POW_MAX_DIFFICULTY'),
+        )
+
+    def get_pow_binding(self, username):
+        """Ties a challenge to the last failed attempt, so each solution is good for one try."""
+        last_limiting_attempt = self.get_last_limiting_attempt(username)
+        return last_limiting_attempt.id if last_limiting_attempt else None
+
+    def verify_pow(self, form, difficulty):
+        username = form.login_id.data
+        return verify_pow_solution(
+            form.pow_challenge.data,
+            form.pow_solution.data,
+            username,
+            difficulty,
+            self.get_pow_binding(username),
+        )
+
+    def on_pow_failed(self):
+        if self.flash_pow_failed:
+            flash(*self.flash_pow_failed)
+
+    def on_pow_required(self):
+        if self.flash_pow_required:
+            flash(*self.flash_pow_required)
+
+    def assign_template_vars(self, form):
+        super().assign_template_vars(form)
+
+        if not hasattr(form, 'pow_challenge'):
+            return
+
+        # issue a fresh challenge for the next attempt, based on the attempts logged so far
+        username = form.login_id.data
+        difficulty = self.get_pow_difficulty(username)
+        form.pow_challenge.data = issue_pow_challenge(
+            username, difficulty, self.get_pow_binding(username)
+        ) if difficulty else ''
+        form.pow_solution.data = ''
+        self.assign('pow_difficulty', difficulty)
+
     def on_form_error(self, form):
         super().on_form_error(form)
         username = form.login_id.data
@@ -566,6 +771,20 @@ class PasswordFormViewResponder(AttemptLimitMixin, LoginResponderMixin,
 
     def on_form_valid(self, form):
         username = form.login_id.data
+        # the challenge has to be checked against the attempts logged before this one
+        pow_difficulty = self.get_pow_difficulty(username)
+        if pow_difficulty and not form.pow_challenge.data:
+            # No challenge was served, e.g. the form came from a fresh GET, which does not know
+            # the login ID. Send one back without counting this as a failed attempt. The
+            # password is not checked.
+            self.on_pow_required()
+            return
+        pow_valid = not pow_difficulty or self.verify_pow(form, pow_difficulty)
+
+        # The attempt is committed as a failure before the password is checked, so it counts
+        # toward the limit even if the request never gets past the hash. A successful login
+        # then marks it in a second, short transaction, along with any password rehash and the
+        # last login time.
         try:
             attempt = self.check_blocking(username)
         except AttemptBlocked:
@@ -575,6 +794,12 @@ class PasswordFormViewResponder(AttemptLimitMixin, LoginResponderMixin,
             # an expensive operation
             return
 
+        if not pow_valid:
+            # The attempt stays logged as a failure, and the password is never checked. The
+            # client pays for the challenge, not the server for the hash.
+            self.on_pow_failed()
+            return
+
         try:
             # We want to know if the login attempt was successful so we'll try
             # to verify the user. If the user is verified but the attempt is blocked,
@@ -585,16 +810,26 @@ class PasswordFormViewResponder(AttemptLimitMixin, LoginResponderMixin,
             )
 
             if attempt:
-                self.update_attempt(attempt, success=True)
+                attempt.success = True
 
             # User is active and password is verified
-            return self.on_success(user)
+            resp = self.on_success(user)
+            # in case login did not commit (e.g. customized on_success)
+            db.session.commit()
+            return resp
         except UserNotFound:
             self.on_invalid_user(form.login_id.data)
         except UserInactive as exc:
             self.on_inactive_user(exc.user)
         except UserInvalidAuth as exc:
             self.on_invalid_password(exc.user)
+        except HashingServiceBusy:
+            # The password was never checked, so the attempt must not count toward a lockout.
+            # Otherwise, a full pool would lock out users who had the right password.
+            if attempt:
+                db.session.delete(attempt)
+                db.session.commit()
+            self.on_hashing_busy()
 
     def on_invalid_password(self, user):
         if self.flash_invalid_password:
@@ -661,7 +896,8 @@ class OAuthLoginViewResponder(ViewResponder):
         redirect_uri = flask.current_app.auth_manager.url_for(
             'oauth-authorize', name=name, _external=True
         )
-        return client.authorize_redirect(redirect_uri)
+        with self.parent.provider_metadata(client):
+            return client.authorize_redirect(redirect_uri)
 
     def head(self, *args, **kwargs):
         return flask.abort(405, valid_methods=['GET'])
@@ -683,10 +919,11 @@ class OAuthAuthorizeViewResponder(LoginResponderMixin, ViewResponder):
             return flask.abort(404)
 
         oauth_profile = self.parent.select_oauth_profile(name)
-        token = client.authorize_access_token()
-        userinfo = token.get('userinfo')
-        if not userinfo:
-            userinfo = client.userinfo()
+        with self.parent.provider_metadata(client):
+            token = client.authorize_access_token()
+            userinfo = token.get('userinfo')
+            if not userinfo:
+                userinfo = client.userinfo()
 
         login_id = userinfo.get(oauth_profile['id_field'])
 
@@ -905,13 +1142,28 @@ class KegAuthenticator(PasswordAuthenticatorMixin, LoginAuthenticator):
             domain_exclusions.extend(tolist(profile.get('domain_filter', [])))
         self.domain_exclusions = domain_exclusions
 
+    @property
+    def domain_exclusions(self):
+        return self._domain_exclusions
+
+    @domain_exclusions.setter
+    def domain_exclusions(self, domains):
+        # checked on every login and user form, so keep a set for lookups
+        self._domain_exclusions = list(domains)
+        self._domain_exclusion_set = frozenset(self._domain_exclusions)
+
+    @domain_exclusions.deleter
+    def domain_exclusions(self):
+        del self._domain_exclusions
+        self._domain_exclusion_set = frozenset()
+
     def is_domain_excluded(self, login_id):
         """Domains configured for OAuth access are excluded from the password authenticator.
 
         Any operations not using ``verify_user`` should check for exclusion."""
-        if self.domain_exclusions:
+        if self._domain_exclusion_set:
             domain = get_domain_from_email(login_id)
-            if domain and domain in self.domain_exclusions:
+            if domain and domain in self._domain_exclusion_set:
                 return True
         return False
 
@@ -936,11 +1188,23 @@ class KegAuthenticator(PasswordAuthenticatorMixin, LoginAuthenticator):
         return user
 
     def verify_password(self, user, password):
+        verify_and_update = getattr(user.password, 'verify_and_update', None)
         try:
-            return user.password == password
+            if (
+                verify_and_update is None
+                or not flask.current_app.config.get('KEGAUTH_PASSWORD_REHASH_ON_LOGIN')
+            ):
+                return user.password == password
+            valid, new_hash = verify_and_update(password)
         except passlib.exc.UnknownHashError:
             return False
 
+        if valid and new_hash:
+            # The crypt context marked the stored hash as outdated. Replace it, but leave the
+            # commit to the login itself, which persists it along with last_login_utc.
+            user.password = KAPassword(new_hash)
+        return valid
+
 
 class OAuthAuthenticator(LoginAuthenticator):
     """ Uses OAuth authentication via authlib, validates user info against keg-auth db"""
@@ -957,6 +1221,10 @@ class OAuthAuthenticator(LoginAuthenticator):
         from authlib.integrations.flask_client import OAuth
 
         app.auth_manager.oauth = oauth = OAuth(app)
+        # profiles are looked up by name on each login and authorize request
+        self.profiles = {}
+        self.profile_domains = {}
+        self.metadata_urls = {}
         for profile in app.config.get('KEGAUTH_OAUTH_PROFILES'):
             expected_keys = 'domain_filter', 'id_field', 'oauth_client_kwargs'
             if len(set(expected_keys) & set(profile.keys())) != len(expected_keys):
@@ -964,15 +1232,90 @@ class OAuthAuthenticator(LoginAuthenticator):
                 raise Exception(
                     f'OAuth profile is missing keys, expects {expected_keys_display}'
                 )
-            oauth.register(**profile['oauth_client_kwargs'])
+            client_kwargs = dict(profile['oauth_client_kwargs'])
+            name = client_kwargs.get('name')
+            self.profiles.setdefault(name, profile)
+            self.profile_domains.setdefault(
+                name, frozenset(tolist(profile['domain_filter'] or [])))
+            # discovery is left to load_provider_metadata, so it can be cached and expired
+            self.metadata_urls.setdefault(name, client_kwargs.pop('server_metadata_url', None))
+            oauth.register(**client_kwargs)
+
+        cache_dir = app.config.get('KEGAUTH_OAUTH_METADATA_CACHE_DIR')
+        self.metadata_ttl = app.config.get('KEGAUTH_OAUTH_METADATA_TTL')
+        self.metadata_cache = JSONFileCache(cache_dir, ttl=self.metadata_ttl) if cache_dir else None
+        # client name -> (metadata configured on the client, time its discovery document loaded)
+        self._metadata_loaded = {}
+        self._metadata_stored = {}
+        if self.metadata_cache is not None:
+            # let a new worker serve its first OAuth requests without discovery fetches
+            for name in self.profiles:
+                self.load_provider_metadata(oauth.create_client(name), fetch=False)
 
     def select_oauth_profile(self, name):
-        return next(
-            filter(
-                lambda profile: profile['oauth_client_kwargs']['name'] == name,
-                flask.current_app.config.get('KEGAUTH_OAUTH_PROFILES', [])
-            ), None
-        )
+        return self.profiles.get(name)
+
+    def fetch_provider_metadata(self, client, url):
+        """Fetch a provider's discovery document with the client's own HTTP session."""
+        with client.client_cls(**client.client_kwargs) as session:
+            resp = session.request('GET', url, withhold_token=True)
+            resp.raise_for_status()
+            return resp.json()
+
+    def load_provider_metadata(self, client, fetch=True):
+        """Fill in a client's discovery document once the copy it has is older than the TTL,
+        from the disk cache when it has a fresh one. Its JWKS is dropped along with it, for
+        authlib to fetch again."""
+        url = self.metadata_urls.get(client.name)
+        if not url:
+            return
+
+        configured, loaded_at = self._metadata_loaded.setdefault(
+            client.name, (dict(client.server_metadata), None))
+        if loaded_at is not None and time.time() - loaded_at < self.metadata_ttl:
+            return
+
+        cached = self.metadata_cache.get(url) if self.metadata_cache is not None else None
+        if cached:
+            metadata, loaded_at = cached['metadata'], cached['loaded_at']
+            self._metadata_stored[url] = (loaded_at, 'jwks' in metadata)
+        elif fetch:
+            metadata, loaded_at = self.fetch_provider_metadata(client, url), time.time()
+        else:
+            return
+
+        client.server_metadata = {**configured, **metadata}
+        self._metadata_loaded[client.name] = (configured, loaded_at)
+
+    def store_provider_metadata(self, client):
+        """Write a client's newly fetched discovery document and JWKS to the disk cache."""
+        url = self.metadata_urls.get(client.name)
+        _, loaded_at = self._metadata_loaded.get(client.name, (None, None))
+        if not url or self.metadata_cache is None or loaded_at is None:
+            return
+
+        metadata = client.server_metadata
+        state = (loaded_at, 'jwks' in metadata)
+        if self._metadata_stored.get(url) != state:
+            # leave out values configured on the client, they come from the profile
+            configured = self.profiles[client.name]['oauth_client_kwargs']
+            self.metadata_cache.set(url, {
+                'loaded_at': loaded_at,
+                'metadata': {
+                    key: value for key, value in metadata.items() if key not in configured
+                },
+            })
+            self._metadata_stored[url] = state
+
+    @contextlib.contextmanager
+    def provider_metadata(self, client):
+        """Use cached provider metadata for the duration of an OAuth request, and cache any
+        fetched during it."""
+        self.load_provider_metadata(client)
+        try:
+            yield client
+        finally:
+            self.store_provider_metadata(client)
 
     def verify_user(self, profile_name=None, login_id=None):
         oauth_profile = self.select_oauth_profile(profile_name)
@@ -983,9 +1326,10 @@ class OAuthAuthenticator(LoginAuthenticator):
         #   from specific domains. But we shouldn't make that assumption for all providers,
         #   and since we have the domain filter also for disallowing logins in KegAuthenticator,
         #   it's best to check it here as well.
-        if oauth_profile.get('domain_filter'):
+        domain_filter = self.profile_domains[profile_name]
+        if domain_filter:
             domain = get_domain_from_email(login_id)
-            if domain and domain not in tolist(oauth_profile['domain_filter']):
+            if domain and domain not in domain_filter:
                 raise UserNotFound
 
         user = self.user_ent.query.filter_by(username=login_id).one_or_none()
@@ -1011,6 +1355,12 @@ class LdapAuthenticator(KegAuthenticator):
 
         Most responder types won't be relevant here.
     """
+    def __init__(self, app):
+        super().__init__(app)
+        self._server_pool = None
+        self._server_pool_lock = threading.Lock()
+        self._verification_cache = None
+
     def verify_user(self, login_id=None, password=None):
         user = self.user_ent.query.filter_by(username=login_id).one_or_none()
 
@@ -1041,30 +1391,62 @@ class LdapAuthenticator(KegAuthenticator):
         if not ldap_dn_format:
             raise Exception(_('No KEGAUTH_LDAP_DN_FORMAT configured!'))
 
-        def ldap_bind(server_url):
-            session = ldap.initialize(server_url)
-
-            try:
-                dn = ldap_dn_format.format(user.username)
-                result = session.simple_bind_s(dn, password)
-                del session
-                return bool(
-                    result
-                    and len(result)
-                    and result[0] == ldap.RES_BIND
-                )
-            except (ldap.INVALID_CREDENTIALS, ldap.INVALID_DN_SYNTAX):
-                return False
-
-        if isinstance(ldap_url, str):
-            return ldap_bind(ldap_url)
-
-        # We have a list of servers.
-        for server_url in ldap_url:
-            if ldap_bind(server_url):
-                return True
+        dn = ldap_dn_format.format(user.username)
+        cache = self.verification_cache
+        if cache is not None:
+            fingerprint = cache.get(dn)
+            if fingerprint is not None:
+                if check_credential_fingerprint(fingerprint, password):
+                    return True
+                # maybe the password changed, the directory decides
+                cache.pop(dn)
+
+        success = self.get_server_pool(ldap_url).simple_bind(dn, password)
+        if cache is not None and success:
+            cache.set(dn, credential_fingerprint(
+                password, rounds=flask.current_app.config.get('KEGAUTH_LDAP_CACHE_ROUNDS')))
+        elif cache is not None:
+            cache.pop(dn)
+        return success
 
-        return False
+    @property
+    def verification_cache(self):
+        """Recently verified credentials, None if disabled. Rebuilt if the configuration changes."""
+        config = flask.current_app.config
+        settings = (config.get('KEGAUTH_LDAP_CACHE_TTL'), config.get('KEGAUTH_LDAP_CACHE_SIZE'))
+        if self._verification_cache is None or self._verification_cache[0] != settings:
+            ttl, size = settings
+            self._verification_cache = (
+                settings, TTLCache(maxsize=size, ttl=ttl) if ttl else None)
+        return self._verification_cache[1]
+
+    def get_server_pool(self, ldap_url):
+        """Servers, connection pools and health for the configured URL(s), kept between logins.
+
+        Rebuilt if the configuration changes."""
+        config = flask.current_app.config
+        settings = (
+            tuple(tolist(ldap_url)),
+            config.get('KEGAUTH_LDAP_PARALLEL_BIND'),
+            config.get('KEGAUTH_LDAP_POOL_SIZE'),
+            config.get('KEGAUTH_LDAP_NETWORK_TIMEOUT'),
+            config.get('KEGAUTH_LDAP_TIMEOUT'),
+            config.get('KEGAUTH_LDAP_FAILURE_BACKOFF'),
+        )
+        with self._server_pool_lock:
+            if self._server_pool is None or self._server_pool[0] != settings:
+                if self._server_pool is not None:
+                    self._server_pool[1].shutdown()
+                urls, parallel, pool_size, network_timeout, timeout, failure_backoff = settings
+                self._server_pool = (settings, LdapServerPool(
+                    urls,
+                    parallel=parallel,
+                    pool_size=pool_size,
+                    network_timeout=network_timeout,
+                    timeout=timeout,
+                    failure_backoff=failure_backoff,
+                ))
+            return self._server_pool[1]
 
 
 class JwtRequestLoader(TokenLoaderMixin, RequestLoader):
@@ -1074,6 +1456,26 @@ class JwtRequestLoader(TokenLoaderMixin, RequestLoader):
     def __init__(self, app):
         super(JwtRequestLoader, self).__init__(app)
 
+        # Users loaded for a token identity may be reused for up to this many seconds, bounding
+        # how long changes made elsewhere (e.g. disabling the user) can go unnoticed
+        self.user_cache = None
+        if app.config.get('KEGAUTH_JWT_USER_CACHE_TTL'):
+            self.user_cache = TTLCache(
+                maxsize=app.config.get('KEGAUTH_JWT_USER_CACHE_SIZE'),
+                ttl=app.config.get('KEGAUTH_JWT_USER_CACHE_TTL'),
+            )
+
+        self._revocation_store = None
+
+        # Asymmetric signing: tokens are signed with the current key's algorithm (see
+        # additional_headers_loader). flask-jwt-extended only takes the algorithms it accepts
+        # from config, so those default to the keys' algorithms. Set before it applies its own.
+        self._signing_keys = None
+        signing_keys = load_signing_keys(app.config.get('KEGAUTH_JWT_SIGNING_KEYS') or ())
+        if signing_keys:
+            app.config.setdefault(
+                'JWT_DECODE_ALGORITHMS', sorted({key.algorithm for key in signing_keys}))
+
         self.jwt_manager = jwt_manager = flask_jwt_extended.JWTManager()
         jwt_manager.init_app(app)
 
@@ -1094,7 +1496,142 @@ class JwtRequestLoader(TokenLoaderMixin, RequestLoader):
             Note, if user is not found or inactive, fail silently - user just won't get loaded
             """
             data_key = flask.current_app.config.get('JWT_IDENTITY_CLAIM')
-            return self.user_ent.get_by(session_key=jwt_data[data_key], is_active=True)
+            user = self.load_user(jwt_data[data_key])
+
+            # Permission changes rotate the session key, which is the token identity. So if the
+            # user loaded, a permission snapshot in the token is current, and can stand in for
+            # the permission query.
+            tokens = self.permission_tokens_from_claims(jwt_data)
+            if user is not None and tokens is not None:
+                user._permission_cache = tokens
+            return user
+
+        @jwt_manager.encode_key_loader
+        def encode_key_loader(identity):
+            signing_keys = self.signing_keys
+            if signing_keys:
+                return signing_keys[0].private_key
+            return flask_jwt_extended.config.config.encode_key
+
+        @jwt_manager.decode_key_loader
+        def decode_key_loader(jwt_header, jwt_data):
+            signing_keys = self.signing_keys
+            if not signing_keys:
+                return flask_jwt_extended.config.config.decode_key
+            for key in signing_keys:
+                if key.kid == jwt_header.get('kid'):
+                    return key.public_key
+            # e.g. a key retired since the token was issued
+            raise flask_jwt_extended.exceptions.JWTDecodeError('Unknown JWT signing key')
+
+        @jwt_manager.additional_headers_loader
+        def additional_headers_loader(identity):
+            # an alg header takes precedence over JWT_ALGORITHM when signing
+            signing_keys = self.signing_keys
+            if not signing_keys:
+                return {}
+            return {'kid': signing_keys[0].kid, 'alg': signing_keys[0].algorithm}
+
+        @jwt_manager.token_in_blocklist_loader
+        def token_in_blocklist_loader(jwt_header, jwt_data):
+            self.sync_revocations()
+            return self.revocation_store.is_revoked(jwt_data.get('jti'))
+
+    @property
+    def signing_keys(self):
+        """Keys from ``KEGAUTH_JWT_SIGNING_KEYS``, current signing key first. Empty for HMAC."""
+        pems = tuple(flask.current_app.config.get('KEGAUTH_JWT_SIGNING_KEYS') or ())
+        if self._signing_keys is None or self._signing_keys[0] != pems:
+            self._signing_keys = (pems, load_signing_keys(pems))
+        return self._signing_keys[1]
+
+    def get_jwks(self):
+        """Public signing keys as a JWKS document, for verifying tokens elsewhere."""
+        return {'keys': [key.jwk for key in self.signing_keys]}
+
+    @property
+    def revocation_store(self):
+        """Revoked token IDs, checked on every request without a database query."""
+        if self._revocation_store is None:
+            config = flask.current_app.config
+            self._revocation_store = RevocationStore(
+                capacity=config.get('KEGAUTH_JWT_REVOCATION_CAPACITY'),
+                error_rate=config.get('KEGAUTH_JWT_REVOCATION_ERROR_RATE'),
+                sync_interval=config.get('KEGAUTH_JWT_REVOCATION_SYNC_INTERVAL'),
+            )
+        return self._revocation_store
+
+    @staticmethod
+    def _revoked_token_cls():
+        registry = flask.current_app.auth_manager.entity_registry
+        if registry.is_registered('revoked_token'):
+            return registry.revoked_token_cls
+        return None
+
+    def sync_revocations(self, force=False):
+        """Pick up tokens revoked by other processes, if a revoked token entity is registered."""
+        revoked_token_cls = self._revoked_token_cls()
+        if revoked_token_cls is not None:
+            self.revocation_store.sync(revoked_token_cls, force=force)
+
+    def revoke_token(self, token):
+        """Revoke a single access token, e.g. on logout. Other tokens for the user still work.
+
+        Takes effect immediately in this process. With a revoked token entity registered, the
+        revocation is also recorded for other processes, which pick it up on their next sync.
+
+        :param token: the encoded token, or its decoded claims
+        """
+        if isinstance(token, str):
+            token = flask_jwt_extended.decode_token(token, allow_expired=True)
+        jti, exp = token['jti'], token.get('exp')
+
+        self.revocation_store.add(jti, exp)
+        revoked_token_cls = self._revoked_token_cls()
+        if revoked_token_cls is not None:
+            revoked_token_cls.revoke(jti, None if exp is None else arrow.get(exp))
+
+    def load_user(self, session_key):
+        """Load the active user for a token identity, from the user cache when enabled."""
+        if self.user_cache is None:
+            return self.user_ent.get_by(session_key=session_key, is_active=True)
+
+        snapshot = self.user_cache.get(session_key)
+        if snapshot is not None:
+            disabled_utc = snapshot.get('disabled_utc')
+            if disabled_utc is None or disabled_utc > arrow.utcnow():
+                return restore_entity(self.user_ent, snapshot)
+            self.user_cache.pop(session_key)
+
+        user = self.user_ent.get_by(session_key=session_key, is_active=True)
+        if user is not None:
+            self.user_cache.set(session_key, snapshot_entity(user))
+        return user
+
+    def invalidate_session_key(self, session_key):
+        if self.user_cache is not None:
+            self.user_cache.pop(session_key)
+
+    @classmethod
+    def get_credential_locations(cls, config):
+        # flask-jwt-extended settings, with its defaults
+        token_location = tolist(config.get('JWT_TOKEN_LOCATION', 'headers'))
+        locations = []
+        if 'headers' in token_location:
+            locations.append(CredentialLocation(
+                'header',
+                config.get('JWT_HEADER_NAME', 'Authorization'),
+                config.get('JWT_HEADER_TYPE', 'Bearer') or None,
+            ))
+        if 'cookies' in token_location:
+            locations.append(CredentialLocation(
+                'cookie', config.get('JWT_ACCESS_COOKIE_NAME', 'access_token_cookie')))
+        if 'query_string' in token_location:
+            locations.append(CredentialLocation(
+                'query_string', config.get('JWT_QUERY_STRING_NAME', 'jwt')))
+        if 'json' in token_location:
+            locations.append(CredentialLocation('json'))
+        return locations
 
     @staticmethod
     def get_authenticated_user():
@@ -1102,30 +1639,117 @@ class JwtRequestLoader(TokenLoaderMixin, RequestLoader):
             if flask_jwt_extended.verify_jwt_in_request() is None:
                 return None
             user = flask_jwt_extended.get_current_user()
-            flask_login.login_user(user)
+            RequestLoader.login_user(user)
             return user
         except flask_jwt_extended.exceptions.JWTExtendedException:
             return None
 
-    def create_access_token(self, user):
-        return flask_jwt_extended.create_access_token(user)
+    def create_access_token(self, user, permissions=None, expires_delta=None):
+        """Create an access token for the user.
+
+        :param permissions: embed a snapshot of the user's permission tokens, "list" for the
+            tokens themselves, or "bitmask" for a compact mask over the app's defined permissions.
+            Defaults to ``KEGAUTH_JWT_PERMISSIONS_CLAIM``.
+        :param expires_delta: token lifetime, defaults to ``KEGAUTH_JWT_PERMISSIONS_EXPIRES`` for
+            tokens with a permission snapshot, and the flask-jwt-extended setting otherwise
+        """
+        config = flask.current_app.config
+        if permissions is None:
+            permissions = config.get('KEGAUTH_JWT_PERMISSIONS_CLAIM')
+        if not permissions:
+            return flask_jwt_extended.create_access_token(user, expires_delta=expires_delta)
+
+        if expires_delta is None:
+            expires_delta = timedelta(seconds=config.get('KEGAUTH_JWT_PERMISSIONS_EXPIRES'))
+        return flask_jwt_extended.create_access_token(
+            user,
+            expires_delta=expires_delta,
+            additional_claims=self.permission_claims(user, permissions),
+        )
+
+    @staticmethod
+    def _refresh_expires_utc():
+        return arrow.utcnow().shift(
+            seconds=flask.current_app.config.get('KEGAUTH_JWT_REFRESH_EXPIRES'))
+
+    def create_refresh_token(self, user):
+        """Issue a refresh token for the user, e.g. alongside the access token at login.
+
+        Requires an entity registered as ``refresh_token``. Commits.
+        """
+        refresh_token_cls = flask.current_app.auth_manager.entity_registry.refresh_token_cls
+        _, token = refresh_token_cls.issue(user.id, self._refresh_expires_utc())
+        db.session.commit()
+        return token
+
+    def refresh(self, refresh_token):
+        """Exchange a refresh token for ``(access token, refresh token)``.
+
+        The refresh token given is used up. Returns None if it is not valid, or the user is no
+        longer active.
+        """
+        refresh_token_cls = flask.current_app.auth_manager.entity_registry.refresh_token_cls
+        rotated = refresh_token_cls.rotate(refresh_token, self._refresh_expires_utc())
+        if rotated is None:
+            return None
+
+        user_id, new_refresh_token = rotated
+        user = self.user_ent.get_by(id=user_id, is_active=True)
+        if user is None:
+            return None
+        return self.create_access_token(user), new_refresh_token
+
+    @staticmethod
+    def _defined_permission_tokens():
+        tokens = sorted(tolist(perm)[0] for perm in flask.current_app.auth_manager.permissions)
+        digest = hashlib.sha256('\n'.join(tokens).encode()).hexdigest()[:8]
+        return tokens, digest
+
+    def permission_claims(self, user, mode):
+        tokens = user.get_all_permission_tokens()
+        if mode == 'bitmask':
+            defined, digest = self._defined_permission_tokens()
+            # tokens missing from the app's definitions cannot be interned
+            if tokens.issubset(defined):
+                mask = sum(1 << index for index, token in enumerate(defined) if token in tokens)
+                return {'permb': format(mask, 'x'), 'permd': digest}
+        elif mode != 'list':
+            raise ValueError(f'Unknown permissions claim mode: {mode}')
+        return {'perms': sorted(tokens)}
+
+    def permission_tokens_from_claims(self, claims):
+        """Permission tokens from a verified token's claims, None if it has no usable snapshot."""
+        if 'perms' in claims:
+            return set(claims['perms'])
+        if 'permb' in claims:
+            defined, digest = self._defined_permission_tokens()
+            # a mask is only meaningful against the definitions it was created with
+            if claims.get('permd') != digest:
+                return None
+            mask = int(claims['permb'], 16)
+            return {token for index, token in enumerate(defined) if mask >> index & 1}
+        return None
 
 
 class TokenRequestLoader(RequestLoader):
     authentication_failure_redirect = False
 
+    @classmethod
+    def get_credential_locations(cls, config):
+        return [CredentialLocation('header', 'X-Auth-Token')]
+
     def get_authenticated_user(self):
         token = flask.request.headers.get('X-Auth-Token')
 
         if token is None:
             return
 
-        user = self.user_ent.get_by_token(token)
+        user = self.user_ent.get_user_for_api_token(token)
 
         if user is None:
             return
 
-        flask_login.login_user(user)
+        self.login_user(user)
         return user
 
 
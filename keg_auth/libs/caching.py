@@ -0,0 +1,129 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import flask
+import sqlalchemy as sa
+from keg.db import db
+
+log = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    """Bounded, thread-safe mapping whose entries expire ``ttl`` seconds after being set.
+
+    Once ``maxsize`` entries are held, the least recently used entry is evicted to make room.
+    """
+    def __init__(self, maxsize=1024, ttl=60, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires <= self.timer():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (self.timer() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                return self._data.pop(key)[1]
+            except KeyError:
+                return default
+
+    def discard_where(self, predicate):
+        """Remove all entries whose value matches ``predicate``."""
+        with self._lock:
+            for key in [key for key, (_, value) in self._data.items() if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class JSONFileCache(object):
+    """JSON documents kept on disk for ``ttl`` seconds, shared by processes on one host.
+
+    Entries are written to a temporary file and renamed into place, so readers never see a
+    partial document. Unreadable or stale entries count as missing.
+    """
+    def __init__(self, directory, ttl=86400, timer=time.time):
+        self.directory = directory
+        self.ttl = ttl
+        self.timer = timer
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + '.json')
+
+    def get(self, key, default=None):
+        try:
+            with open(self.path(key)) as fo:
+                cached = json.load(fo)
+            if self.timer() - cached['stored'] >= self.ttl:
+                return default
+            return cached['value']
+        except (OSError, ValueError, KeyError, TypeError):
+            return default
+
+    def set(self, key, value):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=self.directory, delete=False) as fo:
+                json.dump({'key': key, 'stored': self.timer(), 'value': value}, fo)
+            os.replace(fo.name, self.path(key))
+        except OSError as exc:
+            log.warning('Could not write cache file for %s: %s', key, exc)
+
+
+def get_credential_cache():
+    """Return the current app's verified-credential cache, or None if it is disabled."""
+    if not flask.has_app_context():
+        return None
+    auth_manager = getattr(flask.current_app, 'auth_manager', None)
+    if auth_manager is None:
+        return None
+    return auth_manager.credential_cache
+
+
+def snapshot_entity(obj):
+    """Capture an entity's column values, to rebuild it later with ``restore_entity``."""
+    mapper = sa.inspect(obj).mapper
+    return {attr.key: getattr(obj, attr.key) for attr in mapper.column_attrs}
+
+
+def restore_entity(cls, snapshot):
+    """Rebuild an entity from ``snapshot_entity`` values, attached to the current session.
+
+    Nothing is loaded from the database, the entity is taken to be persistent with the given
+    values. Relationships still load as usual on access.
+    """
+    obj = sa.inspect(cls).class_manager.new_instance()
+    for key, value in snapshot.items():
+        setattr(obj, key, value)
+    sa.orm.make_transient_to_detached(obj)
+    return db.session.merge(obj, load=False)
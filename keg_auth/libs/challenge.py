@@ -0,0 +1,66 @@
+import hashlib
+import itertools
+
+import flask
+from itsdangerous import BadData, URLSafeTimedSerializer
+
+# Solutions are decimal counters, anything longer is not worth hashing
+MAX_SOLUTION_LENGTH = 20
+
+
+def _get_serializer():
+    return URLSafeTimedSerializer(
+        flask.current_app.config['SECRET_KEY'],
+        salt='keg-auth-login-pow',
+    )
+
+
+def issue_pow_challenge(login_id, difficulty, binding=None):
+    """Create a signed proof-of-work challenge for a login attempt.
+
+    The challenge carries everything needed to verify a solution later, so nothing is stored
+    server-side. ``binding`` ties the challenge to the current attempt state (e.g. the id of the
+    last failed attempt) so a solved challenge cannot be replayed once that state changes.
+    """
+    return _get_serializer().dumps({'u': login_id, 'd': difficulty, 'b': binding})
+
+
+def pow_solution_is_valid(challenge, solution, difficulty):
+    """Does sha256(``challenge:solution``) start with ``difficulty`` zero bits?"""
+    if not solution or len(solution) > MAX_SOLUTION_LENGTH or not solution.isdigit():
+        return False
+    digest = hashlib.sha256(f'{challenge}:{solution}'.encode()).digest()
+    return int.from_bytes(digest, 'big') >> (len(digest) * 8 - difficulty) == 0
+
+
+def verify_pow_solution(challenge, solution, login_id, difficulty, binding=None):
+    """Verify a challenge was issued by us for this login and state, and has been solved.
+
+    The challenge must have been issued within ``KEGAUTH_LOGIN_POW_TTL`` seconds, for the same
+    login ID and binding, with at least the required difficulty.
+    """
+    if not challenge:
+        return False
+
+    try:
+        payload = _get_serializer().loads(
+            challenge,
+            max_age=flask.current_app.config.get('KEGAUTH_LOGIN_POW_TTL'),
+        )
+    except BadData:
+        return False
+
+    if payload.get('u') != login_id or payload.get('b') != binding:
+        return False
+    if not isinstance(payload.get('d'), int) or payload['d'] < difficulty:
+        return False
+
+    return pow_solution_is_valid(challenge, solution, payload['d'])
+
+
+def solve_pow_challenge(challenge, difficulty):
+    """Brute force a solution, as the login page does in the browser."""
+    for counter in itertools.count():
+        solution = str(counter)
+        if pow_solution_is_valid(challenge, solution, difficulty):
+            return solution
@@ -5,6 +5,7 @@ import flask_login
 from keg.web import validate_arguments, ArgumentValidationError, ViewArgumentError
 
 from keg_auth.extensions import lazy_gettext as _
+from keg_auth.libs import REQUEST_CREDENTIALS, get_request_kind, get_request_loaders
 from keg_auth.model import utils as model_utils
 
 
@@ -130,15 +131,16 @@ class RequiresUser(object):
 
         # no user in session right now, so we need to run request loaders to see if any match
         user = None
-        all_loaders = (
-            (self.request_loaders or [])
-            + list(flask.current_app.auth_manager.request_loaders.values())
-        )
+        # only loaders reading something the request carries
+        auth_manager = flask.current_app.auth_manager
+        all_loaders = [
+            auth_manager.resolve_request_loader(loader) for loader in (self.request_loaders or [])
+            if loader.may_authenticate(flask.request)
+        ]
+        if get_request_kind() == REQUEST_CREDENTIALS:
+            all_loaders += get_request_loaders()
 
         for loader in all_loaders:
-            if inspect.isclass(loader):
-                loader = loader(flask.current_app)
-
             user = loader.get_authenticated_user()
             if user:
                 break
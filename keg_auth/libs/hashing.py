@@ -0,0 +1,257 @@
+import concurrent.futures
+import functools
+import statistics
+import threading
+import time
+import typing
+
+import flask
+import passlib.hash
+from passlib.context import CryptContext
+from werkzeug.exceptions import ServiceUnavailable
+
+from keg_auth.extensions import lazy_gettext as _
+
+
+class HashingServiceBusy(ServiceUnavailable):
+    """Raised when the hashing pool is saturated, or a hash did not complete in time.
+
+    As an HTTP exception, it renders as a 503 response if not otherwise handled.
+    """
+    description = _('The server is too busy to process this request. Please try again shortly.')
+
+
+@functools.lru_cache(maxsize=16)
+def _get_process_context(context_string):
+    return CryptContext.from_string(context_string)
+
+
+def _process_hash(context_string, secret):
+    return _get_process_context(context_string).hash(secret)
+
+
+def _process_verify(context_string, secret, hash):
+    return _get_process_context(context_string).verify(secret, hash)
+
+
+def _process_verify_and_update(context_string, secret, hash):
+    return _get_process_context(context_string).verify_and_update(secret, hash)
+
+
+def _process_hash_many(context_string, secrets):
+    context = _get_process_context(context_string)
+    return [context.hash(secret) for secret in secrets]
+
+
+def hash_many(context, secrets, executor=None, chunk_size=100):
+    """Hash a batch of secrets, optionally spread across a process pool.
+
+    Meant for bulk work like user imports, where hashing dominates. Secrets are sent to the
+    executor's workers in chunks, to keep the overhead of sending the context configuration low.
+    Hashes are returned in the order of ``secrets``.
+
+    :param executor: ``concurrent.futures.ProcessPoolExecutor`` to hash in, None to hash inline
+    """
+    secrets = list(secrets)
+    if executor is None:
+        return [context.hash(secret) for secret in secrets]
+
+    context_string = context.to_string()
+    chunks = [secrets[i:i + chunk_size] for i in range(0, len(secrets), chunk_size)]
+    results = executor.map(_process_hash_many, [context_string] * len(chunks), chunks)
+    return [hash for chunk in results for hash in chunk]
+
+
+class HashingService(object):
+    """Run password hashing and verification in a bounded worker pool.
+
+    Hashing is CPU-bound and slow by design. Running it in a pool keeps request threads (or
+    greenlets) free, and caps how much hashing can be in progress at once. Once the pool and its
+    queue are full, new work is rejected immediately with ``HashingServiceBusy``, rather than
+    piling up behind a backlog of logins.
+
+    :param max_workers: number of pool workers
+    :param executor_type: "thread" or "process". Thread pools suit schemes that release the GIL
+        while hashing (e.g. bcrypt). Process pools avoid the GIL altogether, at the cost of
+        sending the context configuration to the workers.
+    :param queue_limit: number of jobs allowed to wait for a worker
+    :param timeout: seconds to wait for a result before giving up, None to wait indefinitely
+    """
+    def __init__(self, max_workers=4, executor_type='thread', queue_limit=0, timeout=None):
+        if executor_type not in ('thread', 'process'):
+            raise ValueError(f'Unknown executor type: {executor_type}')
+
+        self.max_workers = max_workers
+        self.executor_type = executor_type
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_workers + queue_limit)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def executor(self):
+        # created on first use, so no workers are started until something needs hashing
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    if self.executor_type == 'process':
+                        executor_cls = concurrent.futures.ProcessPoolExecutor
+                    else:
+                        executor_cls = concurrent.futures.ThreadPoolExecutor
+                    self._executor = executor_cls(max_workers=self.max_workers)
+        return self._executor
+
+    def run(self, func, *args):
+        """Run ``func(*args)`` in the pool and wait for the result."""
+        if not self._slots.acquire(blocking=False):
+            raise HashingServiceBusy()
+
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _future: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise HashingServiceBusy()
+
+    def hash(self, context, secret):
+        """Hash ``secret`` with the context's default scheme."""
+        if self.executor_type == 'process':
+            return self.run(_process_hash, context.to_string(), secret)
+        return self.run(context.hash, secret)
+
+    def verify(self, context, secret, hash):
+        """Verify ``secret`` against ``hash``."""
+        if self.executor_type == 'process':
+            return self.run(_process_verify, context.to_string(), secret, hash)
+        return self.run(context.verify, secret, hash)
+
+    def verify_and_update(self, context, secret, hash):
+        """Verify ``secret`` against ``hash``, see ``CryptContext.verify_and_update``."""
+        if self.executor_type == 'process':
+            return self.run(_process_verify_and_update, context.to_string(), secret, hash)
+        return self.run(context.verify_and_update, secret, hash)
+
+    def shutdown(self, wait=True):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+
+def get_hashing_service():
+    """Return the current app's hashing service, or None if hashing should run inline."""
+    if not flask.has_app_context():
+        return None
+    auth_manager = getattr(flask.current_app, 'auth_manager', None)
+    if auth_manager is None:
+        return None
+    return auth_manager.hashing_service
+
+
+# Cost values tried by default when calibrating. bcrypt's rounds are log2 of the iterations,
+# argon2's are its time cost.
+CALIBRATION_ROUNDS = {
+    'bcrypt': (10, 11, 12, 13, 14),
+    'pbkdf2_sha256': (100000, 200000, 300000, 450000, 600000),
+    'pbkdf2_sha512': (50000, 100000, 210000, 300000),
+    'argon2': (1, 2, 3, 4),
+}
+
+
+class CalibrationResult(typing.NamedTuple):
+    scheme: str
+    rounds: int
+    p50_ms: float
+    p99_ms: float
+
+
+def scheme_available(scheme):
+    """Is the hash scheme known to passlib, with a usable backend?"""
+    handler = getattr(passlib.hash, scheme, None)
+    if handler is None:
+        return False
+    has_backend = getattr(handler, 'has_backend', None)
+    return has_backend() if has_backend else True
+
+
+def check_rounds(scheme, rounds):
+    """Raise ValueError if ``rounds`` is outside the scheme's supported cost range.
+
+    passlib clamps an out of range cost to the nearest limit, which would benchmark (and
+    recommend) a cost other than the one asked for.
+    """
+    handler = getattr(passlib.hash, scheme)
+    min_rounds = getattr(handler, 'min_rounds', None)
+    max_rounds = getattr(handler, 'max_rounds', None)
+    if (min_rounds is not None and rounds < min_rounds) or (
+        max_rounds is not None and rounds > max_rounds
+    ):
+        raise ValueError(f'{scheme} rounds must be between {min_rounds} and {max_rounds}')
+
+
+def measure_verify(scheme, rounds, samples=20, threads=1):
+    """Time ``samples`` verifications of a hash at the given cost, ``threads`` at a time.
+
+    Concurrency matters: with threads contending for CPU, latency grows once there are more
+    concurrent hashes than cores (or, for schemes holding the GIL, beyond one).
+    """
+    check_rounds(scheme, rounds)
+    context = CryptContext(schemes=[scheme], **{f'{scheme}__rounds': rounds})
+    hash = context.hash('calibration-password')
+
+    def timed_verify(_):
+        start = time.perf_counter()
+        context.verify('calibration-password', hash)
+        return (time.perf_counter() - start) * 1000
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        timings = sorted(executor.map(timed_verify, range(samples)))
+
+    if len(timings) > 1:
+        p99 = statistics.quantiles(timings, n=100, method='inclusive')[98]
+    else:
+        p99 = timings[0]
+    return CalibrationResult(scheme, rounds, statistics.median(timings), p99)
+
+
+def calibrate_schemes(schemes, rounds=None, samples=20, threads=1):
+    """Measure each scheme across a range of cost values, yielding ``CalibrationResult``.
+
+    :param rounds: dict of cost values to try by scheme, since each scheme measures cost in its
+        own units. Schemes left out use ``CALIBRATION_ROUNDS``.
+    """
+    rounds = rounds or {}
+    for scheme in schemes:
+        for scheme_rounds in rounds.get(scheme) or CALIBRATION_ROUNDS.get(scheme, ()):
+            yield measure_verify(scheme, scheme_rounds, samples=samples, threads=threads)
+
+
+def recommend_cryptcontext_kwargs(results, target_ms, schemes):
+    """Pick the highest cost per scheme with p99 latency within ``target_ms``.
+
+    Returns a ``PASSLIB_CRYPTCONTEXT_KWARGS`` value, or None if no cost fits the budget. The first
+    of ``schemes`` to fit the budget becomes the default scheme, and the others remain available
+    for verifying existing hashes (and are rehashed on login, see ``deprecated='auto'``).
+    """
+    best = {}
+    for result in results:
+        if result.p99_ms <= target_ms and result.rounds > best.get(result.scheme, 0):
+            best[result.scheme] = result.rounds
+
+    fitting = [scheme for scheme in schemes if scheme in best]
+    if not fitting:
+        return None
+
+    kwargs = {
+        'schemes': fitting + [scheme for scheme in schemes if scheme not in best],
+        'deprecated': 'auto',
+    }
+    for scheme in fitting:
+        kwargs[f'{scheme}__rounds'] = best[scheme]
+    return kwargs
@@ -0,0 +1,183 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key
+from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+
+log = logging.getLogger(__name__)
+
+# JWK members covered by the RFC 7638 thumbprint, by key type
+_THUMBPRINT_MEMBERS = {
+    'RSA': ('e', 'kty', 'n'),
+    'OKP': ('crv', 'kty', 'x'),
+}
+
+# algorithm for JWKs that do not name one
+_KEY_TYPE_ALGORITHMS = {
+    'RSA': 'RS256',
+    'OKP': 'EdDSA',
+}
+
+
+def jwk_thumbprint(jwk):
+    """RFC 7638 thumbprint of a public JWK, used as its key ID."""
+    members = {name: jwk[name] for name in _THUMBPRINT_MEMBERS[jwk['kty']]}
+    digest = hashlib.sha256(json.dumps(members, separators=(',', ':'), sort_keys=True).encode())
+    return base64.urlsafe_b64encode(digest.digest()).rstrip(b'=').decode()
+
+
+class SigningKey(object):
+    """An RSA (RS256) or Ed25519 (EdDSA) key for signing and verifying JWTs.
+
+    :param pem: PEM encoded private key, or public key for a key that is only kept for verifying
+        tokens signed before a rotation
+    """
+    def __init__(self, pem):
+        if isinstance(pem, str):
+            pem = pem.encode()
+        if b'PRIVATE KEY' in pem:
+            self.private_key = load_pem_private_key(pem, password=None)
+            self.public_key = self.private_key.public_key()
+        else:
+            self.private_key = None
+            self.public_key = load_pem_public_key(pem)
+
+        if isinstance(self.public_key, rsa.RSAPublicKey):
+            self.algorithm = 'RS256'
+            jwk = RSAAlgorithm.to_jwk(self.public_key, as_dict=True)
+        elif isinstance(self.public_key, ed25519.Ed25519PublicKey):
+            self.algorithm = 'EdDSA'
+            jwk = OKPAlgorithm.to_jwk(self.public_key, as_dict=True)
+        else:
+            raise ValueError('JWT signing keys must be RSA or Ed25519')
+
+        self.kid = jwk_thumbprint(jwk)
+        self.jwk = dict(jwk, kid=self.kid, alg=self.algorithm, use='sig')
+
+
+def load_signing_keys(pems):
+    """Load PEM keys, current signing key first. Later (older) keys may be public keys only."""
+    keys = [SigningKey(pem) for pem in pems]
+    if keys and keys[0].private_key is None:
+        raise ValueError('The first JWT signing key must be a private key')
+    return keys
+
+
+def _fetch_json(url, timeout=10):
+    with urllib.request.urlopen(url, timeout=timeout) as resp:
+        return json.load(resp)
+
+
+class JWKSVerifier(object):
+    """Verify JWTs locally against the keys an app publishes as a JWKS document.
+
+    For services that trust tokens issued by a keg-auth app, without sharing a secret or calling
+    the app for each token. Keys are held in memory by key ID and, when ``cache_path`` is given,
+    on disk, so a restarted process can verify tokens before (or without) reaching the app.
+
+    The document is fetched again once it is ``max_age`` seconds old, or when a token names an
+    unknown key (a rotation), at most every ``min_refresh_interval`` seconds. If a fetch fails,
+    the keys already held keep being used.
+
+    Only signatures and standard claims are checked. Token revocation and the user's current
+    state are only known to the app itself.
+
+    :param url: the app's JWKS URL, e.g. ``https://example.com/.well-known/jwks.json``
+    :param decode_options: passed through to ``jwt.decode``, e.g. ``audience``, ``leeway``
+    """
+    def __init__(self, url, cache_path=None, max_age=3600, min_refresh_interval=60,
+                 fetch=_fetch_json, timer=time.time, **decode_options):
+        self.url = url
+        self.cache_path = cache_path
+        self.max_age = max_age
+        self.min_refresh_interval = min_refresh_interval
+        self.fetch = fetch
+        self.timer = timer
+        self.decode_options = decode_options
+        self._keys = None
+        self._fetched = 0
+        self._last_attempt = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse(jwks):
+        keys = {}
+        for jwk in jwks.get('keys', ()):
+            try:
+                algorithm = jwk.get('alg') or _KEY_TYPE_ALGORITHMS[jwk['kty']]
+                keys[jwk['kid']] = (jwt.PyJWK(jwk, algorithm).key, algorithm)
+            except (KeyError, jwt.PyJWTError) as exc:
+                log.warning('Skipping unusable JWK: %s', exc)
+        return keys
+
+    def _load_cache_file(self):
+        try:
+            with open(self.cache_path) as fo:
+                cached = json.load(fo)
+            return self._parse(cached['jwks']), cached['fetched']
+        except (OSError, ValueError, KeyError) as exc:
+            log.info('JWKS cache file not used: %s', exc)
+            return None, 0
+
+    def _write_cache_file(self, jwks, fetched):
+        # write and rename, so readers never see a partial file
+        directory = os.path.dirname(os.path.abspath(self.cache_path))
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as fo:
+                json.dump({'jwks': jwks, 'fetched': fetched}, fo)
+            os.replace(fo.name, self.cache_path)
+        except OSError as exc:
+            log.warning('Could not write JWKS cache file: %s', exc)
+
+    def refresh(self):
+        """Fetch the JWKS document. Returns False if it could not be fetched."""
+        now = self.timer()
+        self._last_attempt = now
+        try:
+            jwks = self.fetch(self.url)
+        except Exception as exc:
+            log.warning('Could not fetch JWKS from %s: %s', self.url, exc)
+            return False
+
+        self._keys, self._fetched = self._parse(jwks), now
+        if self.cache_path:
+            self._write_cache_file(jwks, now)
+        return True
+
+    def _can_refresh(self, now):
+        return (self._last_attempt is None
+                or now - self._last_attempt >= self.min_refresh_interval)
+
+    def get_key(self, kid):
+        """Return ``(key, algorithm)`` for a key ID, or None if the app does not publish it."""
+        with self._lock:
+            if self._keys is None:
+                self._keys, self._fetched = {}, 0
+                if self.cache_path:
+                    self._keys, self._fetched = self._load_cache_file()
+                    self._keys = self._keys or {}
+
+            now = self.timer()
+            stale = now - self._fetched >= self.max_age
+            if (stale or kid not in self._keys) and self._can_refresh(now):
+                self.refresh()
+            return self._keys.get(kid)
+
+    def verify(self, token, **decode_options):
+        """Verify a token and return its claims. Raises ``jwt.PyJWTError`` if it is invalid."""
+        kid = jwt.get_unverified_header(token).get('kid')
+        found = self.get_key(kid) if kid else None
+        if found is None:
+            raise jwt.InvalidKeyError(f'Unknown JWT signing key: {kid}')
+        key, algorithm = found
+        options = dict(self.decode_options, **decode_options)
+        return jwt.decode(token, key, algorithms=[algorithm], **options)
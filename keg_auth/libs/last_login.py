@@ -0,0 +1,113 @@
+import atexit
+import logging
+import threading
+import weakref
+
+import arrow
+import sqlalchemy as sa
+from keg.db import db
+
+from keg_auth.libs.caching import TTLCache
+
+log = logging.getLogger(__name__)
+
+# recorders with a flush thread running, stopped (writing what they have queued) at exit
+_running = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_running():
+    for recorder in list(_running):
+        recorder.stop()
+
+
+class LastLoginRecorder(object):
+    """Writes users' ``last_login_utc``, coalescing the writes for request loader logins.
+
+    Request loaders (JWT, API tokens) log the user in on every request. For those, the time is
+    only written once it is ``interval`` seconds old. Users written recently are also tracked in
+    process, since a loader may work from a cached copy of the user. With ``deferred``, the
+    writes are queued, and a background thread writes them in one batch every
+    ``flush_interval`` seconds.
+
+    Interactive logins are always written right away, as they also invalidate outstanding
+    password reset and verification tokens (see ``UserMixin.get_token_salt``).
+    """
+    def __init__(self, app, user_cls, interval=60, deferred=False, flush_interval=10,
+                 maxsize=10000):
+        self.app = app
+        self.user_cls = user_cls
+        self.interval = interval
+        self.deferred = deferred
+        self.flush_interval = flush_interval
+        self._recent = TTLCache(maxsize=maxsize, ttl=interval) if interval else None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def is_due(self, user, now):
+        if not self.interval:
+            return True
+        if self._recent.get(user.id) is not None:
+            return False
+        last_login = user.last_login_utc
+        return last_login is None or (now - last_login).total_seconds() >= self.interval
+
+    def record(self, user, interactive=True):
+        """Record a login. Returns whether the time was written (or queued)."""
+        now = arrow.utcnow()
+        if not interactive and not self.is_due(user, now):
+            return False
+
+        if self._recent is not None:
+            self._recent.set(user.id, now)
+
+        if interactive or not self.deferred:
+            user.last_login_utc = now
+            db.session.commit()
+            return True
+
+        with self._lock:
+            self._pending[user.id] = now
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='keg-auth-last-login', daemon=True)
+                self._thread.start()
+                _running.add(self)
+        return True
+
+    def flush(self):
+        """Write queued login times in one batch. Returns the number of users written."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        with self.app.app_context():
+            try:
+                db.session.execute(sa.update(self.user_cls), [
+                    {'id': user_id, 'last_login_utc': login_utc}
+                    for user_id, login_utc in sorted(pending.items())
+                ])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                log.exception('Could not write last login times')
+                return 0
+            finally:
+                db.session.remove()
+        return len(pending)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        """Stop the background thread, writing anything still queued."""
+        self._stopped.set()
+        _running.discard(self)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
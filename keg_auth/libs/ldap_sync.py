@@ -0,0 +1,255 @@
+import collections
+
+import flask
+import sqlalchemy as sa
+from blazeutils import tolist
+from keg.db import db
+from sqlalchemy_utils import EmailType
+
+from keg_auth.libs.ldap_utils import LdapServerPool, normalize_dn, paged_search
+from keg_auth.model import _generate_session_key, get_username_key
+
+# rows per IN list or insert statement
+CHUNK_SIZE = 1000
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _first_value(attrs, name):
+    values = attrs.get(name) or [b'']
+    value = values[0]
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class LdapDirectory(object):
+    """Users and group memberships from an LDAP directory, to apply with ``LdapSync``.
+
+    :param users: dict of user DN to username
+    :param groups: dict of group name to member values. Members are DNs, or usernames for groups
+        listing those instead (e.g. posixGroup ``memberUid``).
+    """
+    def __init__(self, users=None, groups=None):
+        self.users = {normalize_dn(dn): username for dn, username in (users or {}).items()}
+        self.groups = groups or {}
+
+    @classmethod
+    def read(cls, conn, config, page_size=None):
+        """Read users and groups from a bound connection, as set up in the app config."""
+        page_size = page_size or config['KEGAUTH_LDAP_SYNC_PAGE_SIZE']
+        username_attr = config['KEGAUTH_LDAP_SYNC_USERNAME_ATTR']
+        group_name_attr = config['KEGAUTH_LDAP_SYNC_GROUP_NAME_ATTR']
+        member_attr = config['KEGAUTH_LDAP_SYNC_MEMBER_ATTR']
+
+        users = {}
+        for dn, attrs in paged_search(
+            conn,
+            config['KEGAUTH_LDAP_SYNC_USER_BASE_DN'],
+            config['KEGAUTH_LDAP_SYNC_USER_FILTER'],
+            [username_attr],
+            page_size=page_size,
+        ):
+            username = _first_value(attrs, username_attr)
+            if username:
+                users[dn] = username
+
+        groups = {}
+        for _, attrs in paged_search(
+            conn,
+            config['KEGAUTH_LDAP_SYNC_GROUP_BASE_DN'],
+            config['KEGAUTH_LDAP_SYNC_GROUP_FILTER'],
+            [group_name_attr, member_attr],
+            page_size=page_size,
+        ):
+            name = _first_value(attrs, group_name_attr)
+            if name:
+                groups[name] = {
+                    value.decode('utf-8') if isinstance(value, bytes) else value
+                    for value in attrs.get(member_attr, ())
+                }
+
+        return cls(users=users, groups=groups)
+
+
+class LdapSyncReport(object):
+    def __init__(self):
+        self.users_created = 0
+        self.groups_created = 0
+        self.memberships_added = 0
+        self.memberships_removed = 0
+        self.sessions_invalidated = 0
+
+
+class LdapSync(object):
+    """Apply an ``LdapDirectory`` to users, groups, and group membership.
+
+    Groups found in the directory are created as needed, and their membership is made to match
+    it. Other groups are left alone. Membership changes are applied with set-based inserts and
+    deletes on the mapping table, rather than through the ORM relationship one user at a time.
+    Since that bypasses the session key reset on group changes, the keys of affected users are
+    reset afterwards, in one batched update.
+
+    :param create_users: create users found in the directory that do not exist yet. Otherwise,
+        they are left out of group membership.
+    """
+    def __init__(self, user_cls, group_cls, create_users=True):
+        self.user_cls = user_cls
+        self.group_cls = group_cls
+        self.create_users = create_users
+
+        self.username_key = get_username_key(user_cls)
+        self.username_col = getattr(user_cls, self.username_key)
+        self.username_is_email = isinstance(self.username_col.type, EmailType)
+
+        # the mapping table and its FK column names, as configured on the relationship
+        prop = user_cls.groups.property
+        self.table = prop.secondary
+        self.user_id_col = self.table.c[prop.synchronize_pairs[0][1].key]
+        self.group_id_col = self.table.c[prop.secondary_synchronize_pairs[0][1].key]
+
+    def normalize_username(self, username):
+        return username.lower() if self.username_is_email else username
+
+    def _ids_by_name(self, name_col, names, cls, key, create):
+        ids = {}
+        for chunk in _chunks(names):
+            ids.update(db.session.execute(sa.select(name_col, cls.id).where(
+                name_col.in_(chunk))).all())
+
+        created = 0
+        missing = [name for name in names if name not in ids]
+        if create and missing:
+            for chunk in _chunks(missing):
+                new_ids = db.session.execute(
+                    sa.insert(cls).returning(cls.id, sort_by_parameter_order=True),
+                    [{key: name} for name in chunk],
+                ).scalars().all()
+                ids.update(zip(chunk, new_ids))
+                created += len(chunk)
+        return ids, created
+
+    def user_ids(self, directory, report):
+        usernames = sorted({self.normalize_username(name) for name in directory.users.values()})
+        ids, report.users_created = self._ids_by_name(
+            self.username_col, usernames, self.user_cls, self.username_key, self.create_users)
+        return ids
+
+    def group_ids(self, directory, report):
+        ids, report.groups_created = self._ids_by_name(
+            self.group_cls.name, sorted(directory.groups), self.group_cls, 'name', True)
+        return ids
+
+    def desired_memberships(self, directory, user_ids, group_ids):
+        pairs = set()
+        for name, members in directory.groups.items():
+            for member in members:
+                username = directory.users.get(normalize_dn(member), member)
+                user_id = user_ids.get(self.normalize_username(username))
+                if user_id is not None:
+                    pairs.add((user_id, group_ids[name]))
+        return pairs
+
+    def current_memberships(self, group_ids):
+        pairs = set()
+        for chunk in _chunks(group_ids):
+            pairs.update(db.session.execute(
+                sa.select(self.user_id_col, self.group_id_col).where(
+                    self.group_id_col.in_(chunk))
+            ).all())
+        return pairs
+
+    def apply_memberships(self, to_add, to_remove):
+        for chunk in _chunks(sorted(to_add)):
+            db.session.execute(self.table.insert(), [
+                {self.user_id_col.key: user_id, self.group_id_col.key: group_id}
+                for user_id, group_id in chunk
+            ])
+
+        removed_by_group = collections.defaultdict(list)
+        for user_id, group_id in to_remove:
+            removed_by_group[group_id].append(user_id)
+        for group_id, user_ids in removed_by_group.items():
+            for chunk in _chunks(user_ids):
+                db.session.execute(self.table.delete().where(
+                    self.group_id_col == group_id,
+                    self.user_id_col.in_(chunk),
+                ))
+
+    def reset_session_keys(self, user_ids):
+        """Give each user a new session key. Returns the old keys."""
+        old_keys = []
+        for chunk in _chunks(sorted(user_ids)):
+            rows = db.session.execute(sa.select(self.user_cls.id, self.user_cls.session_key).where(
+                self.user_cls.id.in_(chunk))).all()
+            db.session.execute(sa.update(self.user_cls), [
+                {'id': user_id, 'session_key': _generate_session_key()} for user_id, _ in rows
+            ])
+            old_keys.extend(session_key for _, session_key in rows)
+        return old_keys
+
+    def run(self, directory, dry_run=False):
+        """Apply the directory and commit (or roll back, for a dry run).
+
+        :return: ``LdapSyncReport``
+        """
+        report = LdapSyncReport()
+        user_ids = self.user_ids(directory, report)
+        group_ids = self.group_ids(directory, report)
+
+        desired = self.desired_memberships(directory, user_ids, group_ids)
+        current = self.current_memberships(group_ids.values())
+        to_add, to_remove = desired - current, current - desired
+        self.apply_memberships(to_add, to_remove)
+        report.memberships_added = len(to_add)
+        report.memberships_removed = len(to_remove)
+
+        affected = {user_id for user_id, _ in to_add | to_remove}
+        old_keys = self.reset_session_keys(affected)
+        report.sessions_invalidated = len(old_keys)
+
+        if dry_run:
+            db.session.rollback()
+            return report
+
+        db.session.commit()
+        # the ORM objects in this session still hold the old values
+        db.session.expire_all()
+        auth_manager = flask.current_app.auth_manager
+        for session_key in old_keys:
+            auth_manager.invalidate_session_key(session_key)
+        return report
+
+
+def connect_directory(config):
+    """Connect to the first configured LDAP server that accepts the sync account's bind.
+
+    Raises the last server's ``ldap.LDAPError`` if none did.
+    """
+    urls = tolist(config.get('KEGAUTH_LDAP_SERVER_URL'))
+    if not urls:
+        raise ValueError('No LDAP servers configured (KEGAUTH_LDAP_SERVER_URL)')
+
+    import ldap
+
+    pool = LdapServerPool(
+        urls,
+        pool_size=0,
+        network_timeout=config['KEGAUTH_LDAP_NETWORK_TIMEOUT'],
+        timeout=config['KEGAUTH_LDAP_TIMEOUT'],
+    )
+    error = None
+    for server in pool.ordered_servers():
+        conn = server.connect()
+        try:
+            conn.simple_bind_s(
+                config['KEGAUTH_LDAP_SYNC_BIND_DN'] or '',
+                config['KEGAUTH_LDAP_SYNC_BIND_PASSWORD'] or '',
+            )
+            return conn
+        except ldap.LDAPError as exc:
+            server.discard(conn)
+            error = exc
+    raise error
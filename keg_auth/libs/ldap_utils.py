@@ -0,0 +1,224 @@
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+try:
+    import ldap
+except ImportError:
+    pass  # pragma: no cover
+
+
+class LdapServer(object):
+    """One LDAP server: a pool of idle connections, and its recent health.
+
+    Latency is a moving average of bind round trips. After a failure (server down, timeout), the
+    server is avoided for ``failure_backoff`` seconds, doubling with each consecutive failure.
+    """
+    def __init__(self, url, pool_size=4, network_timeout=5, timeout=10, failure_backoff=30,
+                 max_backoff=600, timer=time.monotonic):
+        self.url = url
+        self.pool_size = pool_size
+        self.network_timeout = network_timeout
+        self.timeout = timeout
+        self.failure_backoff = failure_backoff
+        self.max_backoff = max_backoff
+        self.timer = timer
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+
+    def connect(self):
+        conn = ldap.initialize(self.url)
+        conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.network_timeout)
+        conn.timeout = self.timeout
+        return conn
+
+    def acquire(self):
+        """Return ``(connection, pooled)``, reusing an idle connection when there is one."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self.connect(), False
+
+    def release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        self.discard(conn)
+
+    @staticmethod
+    def discard(conn):
+        try:
+            conn.unbind_s()
+        except Exception:
+            pass
+
+    def record_success(self, elapsed):
+        self.failures = 0
+        self.down_until = 0
+        self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+
+    def record_failure(self):
+        self.failures += 1
+        backoff = min(self.failure_backoff * 2 ** (self.failures - 1), self.max_backoff)
+        self.down_until = self.timer() + backoff
+
+    def is_down(self, now=None):
+        return (now if now is not None else self.timer()) < self.down_until
+
+    def simple_bind(self, dn, password):
+        """Bind as ``dn``. Returns whether the server accepted the credentials.
+
+        Raises ``ldap.LDAPError`` if the server could not give an answer, e.g. it is down or timed
+        out, after recording the failure.
+        """
+        conn, pooled = self.acquire()
+        while True:
+            started = self.timer()
+            try:
+                result = conn.simple_bind_s(dn, password)
+                break
+            except (ldap.INVALID_CREDENTIALS, ldap.INVALID_DN_SYNTAX):
+                self.record_success(self.timer() - started)
+                self.release(conn)
+                return False
+            except ldap.LDAPError:
+                self.discard(conn)
+                if pooled:
+                    # the server may have dropped an idle connection, retry on a new one
+                    conn, pooled = self.connect(), False
+                    continue
+                self.record_failure()
+                raise
+
+        self.record_success(self.timer() - started)
+        self.release(conn)
+        return bool(result and len(result) and result[0] == ldap.RES_BIND)
+
+
+class LdapServerPool(object):
+    """Bind against a set of LDAP servers, preferring those that are up and fast.
+
+    Servers are tried in order of health: servers not backing off from a failure first, by recent
+    latency, then the rest. Ties keep the configured order. With ``parallel``, all servers are
+    tried at once, and the first to accept the credentials wins.
+    """
+    def __init__(self, urls, parallel=False, timer=time.monotonic, **server_kwargs):
+        self.servers = [LdapServer(url, timer=timer, **server_kwargs) for url in urls]
+        self.parallel = parallel
+        self.timer = timer
+        self._executor = None
+
+    def ordered_servers(self):
+        now = self.timer()
+        return sorted(
+            self.servers,
+            key=lambda server: (server.is_down(now), server.latency or 0),
+        )
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.servers), thread_name_prefix='keg-auth-ldap')
+        return self._executor
+
+    def simple_bind(self, dn, password):
+        """Returns True if any server accepts the credentials.
+
+        If no server gave an answer, the last server's error is raised.
+        """
+        if self.parallel and len(self.servers) > 1:
+            return self._parallel_bind(dn, password)
+
+        error = None
+        answered = False
+        for server in self.ordered_servers():
+            try:
+                if server.simple_bind(dn, password):
+                    return True
+                answered = True
+            except ldap.LDAPError as exc:
+                error = exc
+        if error is not None and not answered:
+            raise error
+        return False
+
+    def _parallel_bind(self, dn, password):
+        futures = [
+            self.executor.submit(server.simple_bind, dn, password)
+            for server in self.ordered_servers()
+        ]
+        error = None
+        answered = False
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                if future.result():
+                    # the others finish in the background, returning their connections
+                    return True
+                answered = True
+            except ldap.LDAPError as exc:
+                error = exc
+        if error is not None and not answered:
+            raise error
+        return False
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        for server in self.servers:
+            while server._idle:
+                server.discard(server._idle.pop())
+
+
+def normalize_dn(dn):
+    """Lowercase a DN and drop spaces around separators, so DNs from one directory compare."""
+    return ','.join(part.strip() for part in dn.split(',')).lower()
+
+
+def paged_search(conn, base_dn, filterstr, attrlist=None, page_size=500, scope=None):
+    """Yield ``(dn, attrs)`` for a search, a page at a time with the paged results control.
+
+    Keeps each response within server size limits, and memory flat for large directories.
+    """
+    from ldap.controls import SimplePagedResultsControl
+
+    scope = ldap.SCOPE_SUBTREE if scope is None else scope
+    control = SimplePagedResultsControl(True, size=page_size, cookie='')
+    while True:
+        msgid = conn.search_ext(base_dn, scope, filterstr, attrlist, serverctrls=[control])
+        _, results, _, server_controls = conn.result3(msgid)
+        for dn, attrs in results:
+            # skip search references
+            if dn is not None:
+                yield dn, attrs
+
+        cookies = [
+            ctrl.cookie for ctrl in server_controls
+            if ctrl.controlType == SimplePagedResultsControl.controlType
+        ]
+        if not cookies or not cookies[0]:
+            return
+        control.cookie = cookies[0]
+
+
+def credential_fingerprint(password, rounds=50000, salt=None):
+    """Salted, slow hash of a password that a directory accepted, for caching the result.
+
+    Returns ``(salt, rounds, digest)``, check it with ``check_credential_fingerprint``.
+    """
+    salt = salt or os.urandom(16)
+    return salt, rounds, hashlib.pbkdf2_hmac('sha256', password.encode(), salt, rounds)
+
+
+def check_credential_fingerprint(fingerprint, password):
+    salt, rounds, digest = fingerprint
+    return hmac.compare_digest(credential_fingerprint(password, rounds, salt)[2], digest)
@@ -0,0 +1,201 @@
+import bisect
+import collections
+import datetime
+import typing
+
+import sqlalchemy as sa
+from keg.db import db
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class LockoutPolicy(typing.NamedTuple):
+    limit: int
+    timespan: int
+    lockout: int
+
+
+class LockoutReport(typing.NamedTuple):
+    policy: LockoutPolicy
+    attempts: int
+    blocked: int
+    users: int
+    users_locked_out: int
+    successes_blocked: int
+    attacker_attempts: int
+    attacker_attempts_blocked: int
+
+
+class _AttemptIndex(object):
+    """Attempts that were let through, for one filter value (an input, an IP, or both).
+
+    ``limiting`` holds the times of attempts that count toward the limit, in order.
+    """
+    __slots__ = ('limiting', 'last_success')
+
+    def __init__(self):
+        self.limiting = []
+        self.last_success = None
+
+    def count(self, start, end):
+        """Limiting attempts in ``(start, end]``."""
+        return bisect.bisect_right(self.limiting, end) - bisect.bisect_right(self.limiting, start)
+
+
+class LockoutSimulator(object):
+    """Replay attempt history against a candidate lockout policy, entirely in memory.
+
+    Follows the same steps as ``AttemptLimitMixin.is_attempt_blocked``, without running any
+    per-attempt queries. Attempts are expected as ``(user_input, source_ip, timestamp, success)``
+    tuples (timestamps in seconds), sorted by time.
+
+    - For login and forgot attempts (``success_resets=True``), only failures count toward the
+      limit, and the counting starts over after a success.
+    - For reset attempts, every attempt counts toward the limit.
+    - With ``ip_limit`` (as ``KEGAUTH_ATTEMPT_IP_LIMIT``), attempts count for an input if they
+      were made with that input or from the same source IP.
+
+    Historical attempts made during a lockout were never verified, so they are replayed as
+    failures if the candidate policy would have let them through.
+    """
+    def __init__(self, policy, success_resets=True, ip_limit=False):
+        self.policy = policy
+        self.success_resets = success_resets
+        self.ip_limit = ip_limit
+
+    def replay(self, attempts):
+        """Yield ``(user_input, timestamp, success, blocked)`` for the attempts in time order."""
+        limit, timespan, lockout = self.policy
+        by_input = collections.defaultdict(_AttemptIndex)
+        by_ip = collections.defaultdict(_AttemptIndex)
+        by_both = collections.defaultdict(_AttemptIndex)
+
+        for user_input, source_ip, timestamp, success in attempts:
+            # the live filter is input OR IP: count attempts matching both only once
+            indexes = [(by_input[user_input], 1)]
+            if self.ip_limit and source_ip:
+                indexes += [(by_ip[source_ip], 1), (by_both[user_input, source_ip], -1)]
+
+            last_limiting = max(
+                (index.limiting[-1] for index, _ in indexes if index.limiting), default=None)
+            last_success = max(
+                (index.last_success for index, _ in indexes if index.last_success is not None),
+                default=None,
+            )
+
+            def limiting_count(before):
+                start = before - timespan
+                if self.success_resets and last_success is not None and last_success > start:
+                    start = last_success
+                if start >= before:
+                    return 0
+                return sum(sign * index.count(start, before) for index, sign in indexes)
+
+            if last_limiting is not None and limiting_count(last_limiting) >= limit:
+                # the last limiting attempt caused a lockout, blocked until it has passed
+                blocked = timestamp - last_limiting <= lockout
+            else:
+                blocked = limiting_count(timestamp) >= limit
+
+            if not blocked:
+                for index, _ in indexes:
+                    if success and self.success_resets:
+                        index.last_success = timestamp
+                    else:
+                        index.limiting.append(timestamp)
+
+            yield user_input, timestamp, success, blocked
+
+    def replay_key(self, attempts):
+        """Yield ``(timestamp, success, blocked)`` for one input's ``(timestamp, success)``
+        attempts in time order."""
+        for _, timestamp, success, blocked in self.replay(
+            (None, None, timestamp, success) for timestamp, success in attempts
+        ):
+            yield timestamp, success, blocked
+
+    def run(self, attempts):
+        """Replay the attempts and summarize the effect of the policy.
+
+        Inputs with at least one successful attempt in the history are considered real users.
+        Attempts for inputs that never succeeded are considered attacker attempts.
+        """
+        results = collections.defaultdict(list)
+        for user_input, _, success, blocked in self.replay(attempts):
+            results[user_input].append((success, blocked))
+
+        attempt_count = blocked_count = 0
+        users = users_locked_out = successes_blocked = 0
+        attacker_attempts = attacker_attempts_blocked = 0
+
+        for rows in results.values():
+            blocked = sum(1 for _, is_blocked in rows if is_blocked)
+            attempt_count += len(rows)
+            blocked_count += blocked
+
+            if any(success for success, _ in rows):
+                users += 1
+                users_locked_out += 1 if blocked else 0
+                successes_blocked += sum(
+                    1 for success, is_blocked in rows if success and is_blocked
+                )
+            else:
+                attacker_attempts += len(rows)
+                attacker_attempts_blocked += blocked
+
+        return LockoutReport(
+            policy=self.policy,
+            attempts=attempt_count,
+            blocked=blocked_count,
+            users=users,
+            users_locked_out=users_locked_out,
+            successes_blocked=successes_blocked,
+            attacker_attempts=attacker_attempts,
+            attacker_attempts_blocked=attacker_attempts_blocked,
+        )
+
+
+def load_attempt_history(attempt_ent, attempt_type, since=None, batch_size=10000):
+    """Load attempts of the given type as ``(user_input, source_ip, timestamp, success)``
+    tuples, sorted by time.
+
+    Uses a single ordered query streamed in batches. The datetime column is read as a plain
+    datetime to avoid building Arrow objects for every row.
+
+    :param since: only include attempts on or after this datetime
+    """
+    datetime_col = sa.type_coerce(attempt_ent.datetime_utc, sa.DateTime)
+
+    query = sa.select(
+        attempt_ent.user_input, attempt_ent.source_ip, datetime_col, attempt_ent.success
+    ).where(
+        attempt_ent.attempt_type == attempt_type,
+        attempt_ent.user_input.isnot(None),
+    ).order_by(
+        attempt_ent.datetime_utc, attempt_ent.id,
+    ).execution_options(
+        yield_per=batch_size,
+    )
+    if since is not None:
+        query = query.where(attempt_ent.datetime_utc >= since)
+
+    return [
+        (user_input, source_ip, _to_timestamp(dt), success)
+        for user_input, source_ip, dt, success in db.session.execute(query)
+    ]
+
+
+def _to_timestamp(dt):
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (dt - EPOCH).total_seconds()
+
+
+def simulate_lockout(attempt_ent, attempt_type, policies, ip_limit=False, since=None):
+    """Load attempt history once and return a :class:`LockoutReport` for each policy."""
+    attempts = load_attempt_history(attempt_ent, attempt_type, since=since)
+    success_resets = attempt_type != 'reset'
+    return [
+        LockoutSimulator(policy, success_resets=success_resets, ip_limit=ip_limit).run(attempts)
+        for policy in policies
+    ]
@@ -0,0 +1,127 @@
+import hashlib
+import math
+import threading
+import time
+
+import arrow
+import sqlalchemy as sa
+from keg.db import db
+
+
+class BloomFilter(object):
+    """Fixed-size probabilistic set of strings.
+
+    Membership tests may give false positives (at about ``error_rate`` once ``capacity`` items
+    are added) but never false negatives. Items cannot be removed, build a new filter instead.
+    """
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        # double hashing: k positions derived from two 64-bit halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & 1 << (position & 7)
+                   for position in self._positions(item))
+
+
+class RevocationStore(object):
+    """In-memory set of revoked token IDs (JWT ``jti``), each kept until its token expires.
+
+    A Bloom filter sits in front of the set, so checking a token that is not revoked (by far the
+    common case) costs a few hash probes. Expired entries are dropped, and the filter rebuilt, once
+    the earliest expiry has passed. That is checked on each revocation and on each filter hit, so
+    it does not depend on syncing.
+
+    Revocations from other processes are picked up with ``sync``, from the entity registered as
+    ``revoked_token``.
+    """
+    def __init__(self, capacity=100000, error_rate=0.001, sync_interval=30, timer=time.time):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.timer = timer
+        self._revoked = {}
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._next_expiry = math.inf
+        self._next_sync = 0
+        self._synced_utc = None
+        self._lock = threading.Lock()
+
+    def add(self, jti, expires=None):
+        """Revoke ``jti`` until ``expires`` (a timestamp, None for tokens that never expire)."""
+        expires = math.inf if expires is None else expires
+        now = self.timer()
+        if self._next_expiry <= now:
+            self.prune()
+        if expires <= now:
+            return
+        with self._lock:
+            self._revoked[jti] = max(expires, self._revoked.get(jti, expires))
+            self._bloom.add(jti)
+            self._next_expiry = min(self._next_expiry, expires)
+
+    def is_revoked(self, jti):
+        if jti is None or jti not in self._bloom:
+            return False
+        now = self.timer()
+        if self._next_expiry <= now:
+            self.prune()
+        expires = self._revoked.get(jti)
+        return expires is not None and expires > now
+
+    def prune(self):
+        """Drop expired entries, rebuilding the Bloom filter from those left."""
+        now = self.timer()
+        with self._lock:
+            if self._next_expiry > now:
+                return
+            revoked = {jti: exp for jti, exp in self._revoked.items() if exp > now}
+            # fill the new filter before swapping it in, concurrent checks read without the lock
+            bloom = BloomFilter(self.capacity, self.error_rate)
+            for jti in revoked:
+                bloom.add(jti)
+            self._revoked, self._bloom = revoked, bloom
+            self._next_expiry = min(self._revoked.values(), default=math.inf)
+
+    def sync(self, revoked_token_cls, force=False):
+        """Load revocations recorded since the last sync, at most every ``sync_interval`` seconds.
+
+        Each sync reaches back an extra interval, so rows committed late (or stamped by a
+        slightly different clock) are not missed. Loading a row twice is harmless.
+        """
+        now = self.timer()
+        if not force and now < self._next_sync:
+            return
+        self._next_sync = now + self.sync_interval
+
+        started_utc = arrow.utcnow()
+        query = sa.select(revoked_token_cls.jti, revoked_token_cls.expires_utc).where(
+            sa.or_(
+                revoked_token_cls.expires_utc.is_(None),
+                revoked_token_cls.expires_utc > started_utc,
+            )
+        )
+        if self._synced_utc is not None:
+            query = query.where(revoked_token_cls.revoked_utc
+                                >= self._synced_utc.shift(seconds=-self.sync_interval))
+
+        for jti, expires_utc in db.session.execute(query):
+            self.add(jti, None if expires_utc is None else expires_utc.timestamp())
+        self._synced_utc = started_utc
+        self.prune()
+
+    def __len__(self):
+        return len(self._revoked)
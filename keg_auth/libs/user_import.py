@@ -0,0 +1,263 @@
+import concurrent.futures
+import csv
+import json
+
+import sqlalchemy as sa
+from keg.db import db
+from sqlalchemy_utils import EmailType
+
+from keg_auth.libs.hashing import hash_many
+from keg_auth.model import KAPassword, get_username_key
+
+# CSV cells holding several group/bundle names separate them with this
+LIST_SEPARATOR = ';'
+
+TRUE_STRINGS = {'1', 'true', 't', 'yes', 'y'}
+FALSE_STRINGS = {'0', 'false', 'f', 'no', 'n'}
+
+
+class UserImportError(Exception):
+    pass
+
+
+class UserImportReport(object):
+    """Running totals for an import, passed to the progress callback after each batch.
+
+    ``last_line`` is the last input line handled in a committed batch. Since users that already
+    exist are skipped, an interrupted import can simply be run again to pick up where it left off.
+    """
+    def __init__(self):
+        self.processed = 0
+        self.created = 0
+        self.skipped = 0
+        self.mailed = 0
+        self.errors = []
+        self.last_line = 0
+
+
+def read_user_records(stream, format='csv'):
+    """Stream ``(line number, record)`` pairs from CSV (with a header row) or JSON lines input.
+
+    Empty CSV cells are dropped, so the column defaults apply.
+    """
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, {
+                key: value for key, value in record.items() if value not in (None, '')
+            }
+    elif format == 'jsonl':
+        for line_num, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise UserImportError(f'Line {line_num}: invalid JSON')
+            if not isinstance(record, dict):
+                raise UserImportError(f'Line {line_num}: expected a JSON object')
+            yield line_num, record
+    else:
+        raise ValueError(f'Unknown import format: {format}')
+
+
+class UserImporter(object):
+    """Create users in bulk from a stream of records.
+
+    Records are dicts of user column values, plus these special keys:
+
+    - ``username``: may be used in place of the username column (e.g. ``email``)
+    - ``password``: hashed in a process pool. Users without one get no password (which can never
+      match at login) and are expected to set theirs through the verification mail.
+    - ``groups``, ``bundles``: names to assign, as a list or a ``;``-separated string
+
+    Each batch of users is inserted in a single statement (with their group and bundle mappings)
+    and committed, unlike ``AuthManager.create_user``, which flushes one user at a time.
+
+    :param batch_size: number of records per insert/commit
+    :param workers: processes for password hashing. None uses the CPU count, 0 hashes inline.
+    :param mail_manager: when given, new users are sent the new user mail once their batch is
+        committed, same as ``create_user`` (including skipping excluded domains)
+    :param is_domain_excluded: callable taking a username, for skipping mail
+    """
+    def __init__(self, user_cls, group_cls=None, bundle_cls=None, batch_size=1000, workers=None,
+                 mail_manager=None, is_domain_excluded=None):
+        self.user_cls = user_cls
+        self.batch_size = batch_size
+        self.workers = workers
+        self.mail_manager = mail_manager
+        self.is_domain_excluded = is_domain_excluded or (lambda username: False)
+        self._executor = None
+
+        self.username_key = get_username_key(user_cls)
+        username_type = getattr(user_cls, self.username_key).type
+        self.username_is_email = isinstance(username_type, EmailType)
+        self.column_types = {
+            attr.key: attr.columns[0].type for attr in sa.inspect(user_cls).column_attrs
+        }
+
+        self.mappings = {}
+        for key, related_cls in (('groups', group_cls), ('bundles', bundle_cls)):
+            if related_cls is not None and hasattr(user_cls, key):
+                self.mappings[key] = self._mapping_info(getattr(user_cls, key), related_cls)
+
+    @staticmethod
+    def _mapping_info(relationship_attr, related_cls):
+        # the secondary table and its FK column names, as configured on the relationship
+        prop = relationship_attr.property
+        names = dict(db.session.execute(sa.select(related_cls.name, related_cls.id)).all())
+        return (
+            prop.secondary,
+            prop.synchronize_pairs[0][1].key,
+            prop.secondary_synchronize_pairs[0][1].key,
+            names,
+        )
+
+    def normalize_username(self, username):
+        # email columns are stored lowercased, compare the same way when looking for duplicates
+        return username.lower() if self.username_is_email else username
+
+    def coerce_value(self, key, value):
+        if isinstance(self.column_types[key], sa.Boolean) and isinstance(value, str):
+            if value.lower() in TRUE_STRINGS:
+                return True
+            if value.lower() in FALSE_STRINGS:
+                return False
+            raise UserImportError(f'Invalid value for {key}: {value}')
+        return value
+
+    def prepare(self, record):
+        """Split a record into user column values, password, and mapping names."""
+        record = dict(record)
+        if 'username' in record and self.username_key != 'username':
+            record.setdefault(self.username_key, record.pop('username'))
+        if not record.get(self.username_key):
+            raise UserImportError(f'Missing {self.username_key}')
+
+        password = record.pop('password', None)
+
+        related = {}
+        for key in ('groups', 'bundles'):
+            names = record.pop(key, None) or []
+            if isinstance(names, str):
+                names = [name.strip() for name in names.split(LIST_SEPARATOR) if name.strip()]
+            if names and key not in self.mappings:
+                raise UserImportError(f'Cannot assign {key}')
+            if names:
+                lookup = self.mappings[key][3]
+                unknown = [name for name in names if name not in lookup]
+                if unknown:
+                    raise UserImportError(f'Unknown {key}: {", ".join(unknown)}')
+                related[key] = [lookup[name] for name in names]
+
+        unknown = sorted(set(record) - set(self.column_types))
+        if unknown:
+            raise UserImportError(f'Unknown fields: {", ".join(unknown)}')
+        values = {key: self.coerce_value(key, value) for key, value in record.items()}
+
+        return values, password, related
+
+    def existing_usernames(self, usernames):
+        username_col = getattr(self.user_cls, self.username_key)
+        query = sa.select(username_col).where(username_col.in_(usernames))
+        return {self.normalize_username(name) for name in db.session.execute(query).scalars()}
+
+    @property
+    def executor(self):
+        # started on first use, so imports without passwords never spin up worker processes
+        if self._executor is None and self.workers != 0:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def import_batch(self, batch, report):
+        existing = self.existing_usernames([values[self.username_key] for _, values, _, _ in batch])
+        rows = []
+        for line, values, password, related in batch:
+            username = self.normalize_username(values[self.username_key])
+            if username in existing:
+                report.skipped += 1
+                continue
+            # duplicates within the input are skipped just like existing users
+            existing.add(username)
+            rows.append((line, values, password, related))
+
+        if rows:
+            with_password = [row for row in rows if row[2] is not None]
+            context = self.user_cls.password.type.context
+            hashes = hash_many(
+                context,
+                [row[2] for row in with_password],
+                executor=self.executor if with_password else None,
+            )
+            for (_, values, _, _), hash in zip(with_password, hashes):
+                values['password'] = KAPassword(hash)
+
+            user_ids = db.session.execute(
+                sa.insert(self.user_cls).returning(self.user_cls.id, sort_by_parameter_order=True),
+                [values for _, values, _, _ in rows],
+            ).scalars().all()
+
+            for key, (table, user_col, related_col, _) in self.mappings.items():
+                mapping_rows = [
+                    {user_col: user_id, related_col: related_id}
+                    for user_id, (_, _, _, related) in zip(user_ids, rows)
+                    for related_id in related.get(key, ())
+                ]
+                if mapping_rows:
+                    db.session.execute(table.insert(), mapping_rows)
+
+        db.session.commit()
+        report.created += len(rows)
+
+        if rows and self.mail_manager:
+            self.send_mail(dict(zip(user_ids, (line for line, _, _, _ in rows))), report)
+
+    def send_mail(self, lines_by_id, report):
+        users = self.user_cls.query.filter(self.user_cls.id.in_(lines_by_id))
+        for user in users:
+            if self.is_domain_excluded(user.username):
+                continue
+            user.token_generate()
+            try:
+                self.mail_manager.send_new_user(user)
+            except Exception as exc:
+                # the user is already committed, one bad address should not stop the import
+                report.errors.append((lines_by_id[user.id], f'Mail not sent: {exc}'))
+            else:
+                report.mailed += 1
+
+    def run(self, records, progress=None):
+        """Import ``(line number, record)`` pairs, e.g. from ``read_user_records``.
+
+        :param progress: callable receiving the ``UserImportReport`` after each batch
+        """
+        report = UserImportReport()
+        line = None
+        try:
+            batch = []
+            for line, record in records:
+                report.processed += 1
+                try:
+                    batch.append((line, *self.prepare(record)))
+                except UserImportError as exc:
+                    report.errors.append((line, str(exc)))
+
+                if len(batch) >= self.batch_size:
+                    self.import_batch(batch, report)
+                    batch = []
+                    report.last_line = line
+                    if progress:
+                        progress(report)
+
+            if batch:
+                self.import_batch(batch, report)
+            if line is not None and line != report.last_line:
+                report.last_line = line
+                if progress:
+                    progress(report)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+        return report
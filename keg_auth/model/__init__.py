@@ -1,7 +1,9 @@
 import base64
 import binascii
 import hashlib
+import hmac
 import json
+import secrets
 import time
 
 import arrow
@@ -21,10 +23,13 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy_utils import (
     ArrowType,
     EmailType,
+    Password,
     PasswordType,
     force_auto_coercion,
 )
 
+from keg_auth.libs.caching import get_credential_cache
+from keg_auth.libs.hashing import get_hashing_service
 from keg_auth.model.types import AttemptType
 from keg_auth.model.utils import generate_password
 
@@ -47,16 +52,117 @@ def _generate_session_key():
     return str(shortuuid.uuid())
 
 
+def _token_signing_key(salt, secret_key, digest_method):
+    return digest_method((salt + 'signer' + secret_key).encode()).digest()
+
+
+def _get_token_header(token):
+    """Parse a JWT's header without verifying it, None if it is malformed."""
+    try:
+        segment = token.split(b'.', 1)[0]
+        header = json.loads(base64.urlsafe_b64decode(segment + b'=' * (-len(segment) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+    return header if isinstance(header, dict) else None
+
+
 class InvalidToken(Exception):
     pass
 
 
+class KAPassword(Password):
+    """Password value that verifies through the app's hashing service, if one is enabled."""
+    @classmethod
+    def coerce(cls, key, value):
+        if isinstance(value, Password) and not isinstance(value, KAPassword):
+            # sqlalchemy_utils coerces to its own Password type for all PasswordType columns
+            if value.secret is not None:
+                return cls(value.secret, secret=True)
+            password = cls(value.hash)
+            password.context = value.context
+            return password
+        return super().coerce(key, value)
+
+    def __eq__(self, value):
+        if self.hash is None or self.context is None or not isinstance(value, (str, bytes)):
+            return super().__eq__(value)
+
+        # Plain verification: unlike sqlalchemy_utils, comparing never replaces the stored hash.
+        # Rehashing outdated hashes is done by the login authenticator via verify_and_update.
+        service = get_hashing_service()
+        if service is None:
+            return self.context.verify(value, self.hash)
+        return service.verify(self.context, value, self.hash)
+
+    def verify_and_update(self, secret):
+        """Verify ``secret``, and rehash it if the stored hash is outdated.
+
+        Returns ``(valid, new_hash)``, where ``new_hash`` is None unless the crypt context
+        marks the stored hash as needing an update (deprecated scheme, changed rounds, etc.).
+        """
+        service = get_hashing_service()
+        if service is None:
+            return self.context.verify_and_update(secret, self.hash)
+        return service.verify_and_update(self.context, secret, self.hash)
+
+
 class KAPasswordType(PasswordType):
+    """Password column type using the app's shared CryptContext.
+
+    Columns set up with the default ``onload=_create_cryptcontext_kwargs`` get their context from
+    ``AuthManager.get_crypt_context``, so all password and token columns share one compiled
+    context per app, which follows ``PASSLIB_CRYPTCONTEXT_KWARGS`` as it changes. Outside of an
+    app context, or with other context kwargs, the column's own lazy context is used.
+    """
+    def __init__(self, max_length=None, **kwargs):
+        self._context = None
+        self._app_context_kwargs = None
+        super().__init__(max_length=max_length, **kwargs)
+
+        if kwargs.get('onload') is _create_cryptcontext_kwargs:
+            self._app_context_kwargs = {
+                key: value for key, value in kwargs.items() if key != 'onload'
+            }
+            self._fallback_context = self._context
+            self._context = None
+
+    @property
+    def context(self):
+        # a context assigned directly (e.g. by tests) takes precedence
+        if self._context is not None:
+            return self._context
+
+        if flask.has_app_context() and hasattr(flask.current_app, 'auth_manager'):
+            return flask.current_app.auth_manager.get_crypt_context(**self._app_context_kwargs)
+        return self._fallback_context
+
+    @context.setter
+    def context(self, value):
+        self._context = value
+
     def load_dialect_impl(self, dialect):
         if dialect.name == 'mssql':
             return mssql.VARCHAR(self.length)
         return super(KAPasswordType, self).load_dialect_impl(dialect)
 
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            return KAPassword(value, self.context)
+
+    def _hash(self, value):
+        service = get_hashing_service()
+        if service is None:
+            return super()._hash(value)
+        return service.hash(self.context, value)
+
+    def _coerce(self, value):
+        if value is not None and not isinstance(value, Password):
+            return KAPassword(self._hash(value).encode('utf8'), context=self.context)
+        return super()._coerce(value)
+
+
+KAPassword.associate_with(KAPasswordType)
+
 
 class UserMixin(object):
     """Generic mixin for user entities."""
@@ -115,8 +221,14 @@ class UserMixin(object):
         return str(self.session_key)
 
     def reset_session_key(self):
+        old_session_key = self.session_key
         self.session_key = _generate_session_key()
 
+        if old_session_key and flask.has_app_context():
+            auth_manager = getattr(flask.current_app, 'auth_manager', None)
+            if auth_manager is not None:
+                auth_manager.invalidate_session_key(old_session_key)
+
     @property
     def display_value(self):
         # shortcut to return the value of the user ident attribute
@@ -255,20 +367,40 @@ class UserMixin(object):
 
         :return: JSON string of list containing the values listed above
         """
+        display_value, is_active, password_hash, last_login_utc = self.get_token_salt_values()
         return json.dumps([
-            self.display_value,
-            str(self.is_active),
-            self.password.hash.decode() if self.password is not None else '',
-            self.last_login_utc.to('UTC').isoformat() if self.last_login_utc else None
+            display_value,
+            str(is_active),
+            password_hash.decode() if password_hash is not None else '',
+            last_login_utc.to('UTC').isoformat() if last_login_utc else None
         ])
 
-    def get_token_signature(self, digest_method=hashlib.sha512):
-        base_key = (
-            self.get_token_salt()
-            + 'signer'
-            + flask.current_app.config.get('SECRET_KEY')
+    def get_token_salt_values(self):
+        """The raw user state serialized by ``get_token_salt``."""
+        return (
+            self.display_value,
+            self.is_active,
+            self.password.hash if self.password is not None else None,
+            self.last_login_utc,
         )
-        return digest_method(base_key.encode()).digest()
+
+    def get_token_signature(self, digest_method=hashlib.sha512):
+        secret_key = flask.current_app.config.get('SECRET_KEY')
+        if type(self).get_token_salt is not UserMixin.get_token_salt:
+            # an app's own salt may depend on anything, so it is computed every time
+            return _token_signing_key(self.get_token_salt(), secret_key, digest_method)
+
+        # Kept on the instance, and only reused while the state the salt captures (and the
+        # secret) is unchanged. That skips serializing the salt and hashing it again.
+        state = (self.get_token_salt_values(), secret_key)
+        signing_keys = self.__dict__.setdefault('_token_signing_keys', {})
+        cached = signing_keys.get(digest_method)
+        if cached is None or cached[0] != state:
+            cached = signing_keys[digest_method] = (
+                state,
+                _token_signing_key(self.get_token_salt(), secret_key, digest_method),
+            )
+        return cached[1]
 
     def get_token_payload(self, payload, expires_in):
         now = int(time.time())
@@ -302,9 +434,21 @@ class UserMixin(object):
         - digest_method was supposed to be sha512, but due to a bug in ID it fell back to SHA1
         - iat/exp claims were in the header generated by ID, not the payload
 
-        If we need to fall back to legacy mode due to sha512 not matching signature, we can
-        assume that the token was generated by ID (or by a test mimicing it).
+        The iat/exp header claims tell the two apart, so each token is decoded only once, in the
+        mode it was generated for. Legacy tokens can be refused outright by turning off
+        KEGAUTH_TOKEN_LEGACY_ENABLED.
         """
+        if not _use_legacy:
+            header = _get_token_header(token)
+            if header is None:
+                return False
+            _use_legacy = 'iat' in header or 'exp' in header
+            if _use_legacy and (
+                _block_legacy
+                or not flask.current_app.config.get('KEGAUTH_TOKEN_LEGACY_ENABLED', True)
+            ):
+                return False
+
         digest_method = hashlib.sha512 if not _use_legacy else hashlib.sha1
 
         try:
@@ -315,14 +459,10 @@ class UserMixin(object):
             payload.validate()
         except (
             jose.errors.DecodeError,
-            jose.errors.ExpiredTokenError
+            jose.errors.ExpiredTokenError,
+            jose.errors.BadSignatureError,
         ):
             return False
-        except jose.errors.BadSignatureError:
-            if not _use_legacy and not _block_legacy:
-                # bad sig could mean it's an itsdangerous token, try legacy mode
-                return self.token_verify(token, _use_legacy=True)
-            return False
 
         # authlib treats iat/exp claims as optional. We need to make sure they were in
         # the payload, and fail if not
@@ -331,6 +471,10 @@ class UserMixin(object):
 
         return payload['user_id'] == self.id
 
+    def token_encode(self, payload):
+        """Sign a token payload (see ``get_token_payload``) for this user."""
+        return jose.jwt.encode({'alg': 'HS512'}, payload, self.get_token_signature()).decode()
+
     def token_generate(self):
         """
         Create a new token for this user. The returned value is an expiring JWT
@@ -342,8 +486,7 @@ class UserMixin(object):
             {'user_id': self.id},
             flask.current_app.config['KEGAUTH_TOKEN_EXPIRE_MINS'] * 60
         )
-        header = {'alg': 'HS512'}
-        token = jose.jwt.encode(header, payload, self.get_token_signature()).decode()
+        token = self.token_encode(payload)
 
         # Store the plain text version on this instance for ease of use.  It will not get
         # pesisted to the db, so no security conern.
@@ -352,10 +495,33 @@ class UserMixin(object):
         return token
 
 
+API_KEY_PREFIX = 'kak'
+REFRESH_TOKEN_PREFIX = 'krt'
+
+
+def api_key_digest(secret):
+    """HMAC-SHA256 of an API key secret, keyed with the server's pepper.
+
+    API key secrets are long random strings, so unlike passwords, they need no slow hash to resist
+    guessing. Keying the digest with a pepper kept out of the database means a leaked table alone is
+    not enough to check candidate keys.
+    """
+    config = flask.current_app.config
+    pepper = config.get('KEGAUTH_API_TOKEN_PEPPER') or config['SECRET_KEY']
+    if isinstance(pepper, str):
+        pepper = pepper.encode()
+    return hmac.new(pepper, secret.encode(), hashlib.sha256).hexdigest()
+
+
 class UserTokenMixin(object):
     """Mixin for users who will be authenticated by tokens."""
     token = sa.Column(KAPasswordType(onload=_create_cryptcontext_kwargs))
 
+    # API keys (see generate_api_key) are looked up by their public ID, and the secret checked
+    # against a keyed digest
+    api_key_id = sa.Column(sa.Unicode(32), unique=True, nullable=True)
+    api_key_digest = sa.Column(sa.Unicode(64), nullable=True)
+
     @classmethod
     def generate_raw_auth_token(cls, length=32):
         """Return a raw authentication token
@@ -366,14 +532,70 @@ class UserTokenMixin(object):
         """
         return generate_password(length)
 
+    @classmethod
+    def get_user_for_api_key(cls, api_key):
+        """Look up the user for an API key from ``generate_api_key``.
+
+        Costs one indexed query and a HMAC, no matter how slow the password hash scheme is.
+        """
+        parts = api_key.split('.')
+        if len(parts) != 3 or parts[0] != API_KEY_PREFIX:
+            return
+
+        _, key_id, secret = parts
+        user = cls.query.filter_by(api_key_id=key_id).one_or_none()
+        if user is None or not user.api_key_digest:
+            return
+        if not hmac.compare_digest(user.api_key_digest, api_key_digest(secret)):
+            return
+        return user
+
     @classmethod
     def get_user_for_api_token(cls, api_token):
+        """Look up the user for an API key, or a legacy email/token API token.
+
+        Legacy tokens (from ``generate_api_token``) need a full password hash verify, and are only
+        accepted while ``KEGAUTH_API_TOKEN_LEGACY_ENABLED`` is set.
+
+        Tokens that verify are remembered in the credential cache (keyed by a digest, never the
+        token itself). A repeat request then costs a primary key lookup, and the cached entry is
+        only honored while the user's token, API key, and session key are unchanged.
+        """
         if api_token is None:
             return
 
         if isinstance(api_token, bytes):
             api_token = api_token.decode()
 
+        is_api_key = api_token.startswith(API_KEY_PREFIX + '.')
+        if not is_api_key and not flask.current_app.config.get(
+            'KEGAUTH_API_TOKEN_LEGACY_ENABLED', True
+        ):
+            return
+
+        cache = get_credential_cache()
+        if cache is None:
+            return cls._verify_api_token(api_token, is_api_key)
+
+        cache_key = api_key_digest(api_token)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            user_id, credential_state = cached
+            user = db.session.get(cls, user_id)
+            if user is not None and user.get_credential_state() == credential_state:
+                return user
+            cache.pop(cache_key)
+
+        user = cls._verify_api_token(api_token, is_api_key)
+        if user is not None:
+            cache.set(cache_key, (user.id, user.get_credential_state()))
+        return user
+
+    @classmethod
+    def _verify_api_token(cls, api_token, is_api_key):
+        if is_api_key:
+            return cls.get_user_for_api_key(api_token)
+
         if len(api_token.split('.')) != 2:
             return
 
@@ -389,21 +611,57 @@ class UserTokenMixin(object):
         else:
             return user
 
+    def get_credential_state(self):
+        """Values that, when changed, invalidate cached verifications of this user's tokens."""
+        return (
+            getattr(self, 'session_key', None),
+            self.token.hash if self.token is not None else None,
+            self.api_key_digest,
+        )
+
+    def invalidate_credential_cache(self):
+        cache = get_credential_cache()
+        if cache is not None:
+            cache.discard_where(lambda cached: cached[0] == self.id)
+
     def reset_auth_token(self, **kwargs):
         """Reset the authentication token for this user
 
         Takes the same parameter as `:cls:generate_auth_token`
         """
         self.token = raw = self.generate_raw_auth_token(**kwargs)
+        self.invalidate_credential_cache()
         return raw
 
+    def reset_session_key(self):
+        super().reset_session_key()
+        self.invalidate_credential_cache()
+
     def verify_token(self, token):
         if not token or not self.token:
             return False
 
         return self.token.context.verify(token, self.token.hash)
 
+    def generate_api_key(self):
+        """Issue a new API key, replacing any previous one, and return it.
+
+        The key has the form ``kak.<key id>.<secret>``. Only the key ID and a digest of the secret
+        are stored, so the returned value cannot be recovered later.
+        """
+        secret = secrets.token_urlsafe(32)
+        self.api_key_id = secrets.token_hex(8)
+        self.api_key_digest = api_key_digest(secret)
+        self.invalidate_credential_cache()
+        return '.'.join((API_KEY_PREFIX, self.api_key_id, secret))
+
+    def clear_api_key(self):
+        self.api_key_id = None
+        self.api_key_digest = None
+        self.invalidate_credential_cache()
+
     def generate_api_token(self, token=None):
+        """Legacy email/token API token, prefer ``generate_api_key``."""
         raw_token = token or self.reset_auth_token()
 
         url_safe_email = base64.urlsafe_b64encode(self.email.encode()).decode()
@@ -566,6 +824,121 @@ class AttemptMixin(object):
         return count
 
 
+class RevokedTokenMixin(object):
+    """Generic mixin for recording revoked JWTs, so all app processes honor a revocation."""
+    # JWT ID (the jti claim)
+    jti = sa.Column(sa.Unicode(255), nullable=False, unique=True)
+
+    # when the token would have expired anyway, null for tokens without an expiry
+    expires_utc = sa.Column(ArrowType, nullable=True)
+    revoked_utc = sa.Column(ArrowType, nullable=False, default=arrow.utcnow,
+                            server_default=dbutils.utcnow())
+
+    @classmethod
+    def revoke(cls, jti, expires_utc=None):
+        """Record a revocation, if the token is not already revoked."""
+        if cls.query.filter_by(jti=jti).count():
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.add(cls(jti=jti, expires_utc=expires_utc))
+        except sa.exc.IntegrityError:
+            # revoked concurrently, by another request or process
+            pass
+        db.session.commit()
+
+    @classmethod
+    def purge_expired(cls):
+        """Delete revocations of tokens that have since expired."""
+        count = cls.query.filter(cls.expires_utc < arrow.utcnow()).delete()
+        db.session.commit()
+        return count
+
+
+class RefreshTokenMixin(object):
+    """Generic mixin for rotating refresh tokens, see ``JwtRequestLoader.create_refresh_token``.
+
+    Tokens have the form ``krt.<token id>.<secret>``, and are looked up by the indexed token ID.
+    Each token can be exchanged once. A token presented again was copied, so every token
+    descending from the same login (its family) is revoked.
+    """
+    token_id = sa.Column(sa.Unicode(32), nullable=False, unique=True)
+    digest = sa.Column(sa.Unicode(64), nullable=False)
+    family_id = sa.Column(sa.Unicode(32), nullable=False, index=True)
+    user_id = sa.Column(sa.Integer, nullable=False, index=True)
+    expires_utc = sa.Column(ArrowType, nullable=False)
+    used_utc = sa.Column(ArrowType, nullable=True)
+    revoked_utc = sa.Column(ArrowType, nullable=True)
+
+    @classmethod
+    def issue(cls, user_id, expires_utc, family_id=None):
+        """Add a token to the session (without committing) and return it with its plain value."""
+        secret = secrets.token_urlsafe(32)
+        record = cls(
+            token_id=secrets.token_hex(16),
+            digest=api_key_digest(secret),
+            family_id=family_id or secrets.token_hex(16),
+            user_id=user_id,
+            expires_utc=expires_utc,
+        )
+        db.session.add(record)
+        return record, '.'.join((REFRESH_TOKEN_PREFIX, record.token_id, secret))
+
+    @classmethod
+    def rotate(cls, token, expires_utc):
+        """Exchange a token for a new one in its family.
+
+        Returns ``(user ID, new token)``, or None if the token is not valid. The token's row is
+        locked until commit, so concurrent exchanges of one token cannot both succeed.
+        """
+        try:
+            prefix, token_id, secret = token.split('.')
+        except (AttributeError, ValueError):
+            return None
+        if prefix != REFRESH_TOKEN_PREFIX:
+            return None
+
+        record = cls.query.filter_by(token_id=token_id).with_for_update().one_or_none()
+        if record is None or not hmac.compare_digest(record.digest, api_key_digest(secret)):
+            return None
+
+        now = arrow.utcnow()
+        if record.revoked_utc is not None or record.expires_utc <= now:
+            return None
+        if record.used_utc is not None:
+            cls.revoke_family(record.family_id)
+            return None
+
+        record.used_utc = now
+        _, new_token = cls.issue(record.user_id, expires_utc, family_id=record.family_id)
+        db.session.commit()
+        return record.user_id, new_token
+
+    @classmethod
+    def _revoke(cls, *criteria):
+        count = cls.query.filter(cls.revoked_utc.is_(None), *criteria).update(
+            {cls.revoked_utc: arrow.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        return count
+
+    @classmethod
+    def revoke_family(cls, family_id):
+        """Revoke all tokens descending from one login."""
+        return cls._revoke(cls.family_id == family_id)
+
+    @classmethod
+    def revoke_user(cls, user_id):
+        """Revoke all of a user's tokens, e.g. to log them out of every API client."""
+        return cls._revoke(cls.user_id == user_id)
+
+    @classmethod
+    def purge_expired(cls):
+        """Delete expired tokens."""
+        count = cls.query.filter(cls.expires_utc < arrow.utcnow()).delete()
+        db.session.commit()
+        return count
+
+
 def get_username(user):
     """Based on the registered user entity, find the column representing the login ID."""
     user_cls = registry().get_entity_cls('user')
@@ -29,12 +29,15 @@ class EntityRegistry(object):
 
         registry.user_cls
     """
-    def __init__(self, user=None, permission=None, bundle=None, group=None, attempt=None):
+    def __init__(self, user=None, permission=None, bundle=None, group=None, attempt=None,
+                 revoked_token=None, refresh_token=None):
         self._user_cls = user
         self._permission_cls = permission
         self._bundle_cls = bundle
         self._group_cls = group
         self._attempt_cls = attempt
+        self._revoked_token_cls = revoked_token
+        self._refresh_token_cls = refresh_token
 
     def _type_to_attr(self, type):
         return '_{}_cls'.format(type)
@@ -72,6 +75,14 @@ class EntityRegistry(object):
         """Mark given class as the entity for Attempt."""
         return self.register_entity('attempt', cls)
 
+    def register_revoked_token(self, cls):
+        """Mark given class as the entity for RevokedToken."""
+        return self.register_entity('revoked_token', cls)
+
+    def register_refresh_token(self, cls):
+        """Mark given class as the entity for RefreshToken."""
+        return self.register_entity('refresh_token', cls)
+
     def get_entity_cls(self, type):
         attr = self._type_to_attr(type)
         try:
@@ -108,6 +119,16 @@ class EntityRegistry(object):
         """Return the entity registered for Attempt."""
         return self.get_entity_cls('attempt')
 
+    @property
+    def revoked_token_cls(self):
+        """Return the entity registered for RevokedToken."""
+        return self.get_entity_cls('revoked_token')
+
+    @property
+    def refresh_token_cls(self):
+        """Return the entity registered for RefreshToken."""
+        return self.get_entity_cls('refresh_token')
+
     def is_registered(self, type):
         """Helper for determining if functionality is unlocked via a registered entity."""
         attr = self._type_to_attr(type)
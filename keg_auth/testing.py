@@ -1263,14 +1263,17 @@ def with_crypto_context(field, context=None):
 
     @wrapt.decorator
     def wrapper(wrapped, instance, args, kwargs):
-        prev_context = field.type.context
+        # KAPasswordType resolves the app's shared context unless one is assigned, so restore the
+        # assigned value rather than the resolved one
+        prev_context = getattr(field.type, '_context', field.type.context)
         field.type.context = (
             context or passlib.context.CryptContext(schemes=keg_auth.core.DEFAULT_CRYPTO_SCHEMES)
         )
 
-        wrapped(*args, **kwargs)
-
-        field.type.context = prev_context
+        try:
+            wrapped(*args, **kwargs)
+        finally:
+            field.type.context = prev_context
 
     return wrapper
 
@@ -1,8 +1,14 @@
 from unittest import mock
 
 import flask
+from passlib.context import CryptContext
 from keg_auth.core import AuthManager
-from keg_auth.libs.authenticators import JwtRequestLoader, KegAuthenticator, OAuthAuthenticator
+from keg_auth.libs.authenticators import (
+    JwtRequestLoader,
+    KegAuthenticator,
+    OAuthAuthenticator,
+    RequestLoader,
+)
 from keg_auth.tests.utils import CustomOAuthAuthenticator, oauth_profile
 
 from keg_auth_ta.app import mail_ext
@@ -117,6 +123,41 @@ class TestAuthManager(object):
         assert isinstance(manager.login_authenticator, KegAuthenticator)
         assert isinstance(manager.get_request_loader('jwt'), JwtRequestLoader)
 
+    def test_resolve_request_loader(self):
+        class CustomRequestLoader(RequestLoader):
+            pass
+
+        jwt_loader = self.am.get_request_loader('jwt')
+        assert self.am.resolve_request_loader(JwtRequestLoader) is jwt_loader
+        assert self.am.resolve_request_loader(jwt_loader) is jwt_loader
+
+        with mock.patch.object(
+            CustomRequestLoader, '__init__', autospec=True, return_value=None,
+        ) as m_init:
+            loader = self.am.resolve_request_loader(CustomRequestLoader)
+            assert isinstance(loader, CustomRequestLoader)
+            assert self.am.resolve_request_loader(CustomRequestLoader) is loader
+        m_init.assert_called_once_with(loader, flask.current_app)
+
+    def test_resolve_request_loader_per_app(self):
+        class CustomRequestLoader(RequestLoader):
+            pass
+
+        other_app = flask.Flask(__name__)
+        with mock.patch.object(
+            CustomRequestLoader, '__init__', autospec=True, return_value=None,
+        ) as m_init:
+            loader = self.am.resolve_request_loader(CustomRequestLoader)
+            with other_app.app_context():
+                other_loader = self.am.resolve_request_loader(CustomRequestLoader)
+                assert self.am.resolve_request_loader(CustomRequestLoader) is other_loader
+            assert self.am.resolve_request_loader(CustomRequestLoader) is loader
+        assert other_loader is not loader
+        assert m_init.call_args_list == [
+            mock.call(loader, flask.current_app),
+            mock.call(other_loader, other_app),
+        ]
+
     def test_resend_verification(self):
         user = ents.User.fake(
             email='foo1@bar.com'
@@ -129,3 +170,47 @@ class TestAuthManager(object):
         assert len(outbox) == 1
         assert outbox[0].subject == '[KA Demo] User Welcome & Verification'
         assert '/verify-account/{}/{}'.format(user.id, user._token_plain) in outbox[0].body
+
+
+class TestCryptContext:
+    def test_shared_by_columns(self):
+        context = flask.current_app.auth_manager.get_crypt_context()
+        assert ents.User.password.type.context is context
+        assert ents.UserWithToken.token.type.context is context
+        assert context.schemes() == ('plaintext',)
+
+    def test_not_rebuilt(self):
+        manager = flask.current_app.auth_manager
+        context = manager.get_crypt_context()
+        with mock.patch('keg_auth.core.CryptContext') as m_context:
+            assert manager.get_crypt_context() is context
+        assert not m_context.called
+
+    def test_hot_swap(self):
+        context = flask.current_app.auth_manager.get_crypt_context()
+        kwargs = {'schemes': ['pbkdf2_sha256', 'plaintext'], 'pbkdf2_sha256__rounds': 1000}
+        with mock.patch.dict(flask.current_app.config, {'PASSLIB_CRYPTCONTEXT_KWARGS': kwargs}):
+            # reloaded in place, so values already holding the context follow the change
+            assert ents.User.password.type.context is context
+            assert context.schemes() == ('pbkdf2_sha256', 'plaintext')
+            user = ents.User.fake(password='foo')
+            assert context.identify(user.password.hash) == 'pbkdf2_sha256'
+            assert user.password == 'foo'
+
+        assert ents.User.password.type.context is context
+        assert context.schemes() == ('plaintext',)
+
+    def test_assigned_context(self):
+        assigned = CryptContext(schemes=['pbkdf2_sha256'])
+        column_type = ents.User.password.type
+        column_type.context = assigned
+        try:
+            assert column_type.context is assigned
+        finally:
+            column_type.context = None
+        assert column_type.context is flask.current_app.auth_manager.get_crypt_context()
+
+    def test_outside_app_context(self):
+        column_type = ents.User.password.type
+        with mock.patch('flask.has_app_context', return_value=False):
+            assert column_type.context is column_type._fallback_context
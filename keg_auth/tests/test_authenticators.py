@@ -1,6 +1,8 @@
 import string
+import time
 from unittest import mock
 
+import arrow
 import flask
 import flask_jwt_extended
 import jwt
@@ -10,10 +12,29 @@ except ImportError:
     ldap = None
 import passlib
 import pytest
+import sqlalchemy as sa
+from freezegun import freeze_time
+
+from keg.db import db
+from passlib.context import CryptContext
 
 from keg_auth.libs import authenticators as auth, get_domain_from_email
+from keg_auth.model import KAPassword
+from keg_auth.testing import with_crypto_context
 from keg_auth.tests.utils import oauth_profile
-from keg_auth_ta.model.entities import User, UserNoEmail
+from keg_auth_ta.model.entities import (
+    RefreshToken,
+    RevokedToken,
+    User,
+    UserNoEmail,
+    UserWithToken,
+)
+
+rehash_context = CryptContext(
+    schemes=['pbkdf2_sha256', 'plaintext'],
+    deprecated='auto',
+    pbkdf2_sha256__rounds=1000,
+)
 
 
 class TestKegAuthenticator:
@@ -48,6 +69,46 @@ class TestKegAuthenticator:
             m_eq.side_effect = passlib.exc.UnknownHashError
             assert not authenticator.verify_password(user, 'nomatchinghash')
 
+    @with_crypto_context(User.password, context=rehash_context)
+    def test_user_password_rehashed(self):
+        user = User.fake()
+        # store a hash under a scheme the context considers deprecated
+        user.password = KAPassword('plainpass')
+        db.session.flush()
+
+        authenticator = auth.KegAuthenticator(app=flask.current_app)
+        assert authenticator.verify_user(login_id=user.email, password='plainpass') is user
+        assert user.password.hash.startswith(b'$pbkdf2-sha256$')
+        # left for the login to commit
+        assert user in db.session.dirty
+
+        db.session.commit()
+        db.session.expire(user)
+        assert user.password.hash.startswith(b'$pbkdf2-sha256$')
+        assert rehash_context.verify('plainpass', user.password.hash)
+
+    @with_crypto_context(User.password, context=rehash_context)
+    def test_user_password_not_rehashed(self):
+        user = User.fake()
+        user.password = KAPassword('plainpass')
+        db.session.flush()
+
+        authenticator = auth.KegAuthenticator(app=flask.current_app)
+        with pytest.raises(auth.UserInvalidAuth):
+            authenticator.verify_user(login_id=user.email, password='badpass')
+        assert user.password.hash == b'plainpass'
+
+        # comparison alone never rehashes
+        assert user.password == 'plainpass'
+        assert user.password.hash == b'plainpass'
+
+        with mock.patch.dict(
+            flask.current_app.config, {'KEGAUTH_PASSWORD_REHASH_ON_LOGIN': False}
+        ):
+            assert authenticator.verify_user(login_id=user.email, password='plainpass') is user
+        assert user.password.hash == b'plainpass'
+        assert user not in db.session.dirty
+
     def test_user_verified(self):
         user = User.fake()
         authenticator = auth.KegAuthenticator(app=flask.current_app)
@@ -173,6 +234,92 @@ class TestOAuthAuthenticator:
         with pytest.raises(Exception, match='.*foo is not configured'):
             authenticator.verify_user(profile_name='foo', login_id=user.email)
 
+    @mock.patch.dict(
+        'flask.current_app.config',
+        {'KEGAUTH_OAUTH_PROFILES': [
+            oauth_profile(domain_filter=['foo.co', 'foo.mo']),
+            oauth_profile(domain_filter=None, oauth_client_kwargs={'name': 'bar'}),
+        ]}
+    )
+    def test_profile_index(self):
+        authenticator = auth.OAuthAuthenticator(app=flask.current_app)
+        assert authenticator.select_oauth_profile('bar')['domain_filter'] is None
+        assert authenticator.select_oauth_profile('baz') is None
+        assert authenticator.profile_domains == {
+            'google': frozenset({'foo.co', 'foo.mo'}),
+            'bar': frozenset(),
+        }
+
+
+class TestOAuthProviderMetadata:
+    metadata = {
+        'issuer': 'http://mysite',
+        'authorization_endpoint': 'http://mysite/authorize',
+        'jwks_uri': 'http://mysite/jwks',
+    }
+    jwks = {'keys': [{'kty': 'oct', 'kid': 'foo', 'k': 'YmFy'}]}
+
+    def setup_method(self):
+        self.fetched = []
+
+    def provider(self, client):
+        """Stand in for the provider's discovery and JWKS endpoints."""
+        def request(method, url, **kwargs):
+            self.fetched.append(url)
+            resp = mock.Mock()
+            if url == 'http://mysite/openid-configuration':
+                resp.json.return_value = dict(self.metadata)
+            else:
+                resp.json.return_value = self.jwks
+            return resp
+
+        session = mock.MagicMock()
+        session.__enter__.return_value.request.side_effect = request
+        return mock.patch.object(client, 'client_cls', return_value=session)
+
+    def authenticator(self):
+        authenticator = auth.OAuthAuthenticator(app=flask.current_app)
+        return authenticator, flask.current_app.auth_manager.oauth.create_client('google')
+
+    def test_disk_cache(self, tmp_path):
+        config = {
+            'KEGAUTH_OAUTH_PROFILES': [oauth_profile()],
+            'KEGAUTH_OAUTH_METADATA_CACHE_DIR': str(tmp_path),
+        }
+        with mock.patch.dict(flask.current_app.config, config):
+            authenticator, client = self.authenticator()
+            with self.provider(client), authenticator.provider_metadata(client):
+                assert client.load_server_metadata()['issuer'] == 'http://mysite'
+                assert client.fetch_jwk_set() == self.jwks
+            assert self.fetched == ['http://mysite/openid-configuration', 'http://mysite/jwks']
+
+            # a new worker starts with both, and fetches nothing
+            authenticator, client = self.authenticator()
+            with self.provider(client), authenticator.provider_metadata(client):
+                metadata = client.load_server_metadata()
+                assert client.fetch_jwk_set() == self.jwks
+            assert len(self.fetched) == 2
+            assert metadata['authorization_endpoint'] == 'http://mysite/authorize'
+            # configured values are not cached
+            assert 'client_id' not in authenticator.metadata_cache.get(
+                'http://mysite/openid-configuration')
+
+    @mock.patch.dict('flask.current_app.config', {'KEGAUTH_OAUTH_PROFILES': [oauth_profile()]})
+    def test_ttl(self):
+        authenticator, client = self.authenticator()
+        assert authenticator.metadata_cache is None
+        with self.provider(client):
+            with authenticator.provider_metadata(client):
+                client.fetch_jwk_set()
+            with authenticator.provider_metadata(client):
+                client.fetch_jwk_set()
+            assert len(self.fetched) == 2
+
+            with freeze_time(arrow.utcnow().shift(days=1).datetime), \
+                    authenticator.provider_metadata(client):
+                client.fetch_jwk_set()
+            assert len(self.fetched) == 4
+
 
 @pytest.mark.skipif(not ldap, reason='requires LDAP library')
 class TestLdapAuthenticator:
@@ -282,6 +429,122 @@ class TestLdapAuthenticator:
         ]
         assert success is True
 
+    @mock.patch('ldap.initialize', autospec=True, spec_set=True)
+    def test_connection_reused(self, mocked_ldap):
+        mocked_ldap.return_value.simple_bind_s.return_value = (ldap.RES_BIND, )
+
+        user = User.fake()
+        authenticator = auth.LdapAuthenticator(app=flask.current_app)
+        assert authenticator.verify_password(user, 'foo') is True
+        assert authenticator.verify_password(user, 'foo') is True
+
+        assert mocked_ldap.call_args_list == [mock.call('abc123')]
+        mocked_ldap.return_value.set_option.assert_called_once_with(ldap.OPT_NETWORK_TIMEOUT, 5)
+        assert mocked_ldap.return_value.timeout == 10
+
+    @mock.patch('ldap.initialize', autospec=True, spec_set=True)
+    def test_pool_disabled(self, mocked_ldap):
+        mocked_ldap.return_value.simple_bind_s.return_value = (ldap.RES_BIND, )
+
+        user = User.fake()
+        authenticator = auth.LdapAuthenticator(app=flask.current_app)
+        with mock.patch.dict(flask.current_app.config, {'KEGAUTH_LDAP_POOL_SIZE': 0}):
+            authenticator.verify_password(user, 'foo')
+            authenticator.verify_password(user, 'foo')
+
+        assert mocked_ldap.call_count == 2
+        assert mocked_ldap.return_value.unbind_s.call_count == 2
+
+    @mock.patch('ldap.initialize', autospec=True, spec_set=True)
+    def test_failed_server_tried_last(self, mocked_ldap):
+        mocked_ldap.return_value.simple_bind_s.side_effect = (
+            ldap.SERVER_DOWN(),
+            (ldap.RES_BIND,),
+            (ldap.RES_BIND,),
+        )
+
+        user = User.fake()
+        authenticator = auth.LdapAuthenticator(app=flask.current_app)
+        config = {'KEGAUTH_LDAP_SERVER_URL': ['abc123', 'def456']}
+        with mock.patch.dict(flask.current_app.config, config):
+            assert authenticator.verify_password(user, 'foo') is True
+            # def456 goes first now, on the connection from the first login
+            assert authenticator.verify_password(user, 'foo') is True
+
+        assert mocked_ldap.call_args_list == [mock.call('abc123'), mock.call('def456')]
+
+    @mock.patch('ldap.initialize', autospec=True, spec_set=True)
+    def test_all_servers_down(self, mocked_ldap):
+        mocked_ldap.return_value.simple_bind_s.side_effect = ldap.SERVER_DOWN()
+
+        user = User.fake()
+        authenticator = auth.LdapAuthenticator(app=flask.current_app)
+        config = {'KEGAUTH_LDAP_SERVER_URL': ['abc123', 'def456']}
+        with mock.patch.dict(flask.current_app.config, config):
+            with pytest.raises(ldap.SERVER_DOWN):
+                authenticator.verify_password(user, 'foo')
+
+    @pytest.mark.parametrize('bind_result, expected', [
+        ((ldap.RES_BIND, ) if ldap else None, True),
+        (ldap.INVALID_CREDENTIALS() if ldap else None, False),
+    ])
+    @mock.patch('ldap.initialize', autospec=True, spec_set=True)
+    def test_parallel_bind(self, mocked_ldap, bind_result, expected):
+        if isinstance(bind_result, Exception):
+            mocked_ldap.return_value.simple_bind_s.side_effect = bind_result
+        else:
+            mocked_ldap.return_value.simple_bind_s.return_value = bind_result
+
+        user = User.fake()
+        authenticator = auth.LdapAuthenticator(app=flask.current_app)
+        config = {
+            'KEGAUTH_LDAP_SERVER_URL': ['abc123', 'def456'],
+            'KEGAUTH_LDAP_PARALLEL_BIND': True,
+        }
+        with mock.patch.dict(flask.current_app.config, config):
+            assert authenticator.verify_password(user, 'foo') is expected
+            authenticator.get_server_pool(config['KEGAUTH_LDAP_SERVER_URL']).executor.shutdown()
+
+        assert sorted(call.args[0] for call in mocked_ldap.call_args_list) == [
+            'abc123', 'def456']
+
+    @mock.patch('ldap.initialize', autospec=True, spec_set=True)
+    def test_verification_cache(self, mocked_ldap):
+        bind = mocked_ldap.return_value.simple_bind_s
+        bind.return_value = (ldap.RES_BIND, )
+
+        user = User.fake()
+        authenticator = auth.LdapAuthenticator(app=flask.current_app)
+        assert authenticator.verification_cache is None
+
+        config = {'KEGAUTH_LDAP_CACHE_TTL': 60, 'KEGAUTH_LDAP_CACHE_ROUNDS': 1000}
+        with mock.patch.dict(flask.current_app.config, config):
+            assert authenticator.verify_password(user, 'foo') is True
+            assert authenticator.verify_password(user, 'foo') is True
+            assert bind.call_count == 1
+
+            # a different password goes to the directory, and drops the entry when rejected
+            bind.side_effect = ldap.INVALID_CREDENTIALS()
+            assert authenticator.verify_password(user, 'bar') is False
+            assert len(authenticator.verification_cache) == 0
+            assert authenticator.verify_password(user, 'foo') is False
+            assert bind.call_count == 3
+
+    @mock.patch('ldap.initialize', autospec=True, spec_set=True)
+    def test_verification_cache_expires(self, mocked_ldap):
+        bind = mocked_ldap.return_value.simple_bind_s
+        bind.return_value = (ldap.RES_BIND, )
+
+        user = User.fake()
+        authenticator = auth.LdapAuthenticator(app=flask.current_app)
+        config = {'KEGAUTH_LDAP_CACHE_TTL': 60, 'KEGAUTH_LDAP_CACHE_ROUNDS': 1000}
+        with mock.patch.dict(flask.current_app.config, config):
+            authenticator.verify_password(user, 'foo')
+            with mock.patch.object(authenticator.verification_cache, 'timer',
+                                   return_value=time.monotonic() + 60):
+                authenticator.verify_password(user, 'foo')
+        assert bind.call_count == 2
+
     @mock.patch('ldap.initialize', autospec=True, spec_set=True)
     def test_debug_override(self, mocked_ldap):
         flask.current_app.config['KEGAUTH_LDAP_TEST_MODE'] = True
@@ -386,6 +649,411 @@ class TestJwtRequestLoader:
         assert flask_jwt_extended.decode_token(token)['sub'] == user.session_key
 
 
+class TestJwtPermissionClaims:
+    def setup_method(self):
+        User.delete_cascaded()
+
+    def load_user(self, token):
+        loader = flask.current_app.auth_manager.get_request_loader('jwt')
+        headers = {'Authorization': f'Bearer {token}'}
+        with flask.current_app.test_request_context('/', headers=headers):
+            return loader.get_authenticated_user()
+
+    @pytest.mark.parametrize('mode', ['list', 'bitmask'])
+    def test_snapshot(self, mode):
+        user = User.fake(permissions=['permission1', 'permission2'])
+        loader = flask.current_app.auth_manager.get_request_loader('jwt')
+        token = loader.create_access_token(user, permissions=mode)
+        claims = flask_jwt_extended.decode_token(token)
+        assert claims['exp'] - claims['iat'] == 300
+        if mode == 'list':
+            assert claims['perms'] == ['permission1', 'permission2']
+        else:
+            assert claims['permb'] == '6'
+
+        db.session.expire_all()
+        with mock.patch.object(User, 'get_all_permissions', autospec=True) as m_get_all:
+            loaded = self.load_user(token)
+            assert loaded.has_all_permissions('permission1', 'permission2')
+            assert not loaded.has_any_permission('auth-manage')
+        assert not m_get_all.called
+
+    def test_config_default(self):
+        user = User.fake(permissions=['permission1'])
+        loader = flask.current_app.auth_manager.get_request_loader('jwt')
+        assert 'perms' not in flask_jwt_extended.decode_token(loader.create_access_token(user))
+
+        with mock.patch.dict(flask.current_app.config, {
+            'KEGAUTH_JWT_PERMISSIONS_CLAIM': 'list',
+            'KEGAUTH_JWT_PERMISSIONS_EXPIRES': 60,
+        }):
+            claims = flask_jwt_extended.decode_token(loader.create_access_token(user))
+        assert claims['perms'] == ['permission1']
+        assert claims['exp'] - claims['iat'] == 60
+
+    def test_bitmask_undefined_permission(self):
+        user = User.fake()
+        loader = flask.current_app.auth_manager.get_request_loader('jwt')
+        with mock.patch.object(User, 'get_all_permission_tokens', return_value={'undefined'}):
+            assert loader.permission_claims(user, 'bitmask') == {'perms': ['undefined']}
+
+    def test_bitmask_definitions_changed(self):
+        loader = flask.current_app.auth_manager.get_request_loader('jwt')
+        assert loader.permission_tokens_from_claims({'permb': '1', 'permd': 'stale'}) is None
+        assert loader.permission_tokens_from_claims({}) is None
+
+    def test_permissions_changed(self):
+        # changing permissions rotates the session key, so the old snapshot cannot be used
+        user = User.fake(permissions=['permission1'])
+        loader = flask.current_app.auth_manager.get_request_loader('jwt')
+        token = loader.create_access_token(user, permissions='list')
+        user.permissions = []
+        db.session.commit()
+        assert self.load_user(token) is None
+
+    def test_unknown_mode(self):
+        loader = flask.current_app.auth_manager.get_request_loader('jwt')
+        with pytest.raises(ValueError):
+            loader.permission_claims(User.fake(), 'bloom')
+
+
+class TestJwtRevocation:
+    def setup_method(self):
+        User.delete_cascaded()
+        RevokedToken.delete_cascaded()
+        # the newest loader for the app is the one flask-jwt-extended calls back to
+        self.loader = auth.JwtRequestLoader(flask.current_app)
+
+    def load_user(self, token):
+        headers = {'Authorization': f'Bearer {token}'}
+        with flask.current_app.test_request_context('/', headers=headers):
+            return self.loader.get_authenticated_user()
+
+    def test_revoke(self):
+        user = User.fake()
+        token = self.loader.create_access_token(user)
+        other_token = self.loader.create_access_token(user)
+        assert self.load_user(token) is user
+
+        self.loader.revoke_token(token)
+        assert self.load_user(token) is None
+        assert self.load_user(other_token) is user
+
+        claims = flask_jwt_extended.decode_token(token)
+        revoked = RevokedToken.get_by(jti=claims['jti'])
+        assert revoked.expires_utc == arrow.get(claims['exp'])
+
+    def test_revoke_claims(self):
+        user = User.fake()
+        token = self.loader.create_access_token(user)
+        self.loader.revoke_token(flask_jwt_extended.decode_token(token))
+        assert self.load_user(token) is None
+
+    def test_not_revoked_no_query(self):
+        user = User.fake()
+        token = self.loader.create_access_token(user)
+        self.loader.revocation_store._next_sync = float('inf')
+        with mock.patch.object(RevokedToken, 'query') as m_query:
+            assert self.load_user(token) is user
+        assert not m_query.called
+
+    def test_revoked_elsewhere(self):
+        user = User.fake()
+        token = self.loader.create_access_token(user)
+        RevokedToken.revoke(flask_jwt_extended.decode_token(token)['jti'])
+        assert not self.loader.revocation_store.is_revoked(
+            flask_jwt_extended.decode_token(token)['jti'])
+
+        # picked up on the request after the sync interval has passed
+        self.loader.revocation_store._next_sync = 0
+        assert self.load_user(token) is None
+
+
+class TestJwtSigningKeys:
+    def setup_method(self):
+        User.delete_cascaded()
+
+    @pytest.fixture
+    def keys(self):
+        from keg_auth.tests.test_jwks import ed_key, private_pem, public_pem, rsa_key
+        return private_pem(ed_key), public_pem(rsa_key), private_pem(rsa_key)
+
+    def load_user(self, token):
+        headers = {'Authorization': f'Bearer {token}'}
+        with flask.current_app.test_request_context('/', headers=headers):
+            return auth.JwtRequestLoader.get_authenticated_user()
+
+    def test_sign_and_verify(self, keys):
+        config = {'KEGAUTH_JWT_SIGNING_KEYS': [keys[0], keys[1]]}
+        with mock.patch.dict(flask.current_app.config, config):
+            algorithm = flask.current_app.config['JWT_ALGORITHM']
+            flask.current_app.config.pop('JWT_DECODE_ALGORITHMS')
+            loader = auth.JwtRequestLoader(flask.current_app)
+            assert flask.current_app.config['JWT_ALGORITHM'] == algorithm
+            assert flask.current_app.config['JWT_DECODE_ALGORITHMS'] == ['EdDSA', 'RS256']
+
+            user = User.fake()
+            token = loader.create_access_token(user)
+            header = jwt.get_unverified_header(token)
+            assert header['alg'] == 'EdDSA'
+            assert header['kid'] == loader.signing_keys[0].kid
+            assert self.load_user(token) is user
+
+            assert loader.get_jwks() == {'keys': [key.jwk for key in loader.signing_keys]}
+
+    def test_rotation(self, keys):
+        user = User.fake()
+        config = {
+            'KEGAUTH_JWT_SIGNING_KEYS': [keys[2]],
+            'JWT_DECODE_ALGORITHMS': ['EdDSA', 'RS256'],
+        }
+        with mock.patch.dict(flask.current_app.config, config):
+            loader = auth.JwtRequestLoader(flask.current_app)
+            old_token = loader.create_access_token(user)
+            assert jwt.get_unverified_header(old_token)['alg'] == 'RS256'
+
+            # new signing key of another type, the old one kept for verifying. The signing
+            # algorithm follows the key, with no other config changes.
+            flask.current_app.config['KEGAUTH_JWT_SIGNING_KEYS'] = [keys[0], keys[1]]
+            assert self.load_user(old_token) is user
+            assert jwt.get_unverified_header(loader.create_access_token(user))['alg'] == 'EdDSA'
+
+            # old key retired
+            flask.current_app.config['KEGAUTH_JWT_SIGNING_KEYS'] = [keys[0]]
+            assert self.load_user(old_token) is None
+
+    def test_secret_key_default(self):
+        loader = auth.JwtRequestLoader(flask.current_app)
+        assert loader.signing_keys == []
+        assert loader.get_jwks() == {'keys': []}
+        token = loader.create_access_token(User.fake())
+        assert 'kid' not in jwt.get_unverified_header(token)
+
+
+class TestJwtRefresh:
+    def setup_method(self):
+        User.delete_cascaded()
+        RefreshToken.delete_cascaded()
+
+    @property
+    def loader(self):
+        return flask.current_app.auth_manager.get_request_loader('jwt')
+
+    def test_refresh(self):
+        user = User.fake()
+        refresh_token = self.loader.create_refresh_token(user)
+        record = RefreshToken.get_by(token_id=refresh_token.split('.')[1])
+        assert record.expires_utc > arrow.utcnow().shift(days=29)
+
+        access_token, new_refresh_token = self.loader.refresh(refresh_token)
+        claims = flask_jwt_extended.decode_token(access_token)
+        assert claims['sub'] == user.session_key
+        assert new_refresh_token != refresh_token
+        assert self.loader.refresh(new_refresh_token) is not None
+
+    def test_refresh_used(self):
+        user = User.fake()
+        refresh_token = self.loader.create_refresh_token(user)
+        self.loader.refresh(refresh_token)
+        assert self.loader.refresh(refresh_token) is None
+
+    def test_refresh_no_password_check(self):
+        user = User.fake()
+        refresh_token = self.loader.create_refresh_token(user)
+        with mock.patch.object(passlib.context.CryptContext, 'verify') as m_verify:
+            assert self.loader.refresh(refresh_token) is not None
+        assert not m_verify.called
+
+    def test_refresh_inactive_user(self):
+        user = User.fake()
+        refresh_token = self.loader.create_refresh_token(user)
+        user.is_enabled = False
+        db.session.commit()
+        assert self.loader.refresh(refresh_token) is None
+
+
+class TestJwtUserCache:
+    def setup_method(self):
+        User.delete_cascaded()
+
+    def create_loader(self, ttl=60):
+        with mock.patch.dict(flask.current_app.config, {'KEGAUTH_JWT_USER_CACHE_TTL': ttl}):
+            return auth.JwtRequestLoader(flask.current_app)
+
+    def test_disabled_by_default(self):
+        assert auth.JwtRequestLoader(flask.current_app).user_cache is None
+
+    def test_cached(self):
+        user = User.fake(permissions=['auth-manage'])
+        loader = self.create_loader()
+        assert loader.load_user(user.session_key) is user
+        db.session.remove()
+
+        with mock.patch.object(User, 'get_by', autospec=True) as m_get_by:
+            cached = loader.load_user(user.session_key)
+        assert not m_get_by.called
+        assert cached.id == user.id
+        assert cached.email == user.email
+        assert cached in db.session
+        # relationships load as usual
+        assert cached.has_all_permissions('auth-manage')
+
+    def test_not_found_not_cached(self):
+        loader = self.create_loader()
+        assert loader.load_user('nope') is None
+        assert len(loader.user_cache) == 0
+
+    def test_disabled_utc_expiry(self):
+        user = User.fake(disabled_utc=arrow.utcnow().shift(minutes=5))
+        loader = self.create_loader()
+        assert loader.load_user(user.session_key) is user
+
+        with freeze_time(arrow.utcnow().shift(minutes=6).datetime):
+            assert loader.load_user(user.session_key) is None
+        assert len(loader.user_cache) == 0
+
+    def test_session_key_rotation(self):
+        user = User.fake()
+        loader = self.create_loader()
+        old_session_key = user.session_key
+        assert loader.load_user(old_session_key) is user
+
+        with mock.patch.dict(flask.current_app.auth_manager.request_loaders, {'jwt': loader}):
+            user.reset_session_key()
+        db.session.commit()
+        assert loader.load_user(old_session_key) is None
+        assert loader.load_user(user.session_key) is user
+
+    def test_ttl(self):
+        user = User.fake()
+        loader = self.create_loader(ttl=60)
+        loader.user_cache.timer = mock.Mock(return_value=0)
+        assert loader.load_user(user.session_key) is user
+
+        # disabled elsewhere, e.g. by another process: stale until the entry expires
+        session_key = user.session_key
+        db.session.execute(sa.update(User).where(User.id == user.id).values(is_enabled=False))
+        db.session.commit()
+        db.session.remove()
+        assert loader.load_user(session_key) is not None
+        db.session.remove()
+        loader.user_cache.timer.return_value = 60
+        assert loader.load_user(session_key) is None
+
+    def test_disabled_user_rotates_session_key(self):
+        user = User.fake()
+        loader = self.create_loader()
+        session_key = user.session_key
+        assert loader.load_user(session_key) is user
+
+        with mock.patch.dict(flask.current_app.auth_manager.request_loaders, {'jwt': loader}):
+            user.is_enabled = False
+            db.session.commit()
+        assert loader.load_user(session_key) is None
+
+
+class TestTokenRequestLoader:
+    def setup_method(self):
+        UserWithToken.delete_cascaded()
+
+    def get_authenticated_user(self, headers=None):
+        loader = auth.TokenRequestLoader(flask.current_app)
+        loader.user_ent = UserWithToken
+        with flask.current_app.test_request_context('/', headers=headers):
+            return loader.get_authenticated_user()
+
+    def test_api_key(self):
+        user = UserWithToken.fake()
+        api_key = user.generate_api_key()
+        assert self.get_authenticated_user({'X-Auth-Token': api_key}) is user
+
+    def test_legacy_api_token(self):
+        user = UserWithToken.fake(token='1234')
+        api_token = user.generate_api_token('1234')
+        assert self.get_authenticated_user({'X-Auth-Token': api_token}) is user
+
+    def test_invalid_token(self):
+        UserWithToken.fake().generate_api_key()
+        assert self.get_authenticated_user({'X-Auth-Token': 'kak.foo.bar'}) is None
+
+    def test_missing_token(self):
+        assert self.get_authenticated_user() is None
+
+
+class TestRequestLoaderDispatch:
+    class AlwaysRequestLoader(auth.RequestLoader):
+        pass
+
+    class CookieRequestLoader(auth.RequestLoader):
+        @classmethod
+        def get_credential_locations(cls, config):
+            return [auth.CredentialLocation('cookie', 'api_session')]
+
+    def get_loaders(self, loaders, config=None, **kwargs):
+        dispatch = auth.RequestLoaderDispatch(loaders, config or flask.current_app.config)
+        with flask.current_app.test_request_context('/', **kwargs):
+            return dispatch.get_loaders(flask.request)
+
+    @pytest.mark.parametrize('headers, expected', [
+        ({}, []),
+        ({'X-Auth-Token': 'abc'}, [auth.TokenRequestLoader]),
+        ({'x-auth-token': 'abc'}, [auth.TokenRequestLoader]),
+        ({'Authorization': 'Bearer abc'}, [auth.JwtRequestLoader]),
+        ({'Authorization': 'bearer abc'}, [auth.JwtRequestLoader]),
+        ({'Authorization': 'Basic abc'}, []),
+        ({'Authorization': ''}, []),
+        (
+            {'Authorization': 'Bearer abc', 'X-Auth-Token': 'abc'},
+            [auth.JwtRequestLoader, auth.TokenRequestLoader],
+        ),
+    ])
+    def test_headers(self, headers, expected):
+        loaders = [auth.JwtRequestLoader, auth.TokenRequestLoader]
+        assert self.get_loaders(loaders, headers=headers) == expected
+
+    def test_registration_order(self):
+        loaders = [auth.TokenRequestLoader, auth.JwtRequestLoader]
+        headers = {'Authorization': 'Bearer abc', 'X-Auth-Token': 'abc'}
+        assert self.get_loaders(loaders, headers=headers) == loaders
+
+    def test_undeclared_always_run(self):
+        loaders = [self.AlwaysRequestLoader, auth.TokenRequestLoader]
+        assert self.get_loaders(loaders) == [self.AlwaysRequestLoader]
+        assert self.get_loaders(loaders, headers={'X-Auth-Token': 'abc'}) == loaders
+
+    def test_cookie(self):
+        loaders = [self.CookieRequestLoader]
+        assert self.get_loaders(loaders) == []
+        assert self.get_loaders(loaders, headers={'Cookie': 'api_session=abc'}) == loaders
+
+    def test_jwt_config(self):
+        config = dict(
+            flask.current_app.config,
+            JWT_TOKEN_LOCATION=['headers', 'query_string', 'json'],
+            JWT_HEADER_NAME='X-Jwt',
+            JWT_HEADER_TYPE='',
+        )
+        loaders = [auth.JwtRequestLoader]
+        assert self.get_loaders(loaders, config, headers={'Authorization': 'Bearer abc'}) == []
+        assert self.get_loaders(loaders, config, headers={'X-Jwt': 'abc'}) == loaders
+        assert self.get_loaders(loaders, config, query_string={'jwt': 'abc'}) == loaders
+        assert self.get_loaders(loaders, config, json={'access_token': 'abc'}) == loaders
+
+    @pytest.mark.parametrize('location, headers, expected', [
+        (auth.CredentialLocation('header', 'Authorization', 'Bearer'),
+         {'Authorization': 'Bearer abc'}, True),
+        (auth.CredentialLocation('header', 'Authorization', 'Bearer'),
+         {'Authorization': 'Basic abc'}, False),
+        (auth.CredentialLocation('header', 'Authorization'), {'Authorization': 'Basic abc'}, True),
+        (auth.CredentialLocation('header', 'Authorization'), {}, False),
+        (auth.CredentialLocation('cookie', 'foo'), {'Cookie': 'foo=bar'}, True),
+        (auth.CredentialLocation('cookie', 'foo'), {}, False),
+    ])
+    def test_location_matches(self, location, headers, expected):
+        with flask.current_app.test_request_context('/', headers=headers):
+            assert location.matches(flask.request) is expected
+
+
 class TestPasswordPolicy:
     def setup_method(self, _):
         User.delete_cascaded()
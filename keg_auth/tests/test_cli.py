@@ -1,8 +1,18 @@
+import json
+
 import arrow
+import flask
 import mock
+import pytest
 from blazeutils.containers import LazyDict
 from keg.testing import CLIBase
 
+try:
+    import ldap
+except ImportError:
+    ldap = None
+
+from keg_auth.libs.hashing import CalibrationResult
 from keg_auth.model.entity_registry import RegistryError
 from keg_auth_ta.model import entities as ents
 
@@ -175,3 +185,183 @@ class TestCLI(CLIBase):
     def test_purge_attempts_no_attempt_registered(self, m_ent_registry, m_echo):
         self.invoke('auth', 'purge-attempts', '--username=foo@bar.com')
         m_echo.assert_called_once_with('No attempt class has been registered.')
+
+    def test_simulate_lockout(self):
+        start = arrow.utcnow().shift(hours=-1)
+        for i in range(5):
+            ents.Attempt.fake(user_input='foo@test.com', attempt_type='login', success=False,
+                              datetime_utc=start.shift(seconds=i))
+        ents.Attempt.fake(user_input='bar@test.com', attempt_type='login', success=False,
+                          datetime_utc=start)
+        ents.Attempt.fake(user_input='bar@test.com', attempt_type='login', success=True,
+                          datetime_utc=start.shift(seconds=1))
+
+        result = self.invoke('auth', 'simulate-lockout', '--policy=3:60:60',
+                             '--policy=10:60:60')
+        assert result.output.splitlines() == [
+            'limit=3 timespan=60 lockout=60',
+            '  attempts: 7, blocked: 2',
+            '  users locked out: 0 of 1 (0 successful attempts blocked)',
+            '  attacker attempts blocked: 2 of 5',
+            'limit=10 timespan=60 lockout=60',
+            '  attempts: 7, blocked: 0',
+            '  users locked out: 0 of 1 (0 successful attempts blocked)',
+            '  attacker attempts blocked: 0 of 5',
+        ]
+
+    def test_simulate_lockout_config_policy(self):
+        with mock.patch.dict(flask.current_app.config, {
+            'KEGAUTH_ATTEMPT_LIMIT': 4,
+            'KEGAUTH_ATTEMPT_TIMESPAN': 30,
+            'KEGAUTH_RESET_ATTEMPT_LOCKOUT': 90,
+        }):
+            result = self.invoke('auth', 'simulate-lockout', '--type=reset', '--since=1')
+        assert result.output.splitlines()[0] == 'limit=4 timespan=30 lockout=90'
+
+    def test_simulate_lockout_invalid_policy(self):
+        result = self.invoke('auth', 'simulate-lockout', '--policy=3:60', exit_code=2)
+        assert 'LIMIT:TIMESPAN:LOCKOUT' in result.output
+
+    @mock.patch('keg_auth.cli.calibrate_schemes', autospec=True, spec_set=True)
+    def test_calibrate_hash(self, m_calibrate):
+        m_calibrate.return_value = [
+            CalibrationResult('pbkdf2_sha256', 1000, 1.5, 2.25),
+            CalibrationResult('pbkdf2_sha256', 2000, 3, 4.5),
+        ]
+        result = self.invoke('auth', 'calibrate-hash', '--scheme=pbkdf2_sha256',
+                             '--rounds=pbkdf2_sha256:1000', '--rounds=pbkdf2_sha256:2000',
+                             '--target-ms=3', '--threads=4', '--samples=5')
+        m_calibrate.assert_called_once_with(
+            ('pbkdf2_sha256',), rounds={'pbkdf2_sha256': [1000, 2000]}, samples=5, threads=4
+        )
+        assert result.output.splitlines() == [
+            'pbkdf2_sha256 rounds=1000: p50 1.5ms, p99 2.2ms',
+            'pbkdf2_sha256 rounds=2000: p50 3.0ms, p99 4.5ms (over budget)',
+            "Recommended PASSLIB_CRYPTCONTEXT_KWARGS = {'schemes': ['pbkdf2_sha256'],"
+            " 'deprecated': 'auto', 'pbkdf2_sha256__rounds': 1000}",
+        ]
+
+    @mock.patch('keg_auth.cli.calibrate_schemes', autospec=True, spec_set=True)
+    def test_calibrate_hash_over_budget(self, m_calibrate):
+        m_calibrate.return_value = [CalibrationResult('bcrypt', 12, 250, 300)]
+        result = self.invoke('auth', 'calibrate-hash', '--target-ms=100')
+        m_calibrate.assert_called_once_with(
+            mock.ANY, rounds={}, samples=20, threads=1
+        )
+        assert 'bcrypt' in m_calibrate.call_args[0][0]
+        assert result.output.splitlines()[-1] == 'No cost value verifies within 100ms at p99.'
+
+    @mock.patch('keg_auth.cli.calibrate_schemes', autospec=True, spec_set=True)
+    def test_calibrate_hash_rounds_per_scheme(self, m_calibrate):
+        m_calibrate.return_value = []
+        self.invoke('auth', 'calibrate-hash', '--scheme=bcrypt', '--scheme=pbkdf2_sha256',
+                    '--rounds=bcrypt:12', '--rounds=pbkdf2_sha256:300000')
+        m_calibrate.assert_called_once_with(
+            ('bcrypt', 'pbkdf2_sha256'),
+            rounds={'bcrypt': [12], 'pbkdf2_sha256': [300000]},
+            samples=20,
+            threads=1,
+        )
+
+    @pytest.mark.parametrize('rounds, error', [
+        ('12', 'expected SCHEME:ROUNDS'),
+        ('bcrypt:many', 'expected SCHEME:ROUNDS'),
+        ('bcrypt:200000', 'bcrypt rounds must be between 4 and 31'),
+        ('pbkdf2_sha256:0', 'pbkdf2_sha256 rounds must be between 1 and'),
+        ('pbkdf2_sha512:1000', 'pbkdf2_sha512 is not being calibrated'),
+    ])
+    @mock.patch('keg_auth.cli.calibrate_schemes', autospec=True, spec_set=True)
+    def test_calibrate_hash_invalid_rounds(self, m_calibrate, rounds, error):
+        result = self.invoke('auth', 'calibrate-hash', '--scheme=bcrypt',
+                             '--scheme=pbkdf2_sha256', f'--rounds={rounds}', exit_code=2)
+        assert error in result.output
+        assert not m_calibrate.called
+
+    def test_calibrate_hash_unknown_scheme(self):
+        result = self.invoke('auth', 'calibrate-hash', '--scheme=foo')
+        assert result.output == 'Scheme not available: foo\n'
+
+    def test_import_users(self, tmp_path):
+        ents.User.fake(email='existing@bar.com')
+        path = tmp_path / 'users.csv'
+        path.write_text(
+            'email,password,is_superuser\n'
+            'foo@bar.com,pass,yes\n'
+            'existing@bar.com,,\n'
+            ',pass,\n'
+        )
+        result = self.invoke('auth', 'import-users', str(path), '--workers=0')
+        assert result.output.splitlines() == [
+            'Line 4: 1 created, 1 skipped, 1 errors',
+            'Line 4: Missing email',
+            'Imported 1 users, skipped 1 existing.',
+        ]
+        user = ents.User.get_by(email='foo@bar.com')
+        assert user.is_superuser
+        assert user.password == 'pass'
+
+    def test_import_users_jsonl(self, tmp_path):
+        path = tmp_path / 'users.jsonl'
+        path.write_text('{"email": "foo@bar.com"}\n{"email": \n')
+        result = self.invoke('auth', 'import-users', str(path), '--workers=0')
+        assert result.output == 'Import stopped: Line 2: invalid JSON\n'
+        assert ents.User.query.count() == 0
+
+    @pytest.mark.skipif(not ldap, reason='requires LDAP library')
+    @mock.patch('keg_auth.libs.ldap_sync.connect_directory', autospec=True, spec_set=True)
+    @mock.patch('keg_auth.libs.ldap_sync.paged_search', autospec=True, spec_set=True)
+    def test_ldap_sync(self, m_paged_search, m_connect):
+        m_paged_search.side_effect = [
+            iter([('uid=foo,dc=org', {'uid': [b'foo@bar.com']})]),
+            iter([('cn=admins,dc=org', {'cn': [b'admins'], 'member': [b'uid=foo,dc=org']})]),
+        ]
+        config = {
+            'KEGAUTH_LDAP_SERVER_URL': 'ldap://example.org',
+            'KEGAUTH_LDAP_SYNC_USER_BASE_DN': 'dc=org',
+            'KEGAUTH_LDAP_SYNC_GROUP_BASE_DN': 'dc=org',
+        }
+        with mock.patch.dict(flask.current_app.config, config):
+            result = self.invoke('auth', 'ldap-sync')
+        assert result.output.splitlines() == [
+            'Read 1 users and 1 groups.',
+            'Created 1 users and 1 groups, added 1 and removed 0 memberships,'
+            ' invalidated 1 sessions.',
+        ]
+        m_connect.return_value.unbind_s.assert_called_once_with()
+        assert [group.name for group in ents.User.get_by(email='foo@bar.com').groups] == ['admins']
+
+    @pytest.mark.skipif(not ldap, reason='requires LDAP library')
+    def test_ldap_sync_not_configured(self):
+        result = self.invoke('auth', 'ldap-sync')
+        assert 'LDAP sync needs KEGAUTH_LDAP_SERVER_URL' in result.output
+
+    def test_invite_urls(self, tmp_path):
+        user1 = ents.User.fake(email='foo@bar.com', is_verified=False)
+        user2 = ents.User.fake(email='baz@bar.com', is_verified=False)
+        ents.User.fake(email='verified@bar.com')
+        ents.User.fake(email='other@example.com', is_verified=False)
+
+        path = tmp_path / 'urls.jsonl'
+        result = self.invoke('auth', 'invite-urls', '--unverified', '--username-like=%@bar.com',
+                             '--format=jsonl', f'--output={path}')
+        assert result.output == 'Generated 2 URLs.\n'
+
+        rows = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [(row['user_id'], row['username']) for row in rows] == [
+            (user1.id, 'foo@bar.com'), (user2.id, 'baz@bar.com')
+        ]
+        prefix = f'http://keg.example.com/verify-account/{user1.id}/'
+        assert rows[0]['url'].startswith(prefix)
+        assert user1.token_verify(rows[0]['url'][len(prefix):])
+
+    def test_invite_urls_reset_csv(self):
+        user = ents.User.fake(email='foo@bar.com')
+        ents.User.fake(email='baz@bar.com')
+        result = self.invoke('auth', 'invite-urls', '--kind=reset-password',
+                             f'--user-id={user.id}')
+        lines = result.output.splitlines()
+        assert lines[0] == 'user_id,username,url'
+        assert lines[1].startswith(
+            f'{user.id},foo@bar.com,http://keg.example.com/reset-password/{user.id}/'
+        )
+        assert lines[2] == 'Generated 1 URLs.'
@@ -0,0 +1,209 @@
+import threading
+from unittest import mock
+
+import flask
+import flask_webtest
+import pytest
+from passlib.context import CryptContext
+
+from keg_auth.libs.hashing import (
+    CalibrationResult,
+    HashingService,
+    HashingServiceBusy,
+    calibrate_schemes,
+    check_rounds,
+    get_hashing_service,
+    measure_verify,
+    recommend_cryptcontext_kwargs,
+    scheme_available,
+)
+from keg_auth_ta.model import entities as ents
+
+context = CryptContext(schemes=['pbkdf2_sha256'], pbkdf2_sha256__rounds=1000)
+
+
+class TestHashingService:
+    @pytest.mark.parametrize('executor_type', ['thread', 'process'])
+    def test_hash_and_verify(self, executor_type):
+        service = HashingService(max_workers=1, executor_type=executor_type)
+        try:
+            hash = service.hash(context, 'foo')
+            assert context.identify(hash) == 'pbkdf2_sha256'
+            assert service.verify_and_update(context, 'foo', hash) == (True, None)
+            assert service.verify_and_update(context, 'bar', hash) == (False, None)
+        finally:
+            service.shutdown()
+
+    def test_unknown_executor_type(self):
+        with pytest.raises(ValueError):
+            HashingService(executor_type='fiber')
+
+    def test_busy(self):
+        service = HashingService(max_workers=1, queue_limit=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def job():
+            started.set()
+            release.wait(5)
+
+        try:
+            worker = threading.Thread(target=service.run, args=(job,))
+            worker.start()
+            started.wait(5)
+            queued = threading.Thread(target=service.run, args=(lambda: None,))
+            queued.start()
+
+            # one job running, one queued: no room for a third
+            with pytest.raises(HashingServiceBusy):
+                service.run(lambda: None)
+
+            release.set()
+            worker.join(5)
+            queued.join(5)
+            assert service.run(lambda: 'done') == 'done'
+        finally:
+            release.set()
+            service.shutdown()
+
+    def test_timeout(self):
+        service = HashingService(max_workers=1, timeout=0.01)
+        release = threading.Event()
+        try:
+            with pytest.raises(HashingServiceBusy):
+                service.run(release.wait, 5)
+        finally:
+            release.set()
+            service.shutdown()
+
+    def test_busy_is_service_unavailable(self):
+        assert HashingServiceBusy.code == 503
+
+
+class TestPasswordHashingPool:
+    def setup_method(self):
+        ents.User.delete_cascaded()
+
+    def teardown_method(self):
+        auth_manager = flask.current_app.auth_manager
+        if auth_manager._hashing_service is not None:
+            auth_manager._hashing_service.shutdown()
+            auth_manager._hashing_service = None
+
+    def test_disabled(self):
+        assert get_hashing_service() is None
+
+    @mock.patch.dict('flask.current_app.config', {'KEGAUTH_HASHING_POOL_ENABLED': True})
+    def test_password_column(self):
+        service = get_hashing_service()
+        assert service is flask.current_app.auth_manager.hashing_service
+        assert service.max_workers == 4
+        assert service.executor_type == 'thread'
+
+        with mock.patch.object(service, 'run', wraps=service.run) as m_run:
+            user = ents.User.fake(password='foo')
+            assert m_run.call_count == 1
+
+            assert user.password == 'foo'
+            assert user.password != 'bar'
+            assert m_run.call_count == 3
+
+    @mock.patch.dict('flask.current_app.config', {
+        'KEGAUTH_HASHING_POOL_ENABLED': True,
+        'KEGAUTH_HASHING_POOL_SIZE': 1,
+        'KEGAUTH_HASHING_QUEUE_LIMIT': 0,
+    })
+    def test_login_busy(self):
+        ents.Attempt.delete_cascaded()
+        ents.User.fake(email='foo@bar.com', password='foo')
+        client = flask_webtest.TestApp(flask.current_app)
+        resp = client.get('/login')
+        resp.form['login_id'] = 'foo@bar.com'
+        resp.form['password'] = 'foo'
+
+        with mock.patch.object(
+            get_hashing_service(), 'run', autospec=True, side_effect=HashingServiceBusy
+        ):
+            resp = resp.form.submit(status=200)
+        assert resp.flashes == [
+            ('error', 'The server is too busy to process this request. Please try again shortly.')
+        ]
+        # the password was never checked, so no failure counts toward a lockout
+        assert ents.Attempt.query.count() == 0
+
+    @mock.patch.dict('flask.current_app.config', {'KEGAUTH_HASHING_POOL_ENABLED': True})
+    def test_reset_password_busy(self):
+        ents.Attempt.delete_cascaded()
+        user = ents.User.fake(password='foo')
+        token = user.token_generate()
+        client = flask_webtest.TestApp(flask.current_app)
+        resp = client.get('/reset-password/{}/{}'.format(user.id, token))
+        resp.form['password'] = resp.form['confirm'] = 'foobarbaz'
+
+        with mock.patch.object(
+            get_hashing_service(), 'run', autospec=True, side_effect=HashingServiceBusy
+        ):
+            resp = resp.form.submit(status=200)
+        assert resp.flashes == [
+            ('error', 'The server is too busy to process this request. Please try again shortly.')
+        ]
+        assert ents.Attempt.query.one().success is False
+
+        resp.form['password'] = resp.form['confirm'] = 'foobarbaz'
+        resp.form.submit(status=302)
+        assert ents.Attempt.query.filter_by(success=True).count() == 1
+        ents.User.query.session.expire_all()
+        assert ents.User.get(user.id).password == 'foobarbaz'
+
+
+class TestCalibration:
+    def test_scheme_available(self):
+        assert scheme_available('pbkdf2_sha256')
+        assert not scheme_available('not_a_scheme')
+
+    def test_measure_verify(self):
+        result = measure_verify('pbkdf2_sha256', 1000, samples=4, threads=2)
+        assert result.scheme == 'pbkdf2_sha256'
+        assert result.rounds == 1000
+        assert 0 < result.p50_ms <= result.p99_ms
+
+    def test_calibrate_schemes(self):
+        results = list(calibrate_schemes(
+            ['pbkdf2_sha256', 'pbkdf2_sha512'],
+            rounds={'pbkdf2_sha256': [1000, 2000], 'pbkdf2_sha512': [1500]},
+            samples=1,
+        ))
+        assert [(result.scheme, result.rounds) for result in results] == [
+            ('pbkdf2_sha256', 1000),
+            ('pbkdf2_sha256', 2000),
+            ('pbkdf2_sha512', 1500),
+        ]
+
+    def test_rounds_out_of_range(self):
+        check_rounds('bcrypt', 12)
+        with pytest.raises(ValueError, match='between 4 and 31'):
+            check_rounds('bcrypt', 200000)
+        # passlib would clamp these, measuring a cost other than the one asked for
+        with pytest.raises(ValueError):
+            measure_verify('bcrypt', 200000, samples=1)
+
+    def test_recommend(self):
+        results = [
+            CalibrationResult('bcrypt', 10, 150, 180),
+            CalibrationResult('bcrypt', 11, 300, 350),
+            CalibrationResult('pbkdf2_sha256', 100000, 50, 60),
+            CalibrationResult('pbkdf2_sha256', 200000, 100, 120),
+            CalibrationResult('pbkdf2_sha256', 300000, 150, 210),
+        ]
+        assert recommend_cryptcontext_kwargs(results, 200, ['bcrypt', 'pbkdf2_sha256']) == {
+            'schemes': ['bcrypt', 'pbkdf2_sha256'],
+            'deprecated': 'auto',
+            'bcrypt__rounds': 10,
+            'pbkdf2_sha256__rounds': 200000,
+        }
+        assert recommend_cryptcontext_kwargs(results, 150, ['bcrypt', 'pbkdf2_sha256']) == {
+            'schemes': ['pbkdf2_sha256', 'bcrypt'],
+            'deprecated': 'auto',
+            'pbkdf2_sha256__rounds': 200000,
+        }
+        assert recommend_cryptcontext_kwargs(results, 10, ['bcrypt', 'pbkdf2_sha256']) is None
@@ -0,0 +1,91 @@
+import io
+import json
+from unittest import mock
+
+import arrow
+import flask
+import pytest
+from authlib import jose
+from freezegun import freeze_time
+
+from keg_auth.libs.invites import (
+    InviteTokenEncoder,
+    generate_invite_urls,
+    stream_users,
+    write_invite_urls,
+)
+from keg_auth_ta.model import entities as ents
+
+
+class TestInviteUrls:
+    def setup_method(self):
+        ents.User.delete_cascaded()
+
+    @freeze_time('2020-01-01')
+    def test_token_matches_token_generate(self):
+        user = ents.User.fake()
+        assert InviteTokenEncoder().encode(user) == user.token_generate()
+
+    def test_token_verifies(self):
+        user = ents.User.fake()
+        token = InviteTokenEncoder().encode(user)
+        assert user.token_verify(token)
+
+        user.last_login_utc = arrow.utcnow().shift(minutes=1)
+        assert not user.token_verify(token)
+
+    def test_uses_token_payload(self):
+        user = ents.User.fake()
+        get_token_payload = ents.User.get_token_payload
+
+        def custom_payload(self, payload, expires_in):
+            payload['extra'] = 'foo'
+            return get_token_payload(self, payload, expires_in)
+
+        with mock.patch.object(ents.User, 'get_token_payload', custom_payload):
+            token = InviteTokenEncoder().encode(user)
+        assert user.token_verify(token)
+        assert jose.jwt.decode(token, user.get_token_signature())['extra'] == 'foo'
+
+    def test_expires_in(self):
+        user = ents.User.fake()
+        token = InviteTokenEncoder(expires_in=-10).encode(user)
+        assert not user.token_verify(token)
+
+    @pytest.mark.parametrize('kind', ['verify-account', 'reset-password'])
+    def test_urls_match_mail_manager(self, kind):
+        users = [ents.User.fake(), ents.User.fake()]
+        mail_manager = flask.current_app.auth_manager.mail_manager
+        url_method = getattr(mail_manager, kind.replace('-', '_') + '_url')
+
+        with freeze_time('2020-01-01'):
+            results = list(generate_invite_urls(users, kind=kind))
+            for user in users:
+                user.token_generate()
+
+        assert results == [(user, url_method(user)) for user in users]
+
+    def test_unknown_kind(self):
+        with pytest.raises(ValueError):
+            list(generate_invite_urls([], kind='login'))
+
+    def test_stream_users(self):
+        users = [ents.User.fake() for _ in range(3)]
+        query = ents.User.query.order_by(ents.User.id)
+        assert list(stream_users(query, batch_size=2)) == users
+
+    def test_write(self):
+        user = ents.User.fake(email='foo@bar.com')
+        rows = [(user, 'http://foo')]
+
+        stream = io.StringIO()
+        assert write_invite_urls(rows, stream) == 1
+        assert stream.getvalue().splitlines() == [
+            'user_id,username,url', f'{user.id},foo@bar.com,http://foo'
+        ]
+
+        stream = io.StringIO()
+        assert write_invite_urls(rows, stream, format='jsonl') == 1
+        assert json.loads(stream.getvalue()) == {
+            'user_id': user.id, 'username': 'foo@bar.com', 'url': 'http://foo'
+        }
@@ -0,0 +1,179 @@
+import base64
+import hashlib
+import json
+import time
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+
+from keg_auth.libs.jwks import JWKSVerifier, SigningKey, jwk_thumbprint, load_signing_keys
+
+
+def private_pem(key):
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+
+
+def public_pem(key):
+    return key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    ).decode()
+
+
+rsa_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+ed_key = ed25519.Ed25519PrivateKey.generate()
+
+
+class FakeTimer:
+    def __init__(self, now=1000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestSigningKey:
+    def test_thumbprint(self):
+        # only the required members count, in lexicographic order, serialized without whitespace
+        jwk = {'kty': 'OKP', 'crv': 'Ed25519', 'x': 'abc', 'kid': 'foo', 'use': 'sig'}
+        digest = hashlib.sha256(b'{"crv":"Ed25519","kty":"OKP","x":"abc"}').digest()
+        assert jwk_thumbprint(jwk) == base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+    @pytest.mark.parametrize('key, algorithm, kty', [
+        (rsa_key, 'RS256', 'RSA'),
+        (ed_key, 'EdDSA', 'OKP'),
+    ])
+    def test_private_key(self, key, algorithm, kty):
+        signing_key = SigningKey(private_pem(key))
+        assert signing_key.algorithm == algorithm
+        assert signing_key.jwk['kty'] == kty
+        assert signing_key.jwk['kid'] == signing_key.kid == jwk_thumbprint(signing_key.jwk)
+        assert 'd' not in signing_key.jwk
+
+        # the public half of the key has the same ID
+        public_key = SigningKey(public_pem(key))
+        assert public_key.private_key is None
+        assert public_key.kid == signing_key.kid
+
+    def test_unsupported_key(self):
+        key = ec.generate_private_key(ec.SECP256R1())
+        with pytest.raises(ValueError, match='RSA or Ed25519'):
+            SigningKey(private_pem(key))
+
+    def test_load_signing_keys(self):
+        keys = load_signing_keys([private_pem(ed_key), public_pem(rsa_key)])
+        assert [key.algorithm for key in keys] == ['EdDSA', 'RS256']
+
+        with pytest.raises(ValueError, match='must be a private key'):
+            load_signing_keys([public_pem(rsa_key)])
+
+
+class TestJWKSVerifier:
+    def setup_method(self):
+        self.signing_key = SigningKey(private_pem(rsa_key))
+        self.jwks = {'keys': [self.signing_key.jwk]}
+        self.fetched = []
+
+    def fetch(self, url):
+        self.fetched.append(url)
+        return self.jwks
+
+    def token(self, signing_key=None, **claims):
+        signing_key = signing_key or self.signing_key
+        return jwt.encode(
+            dict({'sub': 'foo', 'exp': int(time.time()) + 60}, **claims),
+            signing_key.private_key,
+            algorithm=signing_key.algorithm,
+            headers={'kid': signing_key.kid},
+        )
+
+    def test_verify(self):
+        verifier = JWKSVerifier('https://example.com/jwks.json', fetch=self.fetch)
+        assert verifier.verify(self.token())['sub'] == 'foo'
+        assert verifier.verify(self.token())['sub'] == 'foo'
+        assert self.fetched == ['https://example.com/jwks.json']
+
+        with pytest.raises(jwt.ExpiredSignatureError):
+            verifier.verify(self.token(exp=int(time.time()) - 60))
+
+    def test_decode_options(self):
+        verifier = JWKSVerifier('https://example.com/jwks.json', fetch=self.fetch, audience='bar')
+        with pytest.raises(jwt.InvalidAudienceError):
+            verifier.verify(self.token(aud='baz'))
+        assert verifier.verify(self.token(aud='bar'))['aud'] == 'bar'
+
+    def test_rotation(self):
+        timer = FakeTimer()
+        verifier = JWKSVerifier('https://example.com/jwks.json', fetch=self.fetch, timer=timer)
+        verifier.verify(self.token())
+
+        new_key = SigningKey(private_pem(ed_key))
+        self.jwks = {'keys': [new_key.jwk, self.signing_key.jwk]}
+
+        # unknown keys are fetched, but not more often than the minimum interval
+        with pytest.raises(jwt.InvalidKeyError):
+            verifier.verify(self.token(new_key))
+        assert len(self.fetched) == 1
+
+        timer.now += 60
+        assert verifier.verify(self.token(new_key))['sub'] == 'foo'
+        assert verifier.verify(self.token())['sub'] == 'foo'
+        assert len(self.fetched) == 2
+
+    def test_stale(self):
+        timer = FakeTimer()
+        verifier = JWKSVerifier('https://example.com/jwks.json', fetch=self.fetch, timer=timer,
+                                max_age=300)
+        verifier.verify(self.token())
+        timer.now += 300
+        verifier.verify(self.token())
+        assert len(self.fetched) == 2
+
+    def test_fetch_failure_keeps_keys(self):
+        timer = FakeTimer()
+        verifier = JWKSVerifier('https://example.com/jwks.json', fetch=self.fetch, timer=timer,
+                                max_age=300)
+        verifier.verify(self.token())
+
+        def fail(url):
+            raise OSError('unreachable')
+
+        verifier.fetch = fail
+        timer.now += 300
+        assert verifier.verify(self.token())['sub'] == 'foo'
+
+    def test_forged_signature(self):
+        verifier = JWKSVerifier('https://example.com/jwks.json', fetch=self.fetch)
+        other = SigningKey(private_pem(rsa.generate_private_key(65537, 2048)))
+        other.kid = self.signing_key.kid
+        with pytest.raises(jwt.InvalidSignatureError):
+            verifier.verify(self.token(other))
+
+    def test_cache_file(self, tmp_path):
+        cache_path = str(tmp_path / 'jwks.json')
+        timer = FakeTimer()
+        verifier = JWKSVerifier('https://example.com/jwks.json', cache_path=cache_path,
+                                fetch=self.fetch, timer=timer)
+        verifier.verify(self.token())
+        with open(cache_path) as fo:
+            assert json.load(fo) == {'jwks': self.jwks, 'fetched': 1000}
+
+        # a new process verifies from the file, without fetching
+        verifier = JWKSVerifier('https://example.com/jwks.json', cache_path=cache_path,
+                                fetch=self.fetch, timer=timer)
+        assert verifier.verify(self.token())['sub'] == 'foo'
+        assert len(self.fetched) == 1
+
+    def test_cache_file_unreadable(self, tmp_path):
+        cache_path = tmp_path / 'jwks.json'
+        cache_path.write_text('not json')
+        verifier = JWKSVerifier('https://example.com/jwks.json', cache_path=str(cache_path),
+                                fetch=self.fetch)
+        assert verifier.verify(self.token())['sub'] == 'foo'
+        assert len(self.fetched) == 1
@@ -0,0 +1,105 @@
+from unittest import mock
+
+import arrow
+import flask
+import pytest
+
+from keg_auth.libs import last_login
+from keg_auth.libs.last_login import LastLoginRecorder
+from keg_auth_ta.model.entities import User
+
+
+class TestLastLoginRecorder:
+    def setup_method(self):
+        User.delete_cascaded()
+
+    def recorder(self, **kwargs):
+        return LastLoginRecorder(flask.current_app, User, **kwargs)
+
+    def test_interactive(self):
+        user = User.fake(last_login_utc=arrow.utcnow())
+        recorder = self.recorder(interval=60)
+        assert recorder.record(user)
+        assert recorder.record(user)
+
+    def test_throttled(self):
+        user = User.fake(last_login_utc=arrow.utcnow().shift(seconds=-30))
+        recorder = self.recorder(interval=60)
+        assert not recorder.record(user, interactive=False)
+
+        user.last_login_utc = arrow.utcnow().shift(seconds=-60)
+        assert recorder.record(user, interactive=False)
+        assert User.get(user.id).last_login_utc > arrow.utcnow().shift(seconds=-5)
+
+        # a loader may hold a stale copy of the user
+        user.last_login_utc = None
+        assert not recorder.record(user, interactive=False)
+
+    def test_no_interval(self):
+        user = User.fake(last_login_utc=arrow.utcnow())
+        recorder = self.recorder(interval=0)
+        assert recorder.record(user, interactive=False)
+        assert recorder.record(user, interactive=False)
+
+    def test_deferred(self):
+        user1 = User.fake(last_login_utc=None)
+        user2 = User.fake(last_login_utc=None)
+        recorder = self.recorder(interval=60, deferred=True, flush_interval=3600)
+        try:
+            assert recorder.record(user1, interactive=False)
+            assert recorder.record(user2, interactive=False)
+            assert not recorder.record(user2, interactive=False)
+            assert User.get(user1.id).last_login_utc is None
+
+            assert recorder.flush() == 2
+            User.query.session.expire_all()
+            assert User.get(user1.id).last_login_utc is not None
+            assert User.get(user2.id).last_login_utc is not None
+            assert recorder.flush() == 0
+        finally:
+            recorder.stop()
+
+    def test_stop_flushes(self):
+        user = User.fake(last_login_utc=None)
+        recorder = self.recorder(deferred=True, flush_interval=3600)
+        recorder.record(user, interactive=False)
+        recorder.stop()
+        User.query.session.expire_all()
+        assert User.get(user.id).last_login_utc is not None
+
+    def test_stopped_at_exit(self):
+        users = [User.fake(last_login_utc=None) for _ in range(2)]
+        recorders = [self.recorder(deferred=True, flush_interval=3600) for _ in users]
+        for recorder, user in zip(recorders, users):
+            recorder.record(user, interactive=False)
+        assert set(recorders) <= set(last_login._running)
+
+        last_login._stop_running()
+        assert not set(recorders) & set(last_login._running)
+        User.query.session.expire_all()
+        assert all(User.get(user.id).last_login_utc is not None for user in users)
+
+
+class TestRequestLoaderLogin:
+    def setup_method(self):
+        User.delete_cascaded()
+
+    @pytest.mark.parametrize('interval, writes', [(60, 1), (0, 3)])
+    def test_jwt(self, interval, writes):
+        user = User.fake(last_login_utc=None)
+        loader = flask.current_app.auth_manager.get_request_loader('jwt')
+        headers = {'Authorization': f'Bearer {loader.create_access_token(user)}'}
+
+        results = []
+        with mock.patch.dict(flask.current_app.config, {'KEGAUTH_LAST_LOGIN_INTERVAL': interval}):
+            recorder = flask.current_app.auth_manager.last_login_recorder
+            record = recorder.record
+            with mock.patch.object(
+                recorder, 'record',
+                side_effect=lambda *args, **kwargs: results.append(record(*args, **kwargs)),
+            ):
+                for _ in range(3):
+                    with flask.current_app.test_request_context('/', headers=headers):
+                        assert loader.get_authenticated_user() == user
+        assert results.count(True) == writes
+        assert len(results) == 3
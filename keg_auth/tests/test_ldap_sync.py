@@ -0,0 +1,174 @@
+import flask
+import mock
+import pytest
+
+try:
+    import ldap
+except ImportError:
+    ldap = None
+
+from keg_auth.libs.ldap_sync import LdapDirectory, LdapSync, connect_directory
+from keg_auth_ta.model import entities as ents
+
+
+class TestLdapDirectory:
+    @mock.patch('keg_auth.libs.ldap_sync.paged_search', autospec=True, spec_set=True)
+    def test_read(self, m_paged_search):
+        m_paged_search.side_effect = [
+            iter([
+                ('uid=foo,ou=people,dc=example,dc=org', {'uid': [b'foo@bar.com']}),
+                ('uid=nameless,ou=people,dc=example,dc=org', {}),
+            ]),
+            iter([
+                ('cn=admins,ou=groups,dc=example,dc=org', {
+                    'cn': [b'admins'],
+                    'member': [b'uid=foo, ou=people, dc=example, dc=org'],
+                }),
+                ('cn=empty,ou=groups,dc=example,dc=org', {'cn': [b'empty']}),
+            ]),
+        ]
+        config = dict(
+            flask.current_app.config,
+            KEGAUTH_LDAP_SYNC_USER_BASE_DN='ou=people,dc=example,dc=org',
+            KEGAUTH_LDAP_SYNC_GROUP_BASE_DN='ou=groups,dc=example,dc=org',
+        )
+        directory = LdapDirectory.read('conn', config, page_size=10)
+
+        assert directory.users == {'uid=foo,ou=people,dc=example,dc=org': 'foo@bar.com'}
+        assert directory.groups == {
+            'admins': {'uid=foo, ou=people, dc=example, dc=org'},
+            'empty': set(),
+        }
+        m_paged_search.assert_any_call(
+            'conn', 'ou=people,dc=example,dc=org', '(objectClass=person)', ['uid'], page_size=10)
+        m_paged_search.assert_any_call(
+            'conn', 'ou=groups,dc=example,dc=org', '(objectClass=groupOfNames)',
+            ['cn', 'member'], page_size=10)
+
+
+class TestLdapSync:
+    def setup_method(self):
+        ents.User.delete_cascaded()
+        ents.Group.delete_cascaded()
+
+    def sync(self, users, groups, **kwargs):
+        return LdapSync(ents.User, ents.Group, **kwargs).run(
+            LdapDirectory(users=users, groups=groups))
+
+    def test_creates_users_and_groups(self):
+        report = self.sync(
+            {'uid=foo,dc=org': 'Foo@Bar.com', 'uid=baz,dc=org': 'baz@bar.com'},
+            {'admins': {'uid=foo,dc=org'}, 'staff': {'uid=foo,dc=org', 'UID=baz, dc=org'}},
+        )
+        assert report.users_created == 2
+        assert report.groups_created == 2
+        assert report.memberships_added == 3
+        assert report.memberships_removed == 0
+
+        foo = ents.User.get_by(email='foo@bar.com')
+        baz = ents.User.get_by(email='baz@bar.com')
+        assert sorted(group.name for group in foo.groups) == ['admins', 'staff']
+        assert [group.name for group in baz.groups] == ['staff']
+
+    def test_membership_diff(self):
+        admins = ents.Group.fake(name='admins')
+        other = ents.Group.fake(name='other')
+        foo = ents.User.fake(email='foo@bar.com', groups=[admins, other])
+        baz = ents.User.fake(email='baz@bar.com')
+        unchanged = ents.User.fake(email='unchanged@bar.com', groups=[admins])
+        keys = {user.id: user.session_key for user in (foo, baz, unchanged)}
+
+        # member values may be usernames instead of DNs
+        users = {
+            'uid=foo,dc=org': 'foo@bar.com',
+            'uid=baz,dc=org': 'baz@bar.com',
+            'uid=unchanged,dc=org': 'unchanged@bar.com',
+        }
+        report = self.sync(
+            users,
+            {'admins': {'baz@bar.com', 'unchanged@bar.com'}},
+        )
+        assert report.users_created == 0
+        assert report.groups_created == 0
+        assert report.memberships_added == 1
+        assert report.memberships_removed == 1
+        assert report.sessions_invalidated == 2
+
+        foo, baz, unchanged = (ents.User.query.get(user_id) for user_id in keys)
+        # groups not in the directory are left alone
+        assert [group.name for group in foo.groups] == ['other']
+        assert [group.name for group in baz.groups] == ['admins']
+        assert foo.session_key != keys[foo.id]
+        assert baz.session_key != keys[baz.id]
+        assert unchanged.session_key == keys[unchanged.id]
+
+        # nothing left to change
+        report = self.sync(
+            users,
+            {'admins': {'baz@bar.com', 'unchanged@bar.com'}},
+        )
+        assert report.memberships_added == report.memberships_removed == 0
+        assert report.sessions_invalidated == 0
+
+    def test_invalidates_cached_sessions(self):
+        admins = ents.Group.fake(name='admins')
+        user = ents.User.fake(email='foo@bar.com', groups=[admins])
+        session_key = user.session_key
+
+        with mock.patch.object(
+            flask.current_app.auth_manager, 'invalidate_session_key', autospec=True,
+        ) as m_invalidate:
+            self.sync({}, {'admins': set()})
+        m_invalidate.assert_called_once_with(session_key)
+
+    def test_no_create_users(self):
+        report = self.sync(
+            {'uid=foo,dc=org': 'foo@bar.com'}, {'admins': {'uid=foo,dc=org'}},
+            create_users=False,
+        )
+        assert report.users_created == 0
+        assert report.memberships_added == 0
+        assert ents.User.query.count() == 0
+        assert ents.Group.get_by(name='admins')
+
+    def test_dry_run(self):
+        report = LdapSync(ents.User, ents.Group).run(
+            LdapDirectory(users={'uid=foo,dc=org': 'foo@bar.com'},
+                          groups={'admins': {'uid=foo,dc=org'}}),
+            dry_run=True,
+        )
+        assert report.users_created == 1
+        assert report.memberships_added == 1
+        assert ents.User.query.count() == 0
+        assert ents.Group.query.count() == 0
+
+
+class TestConnectDirectory:
+    def config(self, urls):
+        return dict(flask.current_app.config, KEGAUTH_LDAP_SERVER_URL=urls)
+
+    def test_no_servers(self):
+        with pytest.raises(ValueError, match='No LDAP servers configured'):
+            connect_directory(self.config(None))
+
+    @pytest.mark.skipif(not ldap, reason='requires LDAP library')
+    @mock.patch('ldap.initialize', autospec=True, spec_set=True)
+    def test_failover(self, m_initialize):
+        refused, down, conn = mock.MagicMock(), mock.MagicMock(), mock.MagicMock()
+        refused.simple_bind_s.side_effect = ldap.INVALID_CREDENTIALS()
+        down.simple_bind_s.side_effect = ldap.SERVER_DOWN()
+        m_initialize.side_effect = [refused, down, conn]
+
+        assert connect_directory(self.config(['ldap://a', 'ldap://b', 'ldap://c'])) is conn
+        refused.unbind_s.assert_called_once_with()
+        down.unbind_s.assert_called_once_with()
+        assert not conn.unbind_s.called
+
+    @pytest.mark.skipif(not ldap, reason='requires LDAP library')
+    @mock.patch('ldap.initialize', autospec=True, spec_set=True)
+    def test_all_fail(self, m_initialize):
+        conn = m_initialize.return_value
+        conn.simple_bind_s.side_effect = ldap.SERVER_DOWN()
+        with pytest.raises(ldap.SERVER_DOWN):
+            connect_directory(self.config(['ldap://a']))
+        conn.unbind_s.assert_called_once_with()
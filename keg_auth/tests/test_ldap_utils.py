@@ -0,0 +1,121 @@
+from unittest import mock
+
+try:
+    import ldap
+except ImportError:
+    ldap = None
+import pytest
+
+from keg_auth.libs.ldap_utils import (
+    LdapServer,
+    LdapServerPool,
+    check_credential_fingerprint,
+    credential_fingerprint,
+    paged_search,
+)
+
+
+class FakeTimer:
+    def __init__(self, now=1000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.skipif(not ldap, reason='requires LDAP library')
+class TestLdapServer:
+    def test_backoff(self):
+        timer = FakeTimer()
+        server = LdapServer('abc123', failure_backoff=30, max_backoff=100, timer=timer)
+        assert not server.is_down()
+
+        server.record_failure()
+        assert server.down_until == 1030
+        server.record_failure()
+        assert server.down_until == 1060
+        server.record_failure()
+        assert server.down_until == 1100
+        assert server.is_down()
+
+        server.record_success(0.1)
+        assert not server.is_down()
+        assert server.failures == 0
+
+    def test_latency(self):
+        server = LdapServer('abc123')
+        server.record_success(1.0)
+        assert server.latency == 1.0
+        server.record_success(2.0)
+        assert server.latency == pytest.approx(1.2)
+
+    @mock.patch('ldap.initialize', autospec=True, spec_set=True)
+    def test_stale_pooled_connection(self, mocked_ldap):
+        stale, fresh = mock.MagicMock(), mock.MagicMock()
+        stale.simple_bind_s.side_effect = ldap.SERVER_DOWN()
+        fresh.simple_bind_s.return_value = (ldap.RES_BIND, )
+        mocked_ldap.return_value = fresh
+
+        server = LdapServer('abc123')
+        server.release(stale)
+        assert server.simple_bind('uid=foo', 'bar') is True
+        assert server.failures == 0
+        stale.unbind_s.assert_called_once_with()
+        assert list(server._idle) == [fresh]
+
+    @mock.patch('ldap.initialize', autospec=True, spec_set=True)
+    def test_pool_size(self, mocked_ldap):
+        server = LdapServer('abc123', pool_size=1)
+        first, second = mock.MagicMock(), mock.MagicMock()
+        server.release(first)
+        server.release(second)
+        assert list(server._idle) == [first]
+        second.unbind_s.assert_called_once_with()
+
+
+@pytest.mark.skipif(not ldap, reason='requires LDAP library')
+class TestLdapServerPool:
+    def test_ordered_servers(self):
+        timer = FakeTimer()
+        pool = LdapServerPool(['abc123', 'def456', 'ghi789'], timer=timer)
+        abc, def_, ghi = pool.servers
+        assert pool.ordered_servers() == [abc, def_, ghi]
+
+        abc.record_success(0.5)
+        def_.record_success(0.1)
+        ghi.record_failure()
+        assert pool.ordered_servers() == [def_, abc, ghi]
+
+        timer.now += 30
+        assert pool.ordered_servers() == [ghi, def_, abc]
+
+
+@pytest.mark.skipif(not ldap, reason='requires LDAP library')
+class TestPagedSearch:
+    def test_follows_cookie(self):
+        from ldap.controls import SimplePagedResultsControl
+
+        def page(cookie):
+            return mock.Mock(controlType=SimplePagedResultsControl.controlType, cookie=cookie)
+
+        conn = mock.MagicMock()
+        conn.result3.side_effect = [
+            (ldap.RES_SEARCH_RESULT, [('uid=foo', {}), (None, ['ldap://ref'])], 1, [page(b'a')]),
+            (ldap.RES_SEARCH_RESULT, [('uid=bar', {})], 2, [page(b'')]),
+        ]
+        results = list(paged_search(conn, 'dc=org', '(uid=*)', ['uid'], page_size=1))
+        assert results == [('uid=foo', {}), ('uid=bar', {})]
+        assert conn.search_ext.call_count == 2
+
+
+class TestCredentialFingerprint:
+    def test_check(self):
+        fingerprint = credential_fingerprint('foo', rounds=1000)
+        assert check_credential_fingerprint(fingerprint, 'foo')
+        assert not check_credential_fingerprint(fingerprint, 'bar')
+
+    def test_salted(self):
+        first, second = credential_fingerprint('foo'), credential_fingerprint('foo')
+        assert first[0] != second[0]
+        assert first[2] != second[2]
+        assert first[1] == 50000
@@ -0,0 +1,221 @@
+import arrow
+import flask
+import mock
+import pytest
+
+from keg_auth.libs.authenticators import (
+    AttemptBlocked,
+    ForgotPasswordViewResponder,
+    PasswordFormViewResponder,
+    ResetPasswordViewResponder,
+)
+from keg_auth.libs.lockout import (
+    LockoutPolicy,
+    LockoutSimulator,
+    load_attempt_history,
+    simulate_lockout,
+)
+from keg_auth_ta.model import entities as ents
+
+
+class TestLockoutSimulator:
+    def replay(self, attempts, policy=LockoutPolicy(3, 60, 300), success_resets=True):
+        simulator = LockoutSimulator(policy, success_resets=success_resets)
+        return [blocked for _, _, blocked in simulator.replay_key(attempts)]
+
+    def test_failures_within_timespan_block(self):
+        assert self.replay([(0, False), (10, False), (20, False), (30, True)]) == [
+            False, False, False, True
+        ]
+
+    def test_failures_outside_timespan_do_not_block(self):
+        assert self.replay([(0, False), (10, False), (100, False), (110, True)]) == [
+            False, False, False, False
+        ]
+
+    def test_lockout_period(self):
+        attempts = [(0, False), (10, False), (20, False), (200, True), (321, True)]
+        assert self.replay(attempts) == [False, False, False, True, False]
+
+    def test_success_resets(self):
+        attempts = [(0, False), (10, False), (15, True), (20, False), (30, True)]
+        assert self.replay(attempts) == [False, False, False, False, False]
+
+    def test_success_does_not_reset(self):
+        attempts = [(0, True), (10, True), (15, True), (20, True)]
+        assert self.replay(attempts, success_resets=False) == [False, False, False, True]
+
+    def test_blocked_attempts_do_not_count(self):
+        policy = LockoutPolicy(2, 60, 30)
+        # blocked attempts at 20 and 30 do not extend the lockout from the failure at 10
+        attempts = [(0, False), (10, False), (20, False), (30, False), (45, True), (75, True)]
+        assert self.replay(attempts, policy=policy) == [False, False, True, True, False, False]
+
+    def test_lockout_shorter_than_timespan(self):
+        # once the lockout has passed, the failures that caused it do not block again
+        attempts = [(0, False), (10, False), (20, False), (50, False), (51, False)]
+        assert self.replay(attempts, policy=LockoutPolicy(2, 600, 30)) == [
+            False, False, True, False, True
+        ]
+
+    def test_inputs_are_independent(self):
+        simulator = LockoutSimulator(LockoutPolicy(1, 60, 60))
+        results = list(simulator.replay([('bar', '1.1.1.1', 0, False),
+                                         ('foo', '1.1.1.1', 5, False)]))
+        assert [blocked for _, _, _, blocked in results] == [False, False]
+
+    def test_ip_limit(self):
+        simulator = LockoutSimulator(LockoutPolicy(2, 60, 60), ip_limit=True)
+        results = list(simulator.replay([
+            ('bar', '1.1.1.1', 0, False),
+            ('foo', '1.1.1.1', 5, False),
+            ('baz', '1.1.1.1', 10, False),
+            ('baz', '1.1.1.2', 80, False),
+            ('qux', '1.1.1.2', 81, False),
+        ]))
+        assert [blocked for _, _, _, blocked in results] == [False, False, True, False, False]
+
+    def test_run(self):
+        simulator = LockoutSimulator(LockoutPolicy(2, 60, 300))
+        report = simulator.run([
+            (user_input, None, timestamp, success)
+            for user_input, timestamp, success in sorted([
+                ('attacker', 0, False),
+                ('attacker', 1, False),
+                ('attacker', 2, False),
+                ('attacker', 3, False),
+                ('user1', 0, False),
+                ('user1', 10, True),
+                ('user2', 0, False),
+                ('user2', 10, False),
+                ('user2', 20, True),
+            ], key=lambda row: row[1])
+        ])
+        assert report.attempts == 9
+        assert report.blocked == 3
+        assert report.users == 2
+        assert report.users_locked_out == 1
+        assert report.successes_blocked == 1
+        assert report.attacker_attempts == 4
+        assert report.attacker_attempts_blocked == 2
+
+
+class TestLockoutHistory:
+    def setup_method(self):
+        ents.Attempt.delete_cascaded()
+
+    def test_load_attempt_history(self):
+        now = arrow.get(2020, 1, 1)
+        ents.Attempt.fake(user_input='foo', attempt_type='login', source_ip='1.1.1.1',
+                          datetime_utc=now.shift(seconds=10), success=True)
+        ents.Attempt.fake(user_input='foo', attempt_type='login', source_ip='1.1.1.2',
+                          datetime_utc=now, success=False)
+        ents.Attempt.fake(user_input='bar', attempt_type='login', source_ip='1.1.1.2',
+                          datetime_utc=now.shift(seconds=5), success=False)
+        ents.Attempt.fake(user_input='foo', attempt_type='reset', source_ip='1.1.1.1',
+                          datetime_utc=now.shift(seconds=10), success=True)
+
+        ts = now.timestamp()
+        assert load_attempt_history(ents.Attempt, 'login') == [
+            ('foo', '1.1.1.2', ts, False),
+            ('bar', '1.1.1.2', ts + 5, False),
+            ('foo', '1.1.1.1', ts + 10, True),
+        ]
+        assert load_attempt_history(
+            ents.Attempt, 'login', since=now.shift(seconds=5)
+        ) == [
+            ('bar', '1.1.1.2', ts + 5, False),
+            ('foo', '1.1.1.1', ts + 10, True),
+        ]
+
+    def check_matches_is_attempt_blocked(self, responder_cls, policy, attempts, ip_limit=False):
+        # drive the live attempt limiting logic, then replay the logged history with the same
+        # policy: the simulator must block exactly the attempts that were blocked
+        responder = responder_cls(None)
+        attempt_type = responder.get_attempt_type()
+        start = arrow.get(2020, 1, 1)
+
+        blocked = []
+        config = {
+            'KEGAUTH_ATTEMPT_IP_LIMIT': ip_limit,
+            'KEGAUTH_ATTEMPT_LIMIT': policy.limit,
+            'KEGAUTH_ATTEMPT_TIMESPAN': policy.timespan,
+            'KEGAUTH_ATTEMPT_LOCKOUT': policy.lockout,
+        }
+        with mock.patch.dict(flask.current_app.config, config):
+            for offset, user_input, source_ip, success in attempts:
+                with mock.patch(
+                    'keg_auth.libs.authenticators.arrow.utcnow',
+                    return_value=start.shift(seconds=offset),
+                ), flask.current_app.test_request_context(
+                    environ_base={'REMOTE_ADDR': source_ip},
+                ):
+                    try:
+                        attempt = responder.check_blocking(user_input)
+                    except AttemptBlocked:
+                        blocked.append(True)
+                        continue
+                    blocked.append(False)
+                    if success:
+                        responder.update_attempt(attempt, success=True)
+
+        assert any(blocked)
+        assert not all(blocked)
+        simulator = LockoutSimulator(
+            policy, success_resets=attempt_type != 'reset', ip_limit=ip_limit,
+        )
+        history = load_attempt_history(ents.Attempt, attempt_type)
+        assert [b for _, _, _, b in simulator.replay(history)] == blocked
+
+    @pytest.mark.parametrize('responder_cls', [
+        PasswordFormViewResponder,
+        ForgotPasswordViewResponder,
+        ResetPasswordViewResponder,
+    ])
+    @pytest.mark.parametrize('policy', [
+        LockoutPolicy(3, 60, 120),
+        # lockout shorter than the timespan
+        LockoutPolicy(2, 600, 30),
+    ])
+    def test_matches_is_attempt_blocked(self, responder_cls, policy):
+        offsets = [
+            (0, False), (5, False), (6, False), (7, True), (30, False), (31, False),
+            (32, False), (40, False), (50, True), (100, True), (130, False), (131, False),
+            (200, True), (201, False), (202, False), (203, False), (204, True), (400, True),
+        ]
+        self.check_matches_is_attempt_blocked(responder_cls, policy, [
+            (offset, 'foo', '1.1.1.1', success) for offset, success in offsets
+        ])
+
+    @pytest.mark.parametrize('responder_cls', [
+        PasswordFormViewResponder,
+        ResetPasswordViewResponder,
+    ])
+    def test_matches_is_attempt_blocked_ip_limit(self, responder_cls):
+        self.check_matches_is_attempt_blocked(responder_cls, LockoutPolicy(3, 60, 30), [
+            (0, 'foo', '1.1.1.1', False),
+            (1, 'bar', '1.1.1.1', False),
+            (2, 'baz', '1.1.1.2', False),
+            (3, 'baz', '1.1.1.1', False),
+            (4, 'qux', '1.1.1.1', False),
+            (5, 'foo', '1.1.1.3', False),
+            (40, 'bar', '1.1.1.2', True),
+            (41, 'baz', '1.1.1.2', False),
+            (42, 'foo', '1.1.1.3', False),
+            (43, 'foo', '1.1.1.3', False),
+            (44, 'qux', '1.1.1.3', False),
+            (50, 'foo', '1.1.1.1', True),
+            (90, 'foo', '1.1.1.1', True),
+        ], ip_limit=True)
+
+    def test_simulate_lockout(self):
+        start = arrow.get(2020, 1, 1)
+        for i in range(5):
+            ents.Attempt.fake(user_input='foo', attempt_type='login', success=False,
+                              datetime_utc=start.shift(seconds=i))
+
+        reports = simulate_lockout(
+            ents.Attempt, 'login', [LockoutPolicy(3, 60, 60), LockoutPolicy(10, 60, 60)]
+        )
+        assert [report.blocked for report in reports] == [2, 0]
+        assert [report.policy.limit for report in reports] == [3, 10]
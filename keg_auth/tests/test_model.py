@@ -90,6 +90,116 @@ class TestUserTokenMixin(object):
     def test_get_user_for_api_token_bad_token(self, token):
         assert ents.UserWithToken.get_user_for_api_token(token) is None
 
+    def test_generate_api_key(self):
+        user = ents.UserWithToken.fake()
+        api_key = user.generate_api_key()
+
+        prefix, key_id, secret = api_key.split('.')
+        assert (prefix, key_id) == ('kak', user.api_key_id)
+        assert secret not in user.api_key_digest
+        assert ents.UserWithToken.get_user_for_api_token(api_key) is user
+
+        # a new key replaces the old one
+        assert user.generate_api_key() != api_key
+        assert ents.UserWithToken.get_user_for_api_token(api_key) is None
+
+    def test_get_user_for_api_key_no_password_verify(self):
+        user = ents.UserWithToken.fake(token='1234')
+        api_key = user.generate_api_key()
+        with mock.patch('passlib.context.CryptContext.verify') as m_verify:
+            assert ents.UserWithToken.get_user_for_api_token(api_key.encode()) is user
+        assert not m_verify.called
+
+    @pytest.mark.parametrize('transform', [
+        lambda key: key[:-1],
+        lambda key: key.replace('kak.', 'kak.0'),
+        lambda key: 'kak.' + key,
+    ])
+    def test_get_user_for_api_key_invalid(self, transform):
+        user = ents.UserWithToken.fake()
+        api_key = user.generate_api_key()
+        assert ents.UserWithToken.get_user_for_api_token(transform(api_key)) is None
+
+    def test_get_user_for_api_key_cleared(self):
+        user = ents.UserWithToken.fake()
+        api_key = user.generate_api_key()
+        user.clear_api_key()
+        assert ents.UserWithToken.get_user_for_api_token(api_key) is None
+
+    def test_api_key_pepper(self):
+        user = ents.UserWithToken.fake()
+        api_key = user.generate_api_key()
+        with mock.patch.dict(flask.current_app.config, {'KEGAUTH_API_TOKEN_PEPPER': 'pepper'}):
+            assert ents.UserWithToken.get_user_for_api_token(api_key) is None
+            api_key = user.generate_api_key()
+            assert ents.UserWithToken.get_user_for_api_token(api_key) is user
+
+    def test_legacy_api_token_disabled(self):
+        user = ents.UserWithToken.fake(token='1234')
+        api_token = user.generate_api_token('1234')
+        with mock.patch.dict(
+            flask.current_app.config, {'KEGAUTH_API_TOKEN_LEGACY_ENABLED': False}
+        ):
+            assert ents.UserWithToken.get_user_for_api_token(api_token) is None
+        assert ents.UserWithToken.get_user_for_api_token(api_token) is user
+
+
+class TestCredentialCache:
+    def setup_method(self):
+        ents.UserWithToken.delete_cascaded()
+        flask.current_app.auth_manager.credential_cache.clear()
+
+    def test_repeat_lookup_skips_verify(self):
+        user = ents.UserWithToken.fake(token='1234')
+        api_token = user.generate_api_token('1234')
+        with mock.patch(
+            'passlib.context.CryptContext.verify', autospec=True, return_value=True
+        ) as m_verify:
+            assert ents.UserWithToken.get_user_for_api_token(api_token) is user
+            assert ents.UserWithToken.get_user_for_api_token(api_token) is user
+        assert m_verify.call_count == 1
+        assert api_token not in str(flask.current_app.auth_manager.credential_cache._data)
+
+    def test_failed_lookup_not_cached(self):
+        ents.UserWithToken.fake(email='foo@bar.com', token='1234')
+        api_token = '{}.5678'.format(base64.urlsafe_b64encode(b'foo@bar.com').decode())
+        assert ents.UserWithToken.get_user_for_api_token(api_token) is None
+        assert len(flask.current_app.auth_manager.credential_cache) == 0
+
+    @pytest.mark.parametrize('change', [
+        lambda user: user.reset_auth_token(),
+        lambda user: user.reset_session_key(),
+        lambda user: user.generate_api_key(),
+    ])
+    def test_invalidated(self, change):
+        user = ents.UserWithToken.fake(token='1234')
+        api_token = user.generate_api_token('1234')
+        api_key = user.generate_api_key()
+        assert ents.UserWithToken.get_user_for_api_token(api_token) is user
+        assert ents.UserWithToken.get_user_for_api_token(api_key) is user
+
+        assert len(flask.current_app.auth_manager.credential_cache) == 2
+        change(user)
+        assert len(flask.current_app.auth_manager.credential_cache) == 0
+
+    def test_changed_elsewhere(self):
+        # e.g. the token was reset by another process: the cached entry no longer matches
+        user = ents.UserWithToken.fake(token='1234')
+        api_token = user.generate_api_token('1234')
+        assert ents.UserWithToken.get_user_for_api_token(api_token) is user
+
+        user.session_key = 'rotated'
+        assert ents.UserWithToken.get_user_for_api_token(api_token) is user
+        user.token = '5678'
+        assert ents.UserWithToken.get_user_for_api_token(api_token) is None
+
+    def test_disabled(self):
+        with mock.patch.dict(flask.current_app.config, {'KEGAUTH_CREDENTIAL_CACHE_TTL': 0}):
+            assert flask.current_app.auth_manager.credential_cache is None
+            user = ents.UserWithToken.fake()
+            api_key = user.generate_api_key()
+            assert ents.UserWithToken.get_user_for_api_token(api_key) is user
+
 
 class TestUser(object):
     def setup_method(self):
@@ -169,6 +279,41 @@ class TestUser(object):
         assert user.token_verify(token)
         assert not user.token_verify(token, _block_legacy=True)
 
+        with mock.patch.dict(flask.current_app.config, {'KEGAUTH_TOKEN_LEGACY_ENABLED': False}):
+            assert not user.token_verify(token)
+
+    def test_bad_signature_single_decode(self):
+        user = ents.User.fake()
+        header, payload, _ = user.token_generate().split('.')
+        forged = '.'.join((header, payload, 'Zm9yZ2Vk'))
+
+        with mock.patch('keg_auth.model.jose.jwt.decode', wraps=jose.jwt.decode) as m_decode:
+            assert not user.token_verify(forged)
+            assert not user.token_verify('not-a-jwt')
+        assert m_decode.call_count == 1
+
+    def test_token_signature_memoized(self):
+        user = ents.User.fake()
+        signature = user.get_token_signature()
+        with mock.patch.object(
+            ents.User, 'get_token_salt', autospec=True, side_effect=ents.User.get_token_salt,
+        ) as m_salt:
+            # an app overriding the salt is not cached
+            assert user.get_token_signature() == signature
+            assert m_salt.call_count == 1
+
+        with mock.patch(
+            'keg_auth.model._token_signing_key', autospec=True,
+        ) as m_signing_key:
+            assert user.get_token_signature() == signature
+            assert not m_signing_key.called
+
+        assert user.get_token_signature(hashlib.sha1) != signature
+        user.last_login_utc = arrow.utcnow()
+        assert user.get_token_signature() != signature
+        with mock.patch.dict(flask.current_app.config, {'SECRET_KEY': 'other'}):
+            assert user.get_token_signature() != signature
+
     def test_token_salt_info_changed(self):
         def check_field(field, new_value):
             user = ents.User.fake(last_login_utc=None)
@@ -642,6 +787,81 @@ class TestGroup(object):
         assert user.session_key == original_session_key
 
 
+class TestRefreshTokenMixin:
+    def setup_method(self):
+        ents.RefreshToken.delete_cascaded()
+
+    def expires(self, **kwargs):
+        return arrow.utcnow().shift(**(kwargs or {'days': 1}))
+
+    def issue(self, user_id=1, **kwargs):
+        _, token = ents.RefreshToken.issue(user_id, self.expires(**kwargs))
+        db.session.commit()
+        return token
+
+    def test_issue(self):
+        token = self.issue()
+        prefix, token_id, secret = token.split('.')
+        assert prefix == 'krt'
+        record = ents.RefreshToken.get_by(token_id=token_id)
+        assert record.user_id == 1
+        # only a digest of the secret is stored
+        assert secret not in record.digest
+
+    def test_rotate(self):
+        token = self.issue()
+        user_id, new_token = ents.RefreshToken.rotate(token, self.expires())
+        assert user_id == 1
+        assert new_token != token
+
+        old = ents.RefreshToken.get_by(token_id=token.split('.')[1])
+        new = ents.RefreshToken.get_by(token_id=new_token.split('.')[1])
+        assert old.used_utc is not None
+        assert new.family_id == old.family_id
+        assert ents.RefreshToken.rotate(new_token, self.expires())[0] == 1
+
+    @pytest.mark.parametrize('token', [
+        None,
+        'foo',
+        'kak.abc.def',
+        'krt.abc.def',
+    ])
+    def test_rotate_malformed(self, token):
+        assert ents.RefreshToken.rotate(token, self.expires()) is None
+
+    def test_rotate_wrong_secret(self):
+        token = self.issue()
+        assert ents.RefreshToken.rotate(token + 'x', self.expires()) is None
+        assert ents.RefreshToken.rotate(token, self.expires()) is not None
+
+    def test_rotate_expired(self):
+        token = self.issue(minutes=-1)
+        assert ents.RefreshToken.rotate(token, self.expires()) is None
+
+    def test_reuse_revokes_family(self):
+        token = self.issue()
+        other_token = self.issue()
+        _, new_token = ents.RefreshToken.rotate(token, self.expires())
+
+        # the old token turning up again means it was copied
+        assert ents.RefreshToken.rotate(token, self.expires()) is None
+        assert ents.RefreshToken.rotate(new_token, self.expires()) is None
+        assert ents.RefreshToken.rotate(other_token, self.expires()) is not None
+
+    def test_revoke_user(self):
+        token = self.issue()
+        other_token = self.issue(user_id=2)
+        assert ents.RefreshToken.revoke_user(1) == 1
+        assert ents.RefreshToken.rotate(token, self.expires()) is None
+        assert ents.RefreshToken.rotate(other_token, self.expires()) is not None
+
+    def test_purge_expired(self):
+        self.issue()
+        self.issue(minutes=-1)
+        assert ents.RefreshToken.purge_expired() == 1
+        assert ents.RefreshToken.query.count() == 1
+
+
 class TestEntityRegistry(object):
     def test_bad_type(self):
         registry = entity_registry.EntityRegistry()
@@ -0,0 +1,135 @@
+import math
+from unittest import mock
+
+import arrow
+
+from keg_auth.libs.revocation import BloomFilter, RevocationStore
+from keg_auth_ta.model import entities as ents
+
+
+class FakeTimer:
+    def __init__(self, now=1000):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestBloomFilter:
+    def test_membership(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        items = [f'jti-{index}' for index in range(1000)]
+        for item in items:
+            bloom.add(item)
+        assert all(item in bloom for item in items)
+
+        false_positives = sum(f'other-{index}' in bloom for index in range(10000))
+        assert false_positives < 300
+
+    def test_sizing(self):
+        bloom = BloomFilter(capacity=100000, error_rate=0.001)
+        assert bloom.num_hashes == 10
+        assert 170000 < len(bloom.bits) < 190000
+
+
+class TestRevocationStore:
+    def test_add_and_expire(self):
+        timer = FakeTimer()
+        store = RevocationStore(timer=timer)
+        store.add('foo', 1010)
+        store.add('forever')
+        store.add('expired', 1000)
+
+        assert store.is_revoked('foo')
+        assert store.is_revoked('forever')
+        assert not store.is_revoked('expired')
+        assert not store.is_revoked('bar')
+        assert not store.is_revoked(None)
+        assert len(store) == 2
+
+        timer.now = 1010
+        assert not store.is_revoked('foo')
+        store.prune()
+        assert len(store) == 1
+        assert 'foo' not in store._bloom
+        assert store._next_expiry == math.inf
+
+    def test_prune_waits_for_first_expiry(self):
+        timer = FakeTimer()
+        store = RevocationStore(timer=timer)
+        store.add('foo', 1010)
+        bloom = store._bloom
+        store.prune()
+        assert store._bloom is bloom
+
+    def test_pruned_without_sync(self):
+        # with no revoked token entity, nothing syncs, so adding and checking prune
+        timer = FakeTimer()
+        store = RevocationStore(timer=timer)
+        for index in range(5):
+            store.add(f'old-{index}', 1010)
+        assert len(store) == 5
+
+        timer.now = 1010
+        store.add('new', 1100)
+        assert len(store) == 1
+        assert 'old-0' not in store._bloom
+        assert store._next_expiry == 1100
+
+        timer.now = 1100
+        assert 'new' in store._bloom
+        assert not store.is_revoked('new')
+        assert len(store) == 0
+        assert store._next_expiry == math.inf
+
+    def test_not_revoked_skips_set(self):
+        store = RevocationStore()
+        with mock.patch.object(store, '_revoked', wraps={}) as m_revoked:
+            assert not store.is_revoked('foo')
+        assert not m_revoked.get.called
+
+
+class TestRevokedTokenSync:
+    def setup_method(self):
+        ents.RevokedToken.delete_cascaded()
+
+    def test_sync(self):
+        timer = FakeTimer()
+        store = RevocationStore(sync_interval=30, timer=timer)
+        ents.RevokedToken.revoke('foo', arrow.utcnow().shift(minutes=5))
+        ents.RevokedToken.revoke('forever')
+        ents.RevokedToken.revoke('expired', arrow.utcnow().shift(minutes=-5))
+
+        store.sync(ents.RevokedToken)
+        assert store.is_revoked('foo')
+        assert store.is_revoked('forever')
+        assert not store.is_revoked('expired')
+
+        # within the interval, nothing is loaded
+        ents.RevokedToken.revoke('bar', arrow.utcnow().shift(minutes=5))
+        store.sync(ents.RevokedToken)
+        assert not store.is_revoked('bar')
+
+        timer.now += 30
+        store.sync(ents.RevokedToken)
+        assert store.is_revoked('bar')
+
+    def test_revoke_once(self):
+        ents.RevokedToken.revoke('foo')
+        ents.RevokedToken.revoke('foo')
+        assert ents.RevokedToken.query.count() == 1
+
+    def test_revoke_race(self):
+        ents.RevokedToken.revoke('foo')
+        # another process inserted the row after the existence check
+        with mock.patch.object(ents.RevokedToken, 'query') as m_query:
+            m_query.filter_by.return_value.count.return_value = 0
+            ents.RevokedToken.revoke('foo')
+        assert ents.RevokedToken.query.count() == 1
+
+    def test_purge_expired(self):
+        ents.RevokedToken.revoke('foo', arrow.utcnow().shift(minutes=5))
+        ents.RevokedToken.revoke('forever')
+        ents.RevokedToken.revoke('expired', arrow.utcnow().shift(minutes=-5))
+        assert ents.RevokedToken.purge_expired() == 1
+        assert sorted(row.jti for row in ents.RevokedToken.query) == ['foo', 'forever']
@@ -0,0 +1,132 @@
+import io
+
+import flask
+import mock
+import pytest
+
+from keg_auth.libs.user_import import UserImportError, UserImporter, read_user_records
+from keg_auth_ta.model import entities as ents
+
+
+class TestReadUserRecords:
+    def test_csv(self):
+        stream = io.StringIO('email,password,groups\nfoo@bar.com,pass,a;b\nbaz@bar.com,,\n')
+        assert list(read_user_records(stream)) == [
+            (2, {'email': 'foo@bar.com', 'password': 'pass', 'groups': 'a;b'}),
+            (3, {'email': 'baz@bar.com'}),
+        ]
+
+    def test_jsonl(self):
+        stream = io.StringIO('{"email": "foo@bar.com", "groups": ["a"]}\n\n{"email": "b@c.com"}\n')
+        assert list(read_user_records(stream, format='jsonl')) == [
+            (1, {'email': 'foo@bar.com', 'groups': ['a']}),
+            (3, {'email': 'b@c.com'}),
+        ]
+
+    def test_jsonl_invalid(self):
+        with pytest.raises(UserImportError, match='Line 2: invalid JSON'):
+            list(read_user_records(io.StringIO('{}\n{"foo"\n'), format='jsonl'))
+
+    def test_unknown_format(self):
+        with pytest.raises(ValueError):
+            list(read_user_records(io.StringIO(''), format='xml'))
+
+
+class TestUserImport:
+    def setup_method(self):
+        ents.User.delete_cascaded()
+        ents.Group.delete_cascaded()
+        ents.Bundle.delete_cascaded()
+
+    def import_users(self, records, **kwargs):
+        kwargs.setdefault('workers', 0)
+        return flask.current_app.auth_manager.import_users(enumerate(records, start=1), **kwargs)
+
+    def test_import(self):
+        group = ents.Group.fake(name='group1')
+        bundle1 = ents.Bundle.fake(name='bundle1')
+        bundle2 = ents.Bundle.fake(name='bundle2')
+
+        report = self.import_users([
+            {'email': 'Foo@Bar.com', 'password': 'pass', 'groups': 'group1',
+             'bundles': 'bundle1; bundle2', 'is_superuser': 'true'},
+            {'username': 'baz@bar.com', 'bundles': ['bundle2'], 'is_verified': True},
+        ])
+        assert (report.processed, report.created, report.skipped) == (2, 2, 0)
+        assert report.errors == []
+        assert report.last_line == 2
+
+        foo = ents.User.get_by(email='foo@bar.com')
+        assert foo.password == 'pass'
+        assert foo.is_superuser is True
+        assert foo.is_verified is False
+        assert foo.session_key
+        assert foo.groups == [group]
+        assert set(foo.bundles) == {bundle1, bundle2}
+
+        baz = ents.User.get_by(email='baz@bar.com')
+        # no password given: nothing will match at login until one is set
+        assert baz.password is None
+        assert baz.is_superuser is False
+        assert baz.is_verified is True
+        assert baz.groups == []
+        assert baz.bundles == [bundle2]
+
+    def test_errors(self):
+        report = self.import_users([
+            {'password': 'pass'},
+            {'email': 'foo@bar.com', 'groups': 'nope'},
+            {'email': 'foo@bar.com', 'favorite_color': 'green'},
+            {'email': 'foo@bar.com', 'is_enabled': 'maybe'},
+            {'email': 'ok@bar.com'},
+        ])
+        assert report.errors == [
+            (1, 'Missing email'),
+            (2, 'Unknown groups: nope'),
+            (3, 'Unknown fields: favorite_color'),
+            (4, 'Invalid value for is_enabled: maybe'),
+        ]
+        assert report.created == 1
+        assert ents.User.query.count() == 1
+
+    def test_resume(self):
+        ents.User.fake(email='foo@bar.com', password='orig')
+        progress = mock.Mock()
+        report = self.import_users([
+            {'email': 'FOO@bar.com', 'password': 'new'},
+            {'email': 'a@bar.com'},
+            {'email': 'b@bar.com'},
+            {'email': 'a@bar.com'},
+            {'email': 'c@bar.com'},
+        ], batch_size=2, progress=progress)
+        assert (report.created, report.skipped) == (3, 2)
+        assert ents.User.query.count() == 4
+        assert ents.User.get_by(email='foo@bar.com').password == 'orig'
+        assert [c.args[0] for c in progress.call_args_list] == [report] * 3
+        assert report.last_line == 5
+
+    def test_password_process_pool(self):
+        report = self.import_users(
+            [{'email': f'user{i}@bar.com', 'password': f'pass{i}'} for i in range(3)],
+            workers=2,
+        )
+        assert report.created == 3
+        assert ents.User.get_by(email='user2@bar.com').password == 'pass2'
+
+    @mock.patch('keg_auth_ta.app.mail_ext.send', autospec=True, spec_set=True)
+    def test_mail(self, m_send):
+        with mock.patch.object(
+            flask.current_app.auth_manager.login_authenticator, 'is_domain_excluded',
+            side_effect=lambda username: username.endswith('@excluded.com'),
+        ):
+            report = self.import_users([
+                {'email': 'foo@bar.com'},
+                {'email': 'foo@excluded.com'},
+            ], mail_enabled=True)
+        assert report.mailed == 1
+        assert m_send.call_count == 1
+
+    def test_no_mappings(self):
+        importer = UserImporter(ents.User, workers=0)
+        report = importer.run([(1, {'email': 'foo@bar.com', 'groups': 'group1'})])
+        assert report.errors == [(1, 'Cannot assign groups')]
@@ -1,6 +1,107 @@
+from unittest import mock
+
+import flask
+
 from keg_auth.libs import get_domain_from_email
+from keg_auth.libs.caching import JSONFileCache, TTLCache
+from keg_auth.libs.challenge import (
+    issue_pow_challenge,
+    pow_solution_is_valid,
+    solve_pow_challenge,
+    verify_pow_solution,
+)
 
 
 def test_email_domain():
     assert get_domain_from_email('foo@bar.baz') == 'bar.baz'
     assert get_domain_from_email('foobar') is None
+
+
+class TestProofOfWorkChallenge:
+    def test_solve_and_verify(self):
+        challenge = issue_pow_challenge('foo@bar.com', 8, 5)
+        solution = solve_pow_challenge(challenge, 8)
+        assert pow_solution_is_valid(challenge, solution, 8)
+        assert verify_pow_solution(challenge, solution, 'foo@bar.com', 8, 5)
+
+    def test_wrong_context(self):
+        challenge = issue_pow_challenge('foo@bar.com', 8, 5)
+        solution = solve_pow_challenge(challenge, 8)
+        assert not verify_pow_solution(challenge, solution, 'bar@bar.com', 8, 5)
+        assert not verify_pow_solution(challenge, solution, 'foo@bar.com', 8, 6)
+        assert not verify_pow_solution(challenge, solution, 'foo@bar.com', 9, 5)
+
+    def test_bad_solution(self):
+        challenge = issue_pow_challenge('foo@bar.com', 8)
+        solution = solve_pow_challenge(challenge, 8)
+        assert not verify_pow_solution(challenge, None, 'foo@bar.com', 8)
+        assert not verify_pow_solution(challenge, 'abc', 'foo@bar.com', 8)
+        assert not verify_pow_solution(challenge, '1' * 21, 'foo@bar.com', 8)
+        assert not verify_pow_solution(challenge, str(int(solution) + 1), 'foo@bar.com', 16)
+
+    def test_bad_challenge(self):
+        challenge = issue_pow_challenge('foo@bar.com', 0)
+        assert not verify_pow_solution(None, '1', 'foo@bar.com', 0)
+        assert not verify_pow_solution(challenge + 'x', '1', 'foo@bar.com', 0)
+
+        with mock.patch.dict(flask.current_app.config, {'SECRET_KEY': 'something-else'}):
+            assert not verify_pow_solution(challenge, '1', 'foo@bar.com', 0)
+
+    def test_expired_challenge(self):
+        challenge = issue_pow_challenge('foo@bar.com', 0)
+        with mock.patch.dict(flask.current_app.config, {'KEGAUTH_LOGIN_POW_TTL': -1}):
+            assert not verify_pow_solution(challenge, '1', 'foo@bar.com', 0)
+
+
+class TestTTLCache:
+    def test_expiry(self):
+        now = [0]
+        cache = TTLCache(ttl=10, timer=lambda: now[0])
+        cache.set('foo', 1)
+        now[0] = 9
+        assert cache.get('foo') == 1
+        now[0] = 10
+        assert cache.get('foo') is None
+        assert len(cache) == 0
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2)
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        cache.get('foo')
+        cache.set('baz', 3)
+        assert (cache.get('foo'), cache.get('bar'), cache.get('baz')) == (1, None, 3)
+
+    def test_pop_and_discard(self):
+        cache = TTLCache()
+        cache.set('foo', 1)
+        cache.set('bar', 2)
+        cache.set('baz', 3)
+        assert cache.pop('foo') == 1
+        assert cache.pop('foo', 'missing') == 'missing'
+        cache.discard_where(lambda value: value > 2)
+        assert (cache.get('bar'), cache.get('baz')) == (2, None)
+        cache.clear()
+        assert len(cache) == 0
+
+
+class TestJSONFileCache:
+    def test_expiry(self, tmp_path):
+        now = [0]
+        cache = JSONFileCache(str(tmp_path / 'cache'), ttl=10, timer=lambda: now[0])
+        assert cache.get('foo') is None
+        cache.set('foo', {'bar': 1})
+        now[0] = 9
+        assert cache.get('foo') == {'bar': 1}
+
+        # shared with other instances on the directory
+        assert JSONFileCache(str(tmp_path / 'cache'), timer=lambda: now[0]).get('foo') == {'bar': 1}
+
+        now[0] = 10
+        assert cache.get('foo', 'missing') == 'missing'
+
+    def test_unreadable(self, tmp_path):
+        cache = JSONFileCache(str(tmp_path))
+        with open(cache.path('foo'), 'w') as fo:
+            fo.write('not json')
+        assert cache.get('foo') is None
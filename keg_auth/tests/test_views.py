@@ -12,6 +12,7 @@ from werkzeug.datastructures import MultiDict
 from keg.testing import ContextManager
 from keg_auth_ta.app import KegAuthTestApp, mail_ext
 from keg_auth.libs.authenticators import OAuthAuthenticator, RedirectAuthenticator
+from keg_auth.libs.challenge import solve_pow_challenge
 from keg_auth.libs.decorators import requires_user
 from keg_auth.testing import AuthTests, AuthTestApp, ViewTestBase
 from keg_auth.tests.utils import oauth_profile
@@ -21,6 +22,8 @@ import flask_login
 from .utils import listen_to
 
 from keg_auth import get_current_user
+from keg_auth.libs import get_request_kind
+from keg_auth.libs.authenticators import RequestLoaderDispatch
 
 
 @pytest.fixture(scope='function')
@@ -377,6 +380,196 @@ class TestViews(object):
         assert doc('div#page-content a').attr('href') == '/login'
 
 
+class TestLoginTransaction:
+    def setup_method(self):
+        ents.User.delete_cascaded()
+        ents.Attempt.delete_cascaded()
+        self.user = ents.User.fake(email='foo@bar.com', password='pass')
+        self.statements = []
+        self.commits = 0
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement.split()[0].upper())
+
+    def on_commit(self, conn):
+        self.commits += 1
+
+    def submit(self, password):
+        client = flask_webtest.TestApp(flask.current_app)
+        resp = client.get('/login')
+        resp.form['login_id'] = 'foo@bar.com'
+        resp.form['password'] = password
+
+        sa.event.listen(db.engine, 'before_cursor_execute', self.on_execute)
+        sa.event.listen(db.engine, 'commit', self.on_commit)
+        try:
+            return resp.form.submit()
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', self.on_execute)
+            sa.event.remove(db.engine, 'commit', self.on_commit)
+
+    def test_success(self):
+        resp = self.submit('pass')
+        assert resp.status_code == 302
+
+        # the attempt is committed before the password is checked, then marked successful
+        # along with the last login
+        assert self.commits == 2
+        assert [statement for statement in self.statements if statement != 'SELECT'] == [
+            'INSERT', 'UPDATE', 'UPDATE'
+        ]
+        attempt = ents.Attempt.query.one()
+        assert attempt.success is True
+        assert ents.User.query.get(self.user.id).last_login_utc is not None
+
+    def test_invalid_password(self):
+        resp = self.submit('badpass')
+        assert resp.flashes == [('error', 'Invalid password.')]
+
+        assert self.commits == 1
+        assert self.statements.count('INSERT') == 1
+        assert 'UPDATE' not in self.statements
+        assert ents.Attempt.query.one().success is False
+
+    def test_unexpected_error(self):
+        # the attempt is already committed when the password check fails
+        with mock.patch(
+            'keg_auth.libs.authenticators.KegAuthenticator.verify_user', autospec=True,
+            side_effect=RuntimeError,
+        ), pytest.raises(RuntimeError):
+            self.submit('pass')
+
+        db.session.rollback()
+        assert ents.Attempt.query.one().success is False
+
+
+class TestLoginProofOfWork:
+    config = {
+        'KEGAUTH_LOGIN_POW_ENABLED': True,
+        'KEGAUTH_LOGIN_POW_THRESHOLD': 2,
+        'KEGAUTH_LOGIN_POW_BASE_DIFFICULTY': 4,
+        'KEGAUTH_LOGIN_POW_MAX_DIFFICULTY': 5,
+        'KEGAUTH_ATTEMPT_IP_LIMIT': False,
+    }
+
+    def setup_method(self):
+        ents.User.delete_cascaded()
+        ents.Attempt.delete_cascaded()
+        ents.User.fake(email='foo@bar.com', password='pass')
+
+    def submit(self, resp, password, solve=True):
+        resp.form['login_id'] = 'foo@bar.com'
+        resp.form['password'] = password
+        challenge = resp.form['pow_challenge'].value
+        if solve and challenge:
+            resp.form['pow_solution'] = solve_pow_challenge(
+                challenge, resp.context['pow_difficulty']
+            )
+        return resp.form.submit()
+
+    @mock.patch.dict('flask.current_app.config', config)
+    def test_challenge_after_threshold(self):
+        client = flask_webtest.TestApp(flask.current_app)
+        resp = client.get('/login')
+        assert resp.form['pow_challenge'].value == ''
+        assert 'pow_solution' in resp.form.fields
+
+        resp = self.submit(resp, 'badpass')
+        assert resp.form['pow_challenge'].value == ''
+        assert resp.context['pow_difficulty'] == 0
+
+        # threshold reached, next attempt must solve a challenge
+        resp = self.submit(resp, 'badpass')
+        assert resp.form['pow_challenge'].value
+        assert resp.context['pow_difficulty'] == 4
+        assert 'sha256' in resp.text
+
+        resp = self.submit(resp, 'badpass')
+        assert resp.flashes == [('error', 'Invalid password.')]
+        assert resp.context['pow_difficulty'] == 5
+
+        resp = self.submit(resp, 'pass')
+        assert resp.status_code == 302
+        assert resp.flashes == [('success', 'Login successful.')]
+        assert ents.Attempt.query.filter_by(success=True).count() == 1
+
+    @mock.patch.dict('flask.current_app.config', config)
+    def test_unsolved_challenge(self):
+        client = flask_webtest.TestApp(flask.current_app)
+        resp = client.get('/login')
+        resp = self.submit(resp, 'badpass')
+        resp = self.submit(resp, 'badpass')
+
+        with mock.patch(
+            'keg_auth.libs.authenticators.KegAuthenticator.verify_user', autospec=True
+        ) as m_verify:
+            resp = self.submit(resp, 'pass', solve=False)
+        assert resp.status_code == 200
+        assert resp.flashes == [
+            ('error', 'Login challenge not completed. Please try again.')
+        ]
+        # password was never checked, the attempt counts as a failure
+        assert not m_verify.called
+        assert ents.Attempt.query.filter_by(success=False).count() == 3
+
+    @mock.patch.dict('flask.current_app.config', config)
+    def test_challenge_not_served(self):
+        client = flask_webtest.TestApp(flask.current_app)
+        resp = client.get('/login')
+        resp = self.submit(resp, 'badpass')
+        resp = self.submit(resp, 'badpass')
+
+        # threshold reached, but a fresh login page has no challenge yet
+        resp = client.get('/login')
+        assert resp.form['pow_challenge'].value == ''
+        with mock.patch(
+            'keg_auth.libs.authenticators.KegAuthenticator.verify_user', autospec=True
+        ) as m_verify:
+            resp = self.submit(resp, 'pass')
+        assert resp.status_code == 200
+        assert resp.flashes == [
+            ('error', 'Please log in again to complete the login challenge.')
+        ]
+        assert not m_verify.called
+        assert ents.Attempt.query.count() == 2
+        assert resp.form['pow_challenge'].value
+        assert resp.context['pow_difficulty'] == 4
+
+        resp = self.submit(resp, 'pass')
+        assert resp.status_code == 302
+        assert resp.flashes == [('success', 'Login successful.')]
+
+    @mock.patch.dict('flask.current_app.config', config)
+    def test_challenge_single_use(self):
+        client = flask_webtest.TestApp(flask.current_app)
+        resp = client.get('/login')
+        resp = self.submit(resp, 'badpass')
+        resp = self.submit(resp, 'badpass')
+
+        challenge = resp.form['pow_challenge'].value
+        solution = solve_pow_challenge(challenge, 4)
+        resp.form['login_id'] = 'foo@bar.com'
+        resp.form['password'] = 'badpass'
+        resp.form['pow_solution'] = solution
+        resp = resp.form.submit()
+        assert resp.flashes == [('error', 'Invalid password.')]
+
+        # replaying the solved challenge fails, another failure has been logged since
+        resp.form['login_id'] = 'foo@bar.com'
+        resp.form['password'] = 'pass'
+        resp.form['pow_challenge'] = challenge
+        resp.form['pow_solution'] = solution
+        resp = resp.form.submit()
+        assert resp.flashes == [
+            ('error', 'Login challenge not completed. Please try again.')
+        ]
+
+    def test_disabled(self):
+        client = flask_webtest.TestApp(flask.current_app)
+        resp = client.get('/login')
+        assert 'pow_challenge' not in resp.form.fields
+
+
 class TestPermissionsRequired:
     @classmethod
     def setup_class(cls):
@@ -574,6 +767,52 @@ class TestRequestLoaders(object):
         resp = client.get('/jwt-required', status=200)
         assert resp.text == 'jwt-required'
 
+    def test_anonymous_fast_path(self):
+        counts = flask.current_app.auth_manager.fast_path_counts
+        before = counts['anonymous']
+        client = flask_webtest.TestApp(flask.current_app)
+        with mock.patch.object(
+            flask.current_app.auth_manager.get_request_loader('jwt'), 'get_authenticated_user',
+        ) as m_loader:
+            client.get('/jwt-required', status=302)
+        m_loader.assert_not_called()
+        assert counts['anonymous'] == before + 1
+
+        # a header a loader reads makes it run
+        client.set_authorization(('Bearer', 'abc'))
+        client.get('/jwt-required', status=422)
+        assert counts['anonymous'] == before + 1
+
+    def test_static_fast_path(self):
+        counts = flask.current_app.auth_manager.fast_path_counts
+        before = counts['static']
+        client = flask_webtest.TestApp(flask.current_app)
+        client.get('/static/webgrid/missing.js', status=404)
+        assert counts['static'] == before + 1
+
+    def test_request_kind(self):
+        session_cookie = flask.current_app.config['SESSION_COOKIE_NAME']
+        for headers, kind in [
+            ({}, 'anonymous'),
+            # no registered loader reads this one
+            ({'X-Auth-Token': 'abc'}, 'anonymous'),
+            ({'Authorization': 'Bearer abc'}, 'credentials'),
+            # not the JWT header type
+            ({'Authorization': 'Basic abc'}, 'anonymous'),
+            ({'Cookie': f'{session_cookie}=abc'}, 'credentials'),
+        ]:
+            with flask.current_app.test_request_context('/', headers=headers):
+                assert get_request_kind() == kind
+
+        with flask.current_app.test_request_context('/?jwt=abc'):
+            assert get_request_kind() == 'anonymous'
+        auth_manager = flask.current_app.auth_manager
+        config = dict(flask.current_app.config, JWT_TOKEN_LOCATION=['query_string'])
+        dispatch = RequestLoaderDispatch(auth_manager.request_loaders.values(), config)
+        with mock.patch.object(auth_manager, 'request_loader_dispatch', dispatch):
+            with flask.current_app.test_request_context('/?jwt=abc'):
+                assert get_request_kind() == 'credentials'
+
     def test_per_endpoint_loader(self):
         ents.User.fake()
 
@@ -1381,7 +1620,7 @@ def oauth_client():
     with mock.patch.dict(
         'flask.current_app.config',
         {'KEGAUTH_OAUTH_PROFILES': [oauth_profile()]}
-    ):
+    ), mock.patch.object(OAuthAuthenticator, 'fetch_provider_metadata', return_value={}):
         authenticator = OAuthAuthenticator(flask.current_app)
         flask.current_app.auth_manager.oauth_authenticator = authenticator
         client = flask.current_app.auth_manager.oauth.create_client('google')
@@ -1444,3 +1683,51 @@ class TestOAuthAuthorize:
             m_auth.return_value = {'userinfo': {'email': auth_user.email}}
             resp = client.get('/oauth-authorize/google')
             assert 'has been disabled' in resp
+
+
+class TestJsonWebKeySet:
+    def test_not_configured(self):
+        client = flask_webtest.TestApp(flask.current_app)
+        client.get('/.well-known/jwks.json', status=404)
+
+    def test_published(self):
+        from keg_auth.tests.test_jwks import ed_key, private_pem, public_pem, rsa_key
+        config = {'KEGAUTH_JWT_SIGNING_KEYS': [private_pem(ed_key), public_pem(rsa_key)]}
+        with mock.patch.dict(flask.current_app.config, config):
+            client = flask_webtest.TestApp(flask.current_app)
+            resp = client.get('/.well-known/jwks.json')
+            loader = flask.current_app.auth_manager.get_request_loader('jwt')
+            assert resp.json == loader.get_jwks()
+        assert [key['alg'] for key in resp.json['keys']] == ['EdDSA', 'RS256']
+        assert not any('d' in key for key in resp.json['keys'])
+        assert resp.headers['Cache-Control'] == 'public, max-age=300'
+
+
+class TestJwtRefresh:
+    def setup_method(self):
+        ents.User.delete_cascaded()
+        ents.RefreshToken.delete_cascaded()
+
+    def test_refresh(self):
+        user = ents.User.fake()
+        loader = flask.current_app.auth_manager.get_request_loader('jwt')
+        refresh_token = loader.create_refresh_token(user)
+
+        client = flask_webtest.TestApp(flask.current_app)
+        resp = client.post_json('/jwt/refresh', {'refresh_token': refresh_token})
+        assert resp.json['refresh_token'] != refresh_token
+        headers = {'Authorization': f'Bearer {resp.json["access_token"]}'}
+        assert client.get('/jwt-required', headers=headers, status=200).text == 'jwt-required'
+
+        resp = client.post('/jwt/refresh', {'refresh_token': resp.json['refresh_token']})
+        assert resp.json['access_token']
+
+    def test_invalid(self):
+        client = flask_webtest.TestApp(flask.current_app)
+        resp = client.post_json('/jwt/refresh', {'refresh_token': 'krt.foo.bar'}, status=401)
+        assert resp.json == {'error': 'invalid_grant'}
+        client.post('/jwt/refresh', status=401)
+
+    def test_csrf_exempt(self):
+        csrf = flask.current_app.extensions['csrf']
+        assert 'keg_auth.views.jwt-refresh' in csrf._exempt_views
@@ -663,11 +663,65 @@ class Permission(keg.web.BaseView):
         )
 
 
+class JsonWebKeySet(keg.web.BaseView):
+    """Public JWT signing keys, as a JWKS document for verifying tokens in other services.
+
+    404 unless JwtRequestLoader is configured with asymmetric signing keys."""
+    url = '/.well-known/jwks.json'
+
+    @classmethod
+    def calc_endpoint(cls, use_blueprint=True):
+        prefix = (cls.blueprint.name + '.') if cls.blueprint and use_blueprint else ''
+        return prefix + 'jwks'
+
+    def get(self):
+        loader = flask.current_app.auth_manager.get_request_loader('jwt')
+        jwks = loader.get_jwks() if loader is not None else None
+        if not jwks or not jwks['keys']:
+            flask.abort(404)
+
+        resp = flask.jsonify(jwks)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = flask.current_app.config.get('KEGAUTH_JWT_JWKS_MAX_AGE')
+        return resp
+
+
+class JwtRefresh(keg.web.BaseView):
+    """Exchange a refresh token for a new access token and refresh token.
+
+    Takes ``refresh_token`` as JSON or form data. Responds with JSON, 401 if the token is not
+    valid. 404 unless JwtRequestLoader is in use and a refresh token entity is registered."""
+    url = '/jwt/refresh'
+
+    # tokens are presented explicitly, there is no session to protect
+    _csrf_custom_handling = True
+
+    @classmethod
+    def calc_endpoint(cls, use_blueprint=True):
+        prefix = (cls.blueprint.name + '.') if cls.blueprint and use_blueprint else ''
+        return prefix + 'jwt-refresh'
+
+    def post(self):
+        auth_manager = flask.current_app.auth_manager
+        loader = auth_manager.get_request_loader('jwt')
+        if loader is None or not auth_manager.entity_registry.is_registered('refresh_token'):
+            flask.abort(404)
+
+        data = flask.request.get_json(silent=True) or flask.request.form
+        tokens = loader.refresh(data.get('refresh_token'))
+        if tokens is None:
+            return flask.jsonify(error='invalid_grant'), 401
+
+        access_token, refresh_token = tokens
+        return flask.jsonify(access_token=access_token, refresh_token=refresh_token)
+
+
 def make_blueprint(import_name, _auth_manager, bp_name='auth', login_cls=Login,
                    forgot_cls=ForgotPassword, reset_cls=ResetPassword, logout_cls=Logout,
                    verify_cls=VerifyAccount, user_crud_cls=User, group_crud_cls=Group,
                    bundle_crud_cls=Bundle, permission_cls=Permission, oauth_login_cls=OAuthLogin,
-                   oauth_auth_cls=OAuthAuthorize, blueprint_class=flask.Blueprint, **kwargs):
+                   oauth_auth_cls=OAuthAuthorize, jwks_cls=JsonWebKeySet,
+                   jwt_refresh_cls=JwtRefresh, blueprint_class=flask.Blueprint, **kwargs):
     """ Blueprint factory for keg-auth views
 
         Most params are assumed to be view classes. `_auth_manager` is the extension instance meant
@@ -688,8 +742,8 @@ def make_blueprint(import_name, _auth_manager, bp_name='auth', login_cls=Login,
         if view_cls:
             view_cls.auth_manager = _auth_manager
 
-    for view_cls in (user_crud_cls, group_crud_cls, bundle_crud_cls, permission_cls,
-                     *auth_responded_views):
+    for view_cls in (user_crud_cls, group_crud_cls, bundle_crud_cls, permission_cls, jwks_cls,
+                     jwt_refresh_cls, *auth_responded_views):
         if view_cls:
             view_cls.assign_blueprint(_blueprint)
 
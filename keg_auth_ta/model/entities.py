@@ -43,6 +43,16 @@ class Attempt(keg_auth.AttemptMixin, EntityMixin, db.Model):
     __tablename__ = 'attempts'
 
 
+@auth_entity_registry.register_revoked_token
+class RevokedToken(keg_auth.RevokedTokenMixin, EntityMixin, db.Model):
+    __tablename__ = 'revoked_tokens'
+
+
+@auth_entity_registry.register_refresh_token
+class RefreshToken(keg_auth.RefreshTokenMixin, EntityMixin, db.Model):
+    __tablename__ = 'refresh_tokens'
+
+
 @auth_entity_registry.register_permission
 class Permission(keg_auth.PermissionMixin, EntityMixin, db.Model):
     __tablename__ = 'permissions'